@@ -1,7 +1,10 @@
-import traceback
+import time
+
+import numpy as np
 
 from enforce_phase import phase, enforce_phase, has_phase_enforced_methods
-from utils import formatobj
+from utils import formatobj, capture_call_site, format_call_site
+from timing import to_integer_time
 
 
 class HasParent(object, metaclass=has_phase_enforced_methods):
@@ -30,6 +33,9 @@ class HasParent(object, metaclass=has_phase_enforced_methods):
         # Add self to the phase enforcer's registry of all instances:
         enforce_phase.register_instance(self)
 
+    def __getstate__(self):
+        return enforce_phase.instance_state(self)
+
 
 class Instruction(HasParent):
     @enforce_phase(phase.ADD_INSTRUCTIONS)
@@ -48,16 +54,34 @@ class Instruction(HasParent):
         useful)."""
         super().__init__(parent, **kwargs)
         self.t = t
+        if self.shot.timeline == 'integer':
+            # t as an integer number of the shot's epsilon, see
+            # timing.TIMELINE_MODES:
+            self.integer_t = to_integer_time(t, self.shot.epsilon)
         self.parent.add_instruction(self)
         self.pseudoclock = parent.pseudoclock
 
         # Timing details to be computed during processing:
+        self.segment = None
         self.relative_t = None
         self.quantised_t = None
 
         # For giving the user a traceback if an error regarding this
-        # instruction is found during later processing:
-        self.traceback = ''.join(traceback.format_stack()[:-_inst_depth])
+        # instruction is found during later processing. Depending on the
+        # shot's traceback_capture setting this is either the formatted
+        # traceback, the raw call site to be formatted on demand, or None:
+        capture = self.shot.traceback_capture
+        profile = self.shot.profile
+        if profile is not None:
+            start = time.perf_counter()
+        if capture == 'lazy':
+            self._call_site = capture_call_site(_inst_depth)
+        elif capture == 'full':
+            self._call_site = format_call_site(capture_call_site(_inst_depth))
+        else:
+            self._call_site = None
+        if profile is not None and capture != 'off':
+            profile.add_traceback_capture(time.perf_counter() - start)
 
         # Count how many instructions there are and save which number we are:
         self.instruction_number = self.parent.shot.total_instructions
@@ -71,8 +95,33 @@ class Instruction(HasParent):
         pseudoclock's timebase. This method converts self.t, producing
         self.relative_t and self.quantised_t. Subclasses implementing this
         method should call our implementation, then convert any additional
-        times that they specify to their relative and quantised versions."""
-        pass
+        times that they specify to their relative and quantised versions.
+        Instructions not controlled by a pseudoclock are not quantised.
+        Shot.convert_timing() does this for all instructions at once using
+        timing.convert_timing(), which calls this method individually only
+        for subclasses that reimplement it."""
+        from timing import convert_instruction_times
+        if self.pseudoclock is None:
+            timebase = 1
+            integer_timebase = 1 if self.shot.timeline == 'integer' else None
+        else:
+            timebase = self.pseudoclock.timebase
+            integer_timebase = self.pseudoclock.integer_timebase
+        segment, relative_t, quantised_t = convert_instruction_times(
+            np.array([self.t]), np.array([getattr(self, 'integer_t', 0)]), waits, timebase,
+            integer_timebase, self.shot.epsilon)
+        self.segment = segment.item()
+        self.relative_t = relative_t.item()
+        if self.pseudoclock is not None:
+            self.quantised_t = quantised_t.item()
+
+    @property
+    def traceback(self):
+        """The formatted stack of user code that created this instruction,
+        or None if the shot was created with traceback_capture='off'"""
+        if self._call_site is None or isinstance(self._call_site, str):
+            return self._call_site
+        return format_call_site(self._call_site)
 
     def __str__(self):
         return formatobj(self, 'parent', 't')
@@ -122,17 +171,30 @@ class HasDevices(HasChildren):
         (not including this instance itself). If recurse_into_pseudoclocks is
         True, then pseudoclocks that are descendants of this instance, and all
         of their descendants (including further pseudoclocks and so on) will
-        be returned as well, otherwise they will be excluded."""
-        from devices import Pseudoclock
+        be returned as well, otherwise they will be excluded. Once the device
+        hierarchy is complete, this is looked up in the shot's
+        HierarchyIndex instead of recursing."""
+        if self.shot.hierarchy is not None:
+            return self.shot.hierarchy.descendants(self, recurse_into_pseudoclocks)
         devices = []
         for device in self.devices:
-            if isinstance(device, Pseudoclock) and not recurse_into_pseudoclocks:
+            # Pseudoclocks are their own pseudoclock:
+            if device.pseudoclock is device and not recurse_into_pseudoclocks:
                 continue
             else:
                 devices.append(device)
                 devices.extend(device.descendant_devices(recurse_into_pseudoclocks))
         return devices
 
+    def descendant_devices_of_type(self, cls, recurse_into_pseudoclocks=False):
+        """Return devices as for descendant_devices(), but only those that
+        are instances of the given class"""
+        if self.shot.hierarchy is not None:
+            return self.shot.hierarchy.descendants_of_type(self, cls,
+                                                           recurse_into_pseudoclocks)
+        return [device for device in self.descendant_devices(recurse_into_pseudoclocks)
+                if isinstance(device, cls)]
+
     def descendant_instructions(self, recurse_into_pseudoclocks=False):
         """Recursively return instructions of all devices that are descendants
         of this instance, including its own instructions (if any). If
@@ -140,13 +202,10 @@ class HasDevices(HasChildren):
         that are descendants of this instance, and all of their descendants
         (including further pseudoclocks and so one) will be returned as well,
         otherwise they will be excluded."""
-        from devices import Pseudoclock
         instructions = super().descendant_instructions(recurse_into_pseudoclocks)
-        for device in self.devices:
-            if isinstance(device, Pseudoclock) and not recurse_into_pseudoclocks:
-                continue
-            else:
-                instructions.extend(device.descendant_instructions(recurse_into_pseudoclocks))
+        for device in self.descendant_devices_of_type(HasInstructions,
+                                                      recurse_into_pseudoclocks):
+            instructions.extend(device.instructions)
         return instructions
 
     @enforce_phase(phase.ESTABLISH_COMMON_LIMITS, exactly_once=True)
@@ -198,6 +257,9 @@ class HasInstructions(HasChildren):
 
     @enforce_phase(phase.ADD_INSTRUCTIONS)
     def add_instruction(self, instruction):
+        if self.shot.frozen:
+            msg = "Cannot add instructions to a frozen shot. Use shot.fork()"
+            raise RuntimeError(msg)
         if not any(isinstance(instruction, cls) for cls in self.allowed_instructions):
             msg = (f"Instruction of type {instruction.__class__.__name__} "
                    f"not permitted by {self}")
@@ -207,6 +269,26 @@ class HasInstructions(HasChildren):
             raise ValueError(msg)
         self.instructions.append(instruction)
 
+    @enforce_phase(phase.ADD_INSTRUCTIONS)
+    def add_instructions(self, instructions):
+        """Add a number of instructions of the same class at once, as for
+        add_instruction()"""
+        if self.shot.frozen:
+            msg = "Cannot add instructions to a frozen shot. Use shot.fork()"
+            raise RuntimeError(msg)
+        if not instructions:
+            return
+        cls = type(instructions[0])
+        if not any(issubclass(cls, allowed) for allowed in self.allowed_instructions):
+            msg = (f"Instruction of type {cls.__name__} "
+                   f"not permitted by {self}")
+            raise TypeError(msg)
+        for instruction in instructions:
+            if type(instruction) is not cls or instruction.parent is not self:
+                msg = "Can only add instructions of the same class and parent at once"
+                raise ValueError(msg)
+        self.instructions.extend(instructions)
+
     def descendant_instructions(self, recurse_into_pseudoclocks=False):
         # When a subclass inherits from both HasInstructions and HasDevices,
         # this method ensures the instances own instructions are returned as well
@@ -256,7 +338,17 @@ class Output(Device, HasInstructions):
     allowed_instructions = [OutputInstruction]
     allowed_devices = [Device]
     def __init__(self, name, parent, connection, **kwargs):
-        super().__init__(name, parent, connection, **kwargs)  
+        super().__init__(name, parent, connection, **kwargs)
+        # Instructions not under a pseudoclock can't be stored in a table, as
+        # their times are not quantised:
+        if self.shot.instruction_storage == 'columnar' and self.pseudoclock is not None:
+            from table import InstructionTable
+            self.instructions = InstructionTable(self)
+
+        # If our ClockLine compacts its ticks, our values at them, run-length
+        # encoded, see ClockLine.compact_ticks():
+        self.run_values = None
+        self.run_lengths = None
 
     # TODO: put these in non-core so that this Output class can be a base
     # class for static outputs too. Or add a DynamicOutput class that these
@@ -265,12 +357,121 @@ class Output(Device, HasInstructions):
 
     def function(self, t, duration, function, samplerate, _inst_depth=1):
         from instructions import Function
-        Function(self, t, duration, function, samplerate, _inst_depth=_inst_depth+1)
+        if self.shot.instruction_storage == 'columnar':
+            self.instructions.append(Function, t, duration, function, samplerate,
+                                     _inst_depth=_inst_depth+1)
+        else:
+            Function(self, t, duration, function, samplerate, _inst_depth=_inst_depth+1)
         return duration
 
     def constant(self, t, value, _inst_depth=1):
         from instructions import Constant
-        Constant(self, t, value, _inst_depth=_inst_depth+1)
+        _check_value(value)
+        if self.shot.instruction_storage == 'columnar':
+            self.instructions.append(Constant, t, 0, value, 0, _inst_depth=_inst_depth+1)
+        else:
+            Constant(self, t, value, _inst_depth=_inst_depth+1)
         return 0
 
+    def functions(self, t, duration, function, samplerate, _inst_depth=1):
+        """Add a Function instruction for each element of the array t, all
+        with the same function. duration and samplerate may be arrays of the
+        same length or single values. Equivalent to calling function() for
+        each, but much faster for many instructions, since the arrays are
+        validated and the instructions added as a whole, and all of them
+        share a single call site for error reporting."""
+        from instructions import Function
+        t, duration, samplerate = _instruction_arrays(t=t, duration=duration,
+                                                      samplerate=samplerate)
+        self._add_bulk(Function, t, duration, [function], np.zeros(len(t), dtype=np.int64),
+                       samplerate, _inst_depth=_inst_depth+1)
+        return duration
+
+    def constants(self, t, values, _inst_depth=1):
+        """Add a Constant instruction for each element of the array t, with
+        the corresponding value in the array values, or the same value for
+        all if values is a single value. Equivalent to calling constant()
+        for each, but much faster, see functions(). The values of the
+        instructions are Python scalars of the type corresponding to the
+        dtype of values, such as int for an integer array."""
+        from instructions import Constant
+        values = np.asarray(values)
+        if values.dtype.kind not in _real_kinds:
+            msg = f"Output values must be real numbers, not of dtype {values.dtype}"
+            raise TypeError(msg)
+        t, _ = _instruction_arrays(t=t, values=values)
+        # Deduplicate the values as given, not as floats, to keep their type:
+        values, function_ids = np.unique(np.broadcast_to(values, t.shape), return_inverse=True)
+        zeros = np.zeros(len(t))
+        self._add_bulk(Constant, t, zeros, values.tolist(), function_ids.reshape(-1), zeros,
+                       _inst_depth=_inst_depth+1)
+        return 0
+
+    def _add_bulk(self, cls, t, duration, functions, function_ids, samplerate, _inst_depth=1):
+        # Capture a single call site and add the instructions in one go:
+        capture = self.shot.traceback_capture
+        profile = self.shot.profile
+        if profile is not None:
+            start = time.perf_counter()
+        call_site = None if capture == 'off' else capture_call_site(_inst_depth)
+        if profile is not None and capture != 'off':
+            profile.add_traceback_capture(time.perf_counter() - start)
+        if self.shot.instruction_storage == 'columnar':
+            self.instructions.extend(cls, t, duration, functions, function_ids, samplerate,
+                                     call_site)
+        else:
+            from instructions import make_instructions
+            if capture == 'full':
+                call_site = format_call_site(call_site)
+            make_instructions(cls, self, t, duration, functions, function_ids, samplerate,
+                              call_site)
+
+
+# NumPy dtype kinds of the values outputs can take: booleans, integers and
+# floats, all of which are evaluated as float64:
+_real_kinds = 'biuf'
+
+
+def _check_value(value):
+    # Raise TypeError unless the value is a real number, and ValueError if it
+    # is not finite, as _instruction_arrays() does for values added in bulk:
+    if isinstance(value, int):
+        return
+    if not isinstance(value, float):
+        array = np.asarray(value)
+        if array.ndim != 0 or array.dtype.kind not in _real_kinds:
+            msg = f"Output values must be real numbers, not {value!r}"
+            raise TypeError(msg)
+    if not np.isfinite(value):
+        raise ValueError(f"Output values must be finite, not {value!r}")
+
+
+def _instruction_arrays(t, **arrays):
+    # Return the time and other arrays of instructions to be added in bulk as
+    # 1D float arrays of the same length, broadcasting single values,
+    # raising ValueError if they are of the wrong shape, or any are
+    # not finite, or any durations or samplerates are negative:
+    t = np.asarray(t, dtype=float)
+    if t.ndim != 1:
+        raise ValueError(f"t must be a 1D array, not one of shape {t.shape}")
+    result = [t]
+    for name, array in arrays.items():
+        array = np.asarray(array, dtype=float)
+        if array.ndim == 0:
+            array = np.full(len(t), array)
+        elif array.shape != t.shape:
+            msg = f"{name} has shape {array.shape}, but t has shape {t.shape}"
+            raise ValueError(msg)
+        result.append(array)
+    for name, array in zip(['t'] + list(arrays), result):
+        invalid = ~np.isfinite(array)
+        if name in ('duration', 'samplerate'):
+            invalid |= array < 0
+        if invalid.any():
+            i = np.flatnonzero(invalid)[0]
+            msg = (f"{np.count_nonzero(invalid)} invalid elements of {name}, "
+                   f"the first being {name}[{i}] = {array[i]}")
+            raise ValueError(msg)
+    return result
+
 
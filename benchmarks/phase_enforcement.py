@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Microbenchmark of the per-call overhead of @enforce_phase in each of the
+per-shot phase enforcement modes, compared to an undecorated method. Run as:
+
+    python benchmarks/phase_enforcement.py [number_of_calls]
+"""
+
+import sys
+import os
+import timeit
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+
+import core
+from enforce_phase import enforce_phase, PHASE_ENFORCEMENT_MODES
+
+
+class Probe(core.StaticDevice):
+    """A device with a decorated and an undecorated method that do nothing"""
+
+    @enforce_phase(core.phase.ADD_INSTRUCTIONS)
+    def decorated(self):
+        pass
+
+    def undecorated(self):
+        pass
+
+
+def make_shot(mode):
+    shot = core.Shot('<shot>', 100e-9, phase_enforcement=mode, traceback_capture='off')
+    probe = Probe('probe', shot, None)
+    pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+    pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                          clock_minimum_period=1, wait_delay=0.5, timebase=0.1)
+    clockline = core.ClockLine('clockline', pulseblaster_clock, 'flag 1')
+    ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                   clock_minimum_trigger=0.1, clock_minimum_period=1.2)
+    ao = core.Output('ao', ni_card, 'ao0')
+    shot.start()
+    return probe, ao
+
+
+def main(number=200000):
+    probe, _ = make_shot('full')
+    baseline = min(timeit.repeat(lambda: probe.undecorated(), number=number, repeat=5)) / number
+    print(f"{'undecorated':>12}: {1e9 * baseline:7.1f} ns per call")
+    for mode in PHASE_ENFORCEMENT_MODES:
+        probe, ao = make_shot(mode)
+        # Look the method up on each call, as ordinary method calls do:
+        per_call = min(timeit.repeat(lambda: probe.decorated(), number=number,
+                                     repeat=5)) / number
+        per_constant = min(timeit.repeat(lambda: ao.constant(0, 0), number=number // 10,
+                                         repeat=3)) / (number // 10)
+        print(f"{mode:>12}: {1e9 * per_call:7.1f} ns per call "
+              f"({1e9 * (per_call - baseline):+7.1f} ns overhead), "
+              f"{1e6 * per_constant:6.2f} us per Output.constant()")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
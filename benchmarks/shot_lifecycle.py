@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark of each phase of the lifecycle of a shot, on synthetic device
+hierarchies of a given size, timing device construction, start(), adding
+instructions, and each phase of stop() separately, and measuring the peak
+memory use of each. Each size parameter accepts several values, and every
+combination of them is run. Run as, for example:
+
+    python benchmarks/shot_lifecycle.py --instructions 100 1000 10000 --json out.json
+
+and compare with the results of another commit with:
+
+    python benchmarks/shot_lifecycle.py --instructions 100 1000 10000 --compare out.json
+
+which prints the ratio of each phase's time to that in out.json, and exits
+with status 1 if any is slower by more than the threshold.
+"""
+
+import sys
+import os
+import gc
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+import tracemalloc
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+
+import numpy as np
+
+import core
+
+# Format version of the JSON results:
+RESULTS_VERSION = 1
+
+SIZES = ['pseudoclocks', 'clocklines', 'devices', 'outputs', 'instructions', 'waits']
+
+# Phases in the order they occur, with those of stop() named after the phase
+# the shot is in:
+PHASES = ['construction', 'start', 'instructions', 'convert_timing',
+          'check_instructions_valid', 'evaluate_functions', 'generate_clock_ticks']
+
+
+def make_devices(shot, pseudoclocks, clocklines, devices, outputs):
+    """Add a synthetic device hierarchy to a shot: a master pseudoclock and
+    pseudoclocks - 1 secondary ones, each triggered by a Trigger on the
+    first device of the master pseudoclock, each with the given number of
+    clocklines, each clocking the given number of devices, each with the
+    given number of analog outputs. Return the list of analog outputs."""
+    analog_outputs = []
+    triggered = None
+    for i in range(pseudoclocks):
+        parent = shot if triggered is None else triggered.pop()
+        pseudoclock_device = core.PseudoclockDevice(f'pseudoclock_device{i}', parent, None,
+                                                    minimum_trigger=0.1)
+        pseudoclock = core.Pseudoclock(f'pseudoclock{i}', pseudoclock_device, 'clock',
+                                       clock_minimum_period=0.05, wait_delay=0.5,
+                                       timebase=0.01)
+        for j in range(clocklines):
+            clockline = core.ClockLine(f'clockline{i}_{j}', pseudoclock, f'flag {j}')
+            for k in range(devices):
+                device = core.ClockableDevice(f'device{i}_{j}_{k}', clockline, 'clock',
+                                              clock_minimum_trigger=0.1,
+                                              clock_minimum_period=0.1)
+                for m in range(outputs):
+                    analog_outputs.append(core.Output(f'ao{i}_{j}_{k}_{m}', device, f'ao{m}'))
+                if triggered is None:
+                    triggered = [core.Trigger(f'trigger{n}', device, f'do{n}')
+                                 for n in range(1, pseudoclocks)]
+    return analog_outputs
+
+
+def add_instructions(shot, analog_outputs, instructions, waits):
+    """Give each output the given number of instructions, one per second,
+    alternately Constants and half-second ramps sampled every 0.1s, and add
+    waits spread evenly between them. Return the stop time."""
+    for n in range(waits):
+        k = (n + 1) * instructions // (waits + 1)
+        shot.wait(t=k + 0.75, name=f'wait{n}')
+    ramp = np.sin
+    for output in analog_outputs:
+        for k in range(instructions):
+            if k % 2:
+                output.function(t=k, duration=0.5, function=ramp, samplerate=10)
+            else:
+                output.constant(t=k, value=k)
+    return instructions + 1
+
+
+def run(params, storage, timeline, trace_memory=False):
+    """Create, fill and stop one shot of the given size, returning a dict of
+    the wall time of each phase, or if trace_memory is True, the peak
+    memory allocated during each phase above that at its start, as traced
+    by tracemalloc, which slows everything down."""
+    results = {}
+    last = [None, None]
+
+    def begin(name):
+        if last[0] is not None:
+            if trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                results[last[0]] = peak - last[1]
+            else:
+                results[last[0]] = time.perf_counter() - last[1]
+        if name is not None:
+            if trace_memory:
+                tracemalloc.reset_peak()
+                last[:] = [name, tracemalloc.get_traced_memory()[0]]
+            else:
+                last[:] = [name, time.perf_counter()]
+
+    gc.collect()
+    begin('construction')
+    shot = core.Shot('<shot>', 100e-9, instruction_storage=storage, timeline=timeline)
+    analog_outputs = make_devices(shot, params['pseudoclocks'], params['clocklines'],
+                                  params['devices'], params['outputs'])
+    begin('start')
+    shot.start()
+    begin('instructions')
+    stop_time = add_instructions(shot, analog_outputs, params['instructions'],
+                                 params['waits'])
+
+    # Time the phases of stop() by the shot's phase transitions:
+    set_phase = shot._set_phase
+
+    def _set_phase(phase):
+        begin(phase.name.lower())
+        set_phase(phase)
+
+    shot._set_phase = _set_phase
+    shot.stop(stop_time)
+    begin(None)
+    return results
+
+
+def benchmark(params, storage, timeline, repeat):
+    """Run one configuration repeat times, and once more tracing memory,
+    and return its results"""
+    times = [run(params, storage, timeline) for _ in range(repeat)]
+    tracemalloc.start()
+    try:
+        peak_memory = run(params, storage, timeline, trace_memory=True)
+    finally:
+        tracemalloc.stop()
+    phases = {}
+    for name in PHASES:
+        samples = [result[name] for result in times]
+        phases[name] = {'times': samples, 'min': min(samples),
+                        'median': float(np.median(samples)), 'peak_bytes': peak_memory[name]}
+    return {'params': dict(params, storage=storage, timeline=timeline), 'phases': phases,
+            'total': min(sum(result.values()) for result in times)}
+
+
+def metadata():
+    """Return a dict describing what was benchmarked, and on what"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=parent_dir,
+                                         stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def describe(params):
+    return ' '.join(f'{name}={params[name]}' for name in SIZES + ['storage', 'timeline'])
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of the minimum time of each phase to that of the same
+    configuration in baseline, and return whether any exceeds threshold"""
+    baseline = {describe(result['params']): result for result in baseline['results']}
+    regressed = False
+    for result in results:
+        key = describe(result['params'])
+        if key not in baseline:
+            print(f"{key}: not in baseline")
+            continue
+        print(key)
+        for name in PHASES:
+            old = baseline[key]['phases'][name]['min']
+            new = result['phases'][name]['min']
+            ratio = new / old if old else float('inf')
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print(f"  {name:>24}: {1e3 * old:9.2f} ms -> {1e3 * new:9.2f} ms "
+                  f"({ratio:5.2f}x){flag}")
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    defaults = {'pseudoclocks': [2], 'clocklines': [2], 'devices': [2], 'outputs': [4],
+                'instructions': [100, 1000], 'waits': [2]}
+    for name in SIZES:
+        parser.add_argument(f'--{name}', type=int, nargs='+', default=defaults[name])
+    parser.add_argument('--storage', nargs='+', default=['objects', 'columnar'],
+                        choices=['objects', 'columnar'])
+    parser.add_argument('--timeline', nargs='+', default=['float'], choices=['float', 'integer'])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs of each configuration")
+    parser.add_argument('--json', help="file to write the results to")
+    parser.add_argument('--compare', help="results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help="ratio of times above which --compare reports a regression")
+    args = parser.parse_args(argv)
+
+    results = []
+    for sizes in itertools.product(*(getattr(args, name) for name in SIZES)):
+        for storage, timeline in itertools.product(args.storage, args.timeline):
+            params = dict(zip(SIZES, sizes))
+            result = benchmark(params, storage, timeline, args.repeat)
+            results.append(result)
+            print(describe(result['params']))
+            for name in PHASES:
+                phase = result['phases'][name]
+                print(f"  {name:>24}: {1e3 * phase['min']:9.2f} ms, "
+                      f"peak {phase['peak_bytes'] / 2**20:8.2f} MiB")
+            print(f"  {'total':>24}: {1e3 * result['total']:9.2f} ms")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'metadata': metadata(),
+                       'results': results}, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import textwrap
+
+import numpy as np
+
+from table import InstructionColumns
+from evaluation import sample_timepoints, iter_timepoints
+from clocking import unique_ticks, merge_ticks, spacing_violations
+import timing
+
+
+__all__ = ['InvalidInstructionsError', 'output_violations', 'clockline_violations']
+
+
+class InvalidInstructionsError(ValueError):
+    """Exception listing all the invalid instructions found during
+    phase.CHECK_INSTRUCTIONS_VALID, along with the traceback of the user code
+    that created each one. self.violations is a list of all (instruction,
+    message) pairs, of which only the first few are included in the
+    exception message."""
+    def __init__(self, violations, max_reported=10):
+        self.violations = violations
+        self.max_reported = max_reported
+        lines = [f"{len(violations)} invalid instructions:"]
+        for instruction, message in violations[:max_reported]:
+            lines.append(f"{instruction}: {message}")
+            if instruction.traceback is not None:
+                lines.append(textwrap.indent(instruction.traceback, '    '))
+        if len(violations) > max_reported:
+            lines.append(f"and {len(violations) - max_reported} more")
+        super().__init__('\n'.join(lines))
+
+    def __reduce__(self):
+        # So that the exception can be pickled, for example to return it
+        # from another process:
+        return self.__class__, (self.violations, self.max_reported)
+
+
+def output_violations(output, wait_times):
+    """Find the invalid instructions of an Output in one sweep over them in
+    order of time, after their timing has been converted. Return a list of
+    (instruction, message) pairs for instructions at the same time as
+    another, Functions starting before an earlier Function on the same
+    output ends, and Functions that are still running at the time of a
+    wait. If the shot has timeline='integer', wait_times must be integer
+    times. All times compared are quantised."""
+    integer = output.shot.timeline == 'integer'
+    columns = InstructionColumns([output], ['duration', 'segment', 'quantised_t',
+                                            'quantised_duration'])
+    if not len(columns):
+        return []
+    segment = columns.columns['segment']
+    start = columns.columns['quantised_t']
+    end = start + columns.columns['quantised_duration']
+
+    # Whether Functions are still running when the next wait occurs,
+    # comparing quantised times relative to the start of their segment, so
+    # that rounding errors in the times given do not make a Function ending
+    # at the time of a wait appear to end after it:
+    pseudoclock = output.pseudoclock
+    wait_ends = timing.quantise_wait_times(wait_times, pseudoclock.timebase,
+                                           pseudoclock.integer_timebase if integer else None)
+    next_wait = np.append(wait_ends, np.iinfo(np.int64).max)[segment]
+    straddling = (columns.columns['duration'] > 0) & (end > next_wait)
+
+    order = np.lexsort((start, segment))
+    segment, start, end = segment[order], start[order], end[order]
+    same_segment = np.diff(segment) == 0
+    same_time = same_segment & (np.diff(start) == 0)
+
+    # Offset the times of each segment so that they are all later than those
+    # of the previous segment, then the latest end time of all instructions
+    # before each one is a running maximum:
+    minimum = start.min()
+    stride = int(max(end.max(), start.max())) - int(minimum) + 1
+    latest_end = np.maximum.accumulate(segment * stride + (end - minimum))
+    overlapping = (segment[1:] * stride + (start[1:] - minimum)) < latest_end[:-1]
+    overlapping &= ~same_time
+
+    violations = []
+    for row in order[1:][same_time]:
+        violations.append((columns.instruction(row),
+                           "instruction at the same time as another on the same output"))
+    for row in order[1:][overlapping]:
+        violations.append((columns.instruction(row),
+                           "instruction starts before a previous Function on the same "
+                           "output has finished"))
+    for row in np.flatnonzero(straddling):
+        wait_t = wait_times[columns.columns['segment'][row]]
+        if integer:
+            wait_t = wait_t * output.shot.epsilon
+        violations.append((columns.instruction(row),
+                           f"Function is still running at the time of the wait at "
+                           f"t={wait_t}"))
+    return violations
+
+
+def _streamed_too_close(columns, minimum_period, chunk_size):
+    # The rows of instructions with a clock tick too soon after a clock tick
+    # of another instruction, found by merging streams of the timepoints of
+    # each output's instructions in chunks of at most chunk_size, rather than
+    # computing all the timepoints at once. Each output's instructions must
+    # not overlap, so that their timepoints are in order.
+    owners = [instruction.parent for instruction in columns.objects]
+    for table, rows in columns.table_slices():
+        owners.extend([table.parent] * len(table))
+    owner_ids = {}
+    owners = np.array([owner_ids.setdefault(owner, len(owner_ids)) for owner in owners],
+                      dtype=np.int64)
+    segment = columns.columns['segment']
+    quantised_t = columns.columns['quantised_t']
+
+    def stream(owner):
+        rows = np.flatnonzero(owners == owner)
+        rows = rows[np.lexsort((quantised_t[rows], segment[rows]))]
+        for local_rows, timepoints in iter_timepoints(
+                quantised_t[rows], columns.columns['quantised_duration'][rows],
+                columns.columns['quantised_sample_period'][rows], chunk_size):
+            yield segment[rows[local_rows]], timepoints, rows[local_rows]
+
+    too_close = []
+    previous = None
+    for segments, ticks, rows in merge_ticks([stream(owner) for owner in range(len(owner_ids))]):
+        if previous is not None:
+            segments, ticks = np.append(previous[0], segments), np.append(previous[1], ticks)
+            rows = np.append(previous[2], rows)
+        too_close.append(rows[spacing_violations(segments, ticks, minimum_period) + 1])
+        previous = segments[-1], ticks[-1], rows[-1]
+    return np.concatenate([np.zeros(0, dtype=np.int64)] + too_close)
+
+
+def clockline_violations(clockline, outputs, chunk_size=None):
+    """Find the instructions of the given Outputs, all clocked by the given
+    ClockLine, which would require clock ticks closer together than the
+    clockline's minimum period, after their timing has been converted.
+    Return a list of (instruction, message) pairs for Functions whose sample
+    rate is too high, and for instructions with a clock tick too soon after
+    a clock tick of another instruction. If chunk_size is given, the clock
+    ticks are generated in chunks of at most that many, which requires that
+    the instructions of each output do not overlap."""
+    columns = InstructionColumns(outputs, ['samplerate', 'segment', 'quantised_t',
+                                           'quantised_duration', 'quantised_sample_period'])
+    if not len(columns):
+        return []
+    minimum_period = clockline.quantised_clock_minimum_period
+    sample_period = columns.columns['quantised_sample_period']
+    duration = columns.columns['quantised_duration']
+    too_fast = (columns.columns['samplerate'] > 0) & (duration > 0)
+    too_fast &= sample_period < minimum_period
+
+    if chunk_size is None:
+        # The clock ticks each instruction requires:
+        timepoints, offsets = sample_timepoints(columns.columns['quantised_t'], duration,
+                                                sample_period)
+        n_samples = np.diff(offsets)
+        sample_rows = np.repeat(np.arange(len(columns)), n_samples)
+        segments = np.repeat(columns.columns['segment'], n_samples)
+        tick_segments, ticks, inverse = unique_ticks(segments, timepoints)
+        # An instruction requiring each tick:
+        tick_rows = np.empty(len(ticks), dtype=np.int64)
+        tick_rows[inverse] = sample_rows
+        too_close = tick_rows[spacing_violations(tick_segments, ticks, minimum_period) + 1]
+    else:
+        too_close = _streamed_too_close(columns, minimum_period, chunk_size)
+    # Don't also report Functions already reported for their sample rate:
+    too_close = np.unique(too_close[~too_fast[too_close]])
+
+    violations = []
+    period = minimum_period * clockline.timebase
+    for row in np.flatnonzero(too_fast):
+        violations.append((columns.instruction(row),
+                           f"sample rate exceeds the maximum clock rate {1 / period:.9g} "
+                           f"of clockline {clockline.name}"))
+    for row in too_close:
+        violations.append((columns.instruction(row),
+                           f"requires a clock tick less than the minimum period {period:.9g} "
+                           f"of clockline {clockline.name} after another"))
+    return violations
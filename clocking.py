@@ -0,0 +1,249 @@
+import numpy as np
+
+
+__all__ = ['unique_ticks', 'merge_ticks', 'output_ticks', 'output_samples', 'held_values',
+           'compact_ticks', 'compaction_stats', 'run_length_encode', 'spacing_violations',
+           'check_spacing', 'iter_check_spacing']
+
+
+def _first_of_runs(sorted_values):
+    # Boolean mask of the elements of a sorted array that differ from their
+    # predecessor:
+    new = np.empty(len(sorted_values), dtype=bool)
+    new[:1] = True
+    np.not_equal(sorted_values[1:], sorted_values[:-1], out=new[1:])
+    return new
+
+
+def unique_ticks(segments, ticks, return_inverse=True):
+    """Return the distinct (segment, tick) pairs of the given integer arrays,
+    sorted by segment then tick, as two arrays, along with an array giving,
+    for each input pair, the index of the corresponding output pair, or None
+    if return_inverse is False, which is faster. Equivalent to np.unique()
+    on the pairs, but sorts explicitly, which is much faster than
+    np.unique() on large integer arrays."""
+    segments = np.asarray(segments, dtype=np.int64)
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if not len(ticks):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty if return_inverse else None
+    # Combine each pair into a single integer so that they can be sorted in
+    # one pass, unless the range of values is too large to do so:
+    min_tick = ticks.min()
+    stride = int(ticks.max()) - int(min_tick) + 1
+    if (int(segments.max()) + 1) * stride < 2**62:
+        keys = segments * stride + (ticks - min_tick)
+        if return_inverse:
+            order = np.argsort(keys)
+            sorted_keys = keys[order]
+        else:
+            sorted_keys = np.sort(keys)
+        new = _first_of_runs(sorted_keys)
+        unique_segments, offset_ticks = np.divmod(sorted_keys[new], stride)
+        distinct_ticks = offset_ticks + min_tick
+    else:
+        order = np.lexsort((ticks, segments))
+        sorted_segments = segments[order]
+        sorted_ticks = ticks[order]
+        new = _first_of_runs(sorted_ticks)
+        new[1:] |= sorted_segments[1:] != sorted_segments[:-1]
+        unique_segments, distinct_ticks = sorted_segments[new], sorted_ticks[new]
+    inverse = None
+    if return_inverse:
+        inverse = np.empty(len(ticks), dtype=np.int64)
+        inverse[order] = np.cumsum(new) - 1
+    return unique_segments, distinct_ticks, inverse
+
+
+def _count_up_to(segments, ticks, segment, tick):
+    # The number of (segment, tick) pairs in the given sorted arrays that
+    # are no later than the given pair:
+    start = np.searchsorted(segments, segment, side='left')
+    stop = np.searchsorted(segments, segment, side='right')
+    return start + np.searchsorted(ticks[start:stop], tick, side='right')
+
+
+def merge_ticks(streams):
+    """Merge a number of streams of chunks of clock ticks into a single
+    stream of chunks of distinct clock ticks, as a generator. Each stream is
+    an iterable of tuples of arrays (segments, ticks, *others), sorted by
+    segment then tick over all its chunks. Yields tuples of the same form,
+    with each distinct (segment, tick) pair once, sorted over all chunks,
+    and the other arrays taken from its first occurrence in the order of the
+    streams. Only as much of each stream is read as is needed to know which
+    ticks come next, so that the ticks are never all in memory at once."""
+    iterators = [iter(stream) for stream in streams]
+    buffers = [None] * len(iterators)
+    while True:
+        # Read from each stream that has run out of buffered ticks:
+        for i, iterator in enumerate(iterators):
+            while iterator is not None and (buffers[i] is None or not len(buffers[i][0])):
+                try:
+                    buffers[i] = next(iterator)
+                except StopIteration:
+                    iterator = iterators[i] = None
+        active = [i for i, buffer in enumerate(buffers)
+                  if buffer is not None and len(buffer[0])]
+        if not active:
+            return
+        # All ticks up to the earliest last buffered tick of the streams that
+        # may have more to come can be merged now:
+        unfinished = [i for i in active if iterators[i] is not None]
+        parts = []
+        if unfinished:
+            bound = min((buffers[i][0][-1], buffers[i][1][-1]) for i in unfinished)
+        for i in active:
+            n = len(buffers[i][0]) if not unfinished else _count_up_to(*buffers[i][:2], *bound)
+            parts.append(tuple(array[:n] for array in buffers[i]))
+            buffers[i] = tuple(array[n:] for array in buffers[i])
+        merged = [np.concatenate(arrays) for arrays in zip(*parts)]
+        # A stable sort, so that the first of each run of equal ticks is its
+        # first occurrence:
+        order = np.lexsort((merged[1], merged[0]))
+        segments, ticks = merged[0][order], merged[1][order]
+        new = _first_of_runs(ticks)
+        new[1:] |= segments[1:] != segments[:-1]
+        yield tuple(array[order][new] for array in merged)
+
+
+def _iter_samples(output):
+    # Yield (segments, timepoints, values) of each evaluated instruction of
+    # an output, or of all of them at once if stored in an InstructionTable:
+    from table import InstructionTable
+    instructions = output.instructions
+    if isinstance(instructions, InstructionTable):
+        if instructions.value_offsets is not None:
+            n_samples = np.diff(instructions.value_offsets)
+            yield (np.repeat(instructions.column('segment'), n_samples),
+                   instructions.evaluation_timepoints, instructions.values)
+    else:
+        for instruction in instructions:
+            timepoints = getattr(instruction, 'evaluation_timepoints', None)
+            if timepoints is not None:
+                yield (np.full(len(timepoints), instruction.segment, dtype=np.int64),
+                       timepoints, instruction.values)
+
+
+def output_ticks(outputs):
+    """Return the segments and quantised times of all the evaluation
+    timepoints of the given outputs' instructions, which must have been
+    evaluated, as two concatenated arrays. These are the times at which the
+    outputs need clock ticks."""
+    segments = []
+    ticks = []
+    for output in outputs:
+        for output_segments, timepoints, _ in _iter_samples(output):
+            segments.append(output_segments)
+            ticks.append(timepoints)
+    if not ticks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(segments), np.concatenate(ticks)
+
+
+def output_samples(outputs):
+    """As output_ticks(), but also return the value of each sample as a
+    third array, and a list of the number of samples of each output, whose
+    samples are concatenated in the order of the outputs"""
+    empty = np.zeros(0, dtype=np.int64)
+    segments = [empty]
+    ticks = [empty]
+    values = [np.zeros(0, dtype=float)]
+    counts = []
+    for output in outputs:
+        count = 0
+        for output_segments, timepoints, output_values in _iter_samples(output):
+            segments.append(output_segments)
+            ticks.append(timepoints)
+            values.append(output_values)
+            count += len(timepoints)
+        counts.append(count)
+    return np.concatenate(segments), np.concatenate(ticks), np.concatenate(values), counts
+
+
+def held_values(n_ticks, indices, values):
+    """Return the value of an output at each of n_ticks clock ticks, given
+    the indices of the ticks at which it has samples and their values. At
+    ticks without a sample, an output holds the value of its most recent
+    sample, or before its first sample, the value of its first sample, as
+    that is what it is initially programmed to output."""
+    set_at = np.full(n_ticks, -1, dtype=np.int64)
+    set_at[indices] = indices
+    np.maximum.accumulate(set_at, out=set_at)
+    set_at[set_at < 0] = indices.min()
+    at_ticks = np.empty(n_ticks, dtype=values.dtype)
+    at_ticks[indices] = values
+    return at_ticks[set_at]
+
+
+def compact_ticks(tick_segments, held):
+    """Return a boolean mask of the given sorted unique clock ticks of a
+    ClockLine that are needed, given the held values of each of its outputs
+    at each tick as returned by held_values(): those at which the value of
+    any output changes, and the first tick of each segment. The others can
+    be dropped, since every output holds its value through them. Dropping
+    ticks only lengthens the intervals between the remaining ones, so these
+    are no closer together than the ClockLine's minimum period if all the
+    ticks were."""
+    keep = _first_of_runs(tick_segments)
+    for values in held:
+        keep[1:] |= values[1:] != values[:-1]
+    return keep
+
+
+def compaction_stats(ticks, compacted_ticks, values, runs):
+    """Return a dict of statistics of the compaction of a ClockLine's ticks,
+    given the number of ticks before and after, the total number of values
+    of its Outputs at its ticks before, and the total number of runs of
+    values after, plus the ratio of values to runs"""
+    return {'ticks': ticks, 'compacted_ticks': compacted_ticks, 'values': values,
+            'runs': runs, 'ratio': values / runs if runs else 1.0}
+
+
+def run_length_encode(values):
+    """Return the distinct values of each run of equal consecutive values
+    of an array and the length of each run, as two arrays"""
+    starts = np.flatnonzero(_first_of_runs(values))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+
+def spacing_violations(segments, ticks, minimum_period):
+    """Given sorted unique ticks as returned by unique_ticks(), return the
+    indices i for which ticks i and i+1 are in the same segment but less
+    than minimum_period apart"""
+    too_close = np.diff(ticks) < minimum_period
+    too_close &= np.diff(segments) == 0
+    return np.flatnonzero(too_close)
+
+
+def check_spacing(device, segments, ticks, minimum_period, max_reported=5):
+    """Raise ValueError describing the first few ticks of the given device
+    (a ClockLine or Pseudoclock) that are closer together than its minimum
+    period, if any"""
+    violations = spacing_violations(segments, ticks, minimum_period)
+    if not len(violations):
+        return
+    timebase = device.timebase
+    lines = [f"{len(violations)} clock ticks of {device.name} are closer than its minimum "
+             f"period of {minimum_period * timebase:.9g} (times relative to the start of "
+             f"each segment):"]
+    for i in violations[:max_reported]:
+        lines.append(f"    segment {segments[i]}: t={ticks[i] * timebase:.9g} and "
+                     f"t={ticks[i + 1] * timebase:.9g}")
+    raise ValueError('\n'.join(lines))
+
+
+def iter_check_spacing(device, chunks, minimum_period):
+    """Generator passing through a stream of chunks of sorted unique ticks
+    as yielded by merge_ticks(), checking them as for check_spacing(),
+    including across the boundaries between chunks"""
+    previous = None
+    for chunk in chunks:
+        segments, ticks = chunk[:2]
+        if previous is None:
+            check_spacing(device, segments, ticks, minimum_period)
+        else:
+            check_spacing(device, np.append(previous[0], segments),
+                          np.append(previous[1], ticks), minimum_period)
+        if len(ticks):
+            previous = segments[-1], ticks[-1]
+        yield chunk
@@ -1,5 +1,7 @@
 import numpy as np
 
+from enforce_phase import phase, PhaseError, WrongPhaseError, AlreadyCalledError, NotCalledError
+
 from bases import Instruction, Device, Output
 
 from instructions import Wait, OutputInstruction, Function, Constant, Static
@@ -9,6 +11,8 @@ from devices import (StaticDevice, StaticOutput, TriggerableDevice, Trigger, Clo
 
 from shot import Shot
 
+from checks import InvalidInstructionsError
+
 
 if __name__ == '__main__':
     import time
@@ -23,7 +27,7 @@ if __name__ == '__main__':
     shot.start()
     shot.wait(t=7, name='first_wait')
     ao.constant(t=0, value=7)
-    ao.function(t=0, duration=7, function=np.sin, samplerate=20)
+    ao.function(t=2, duration=4, function=np.sin, samplerate=0.5)
 
     shot.stop(1)
 
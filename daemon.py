@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import importlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sweep import shot_arrays
+
+
+__all__ = ['CompileDaemon', 'CompileClient', 'CompileError']
+
+
+# Protocol spoken over the daemon's Unix socket. Every message is a frame: a
+# little-endian uint64 length followed by that many bytes of JSON in UTF-8.
+# A client sends a request frame of the form:
+#
+#     {"template": str, "script": str, "stop_time": float,
+#      "name": str or null, "variables": {str: value}, "chunk_size": int or null,
+#      "compact": bool}
+#
+# and the daemon replies with zero or more array frames of the form
+# {"array": str, "dtype": str, "length": int}, each followed immediately by
+# the raw bytes of the array, then a final frame that is either
+# {"done": true, "stats": {str: float}} or
+# {"error": str, "message": str, "traceback": str}, which is also the reply
+# to a request that is not valid JSON or lacks a required key. Arrays of the
+# same name may be sent in several chunks, to be concatenated in the order
+# received.
+# Any number of requests may be sent one after another on a connection.
+_length = struct.Struct('<Q')
+
+
+def _frame(message):
+    data = json.dumps(message).encode('utf8')
+    return _length.pack(len(data)) + data
+
+
+class CompileError(RuntimeError):
+    """An exception raised by compiling a shot in a CompileDaemon, re-raised
+    in the client. The type and traceback of the original exception are
+    available as the type_name and remote_traceback attributes."""
+    def __init__(self, type_name, message, remote_traceback):
+        super().__init__(f"{type_name}: {message}")
+        self.type_name = type_name
+        self.remote_traceback = remote_traceback
+
+
+class _Sink(object):
+    # Passed as the sink of Shot.stop() in a worker thread, sending each
+    # chunk to the client from the event loop, and waiting until it has been
+    # written so that a slow client holds up compilation rather than chunks
+    # accumulating in memory:
+    def __init__(self, daemon, writer):
+        self.daemon = daemon
+        self.writer = writer
+
+    def append(self, device, name, array):
+        self.append_array(f'{device.name}/{name}', array)
+
+    def append_array(self, name, array):
+        self.append_arrays({name: array})
+
+    def append_arrays(self, arrays):
+        coroutine = self.daemon._send_arrays(self.writer, arrays)
+        asyncio.run_coroutine_threadsafe(coroutine, self.daemon.loop).result()
+
+
+class CompileDaemon(object):
+    """A server that compiles shots on request, listening on a Unix socket,
+    for avoiding the cost of starting Python, importing NumPy and this
+    package, and constructing and starting the device hierarchy for every
+    shot. templates is a dict of started shots, each of which is frozen if
+    it is not already and kept for as long as the daemon runs. Each request
+    names a template and gives the source of a script that adds
+    instructions to a shot forked from it, and the shot is then stopped at
+    the requested time and its results streamed back to the client, so the
+    time taken per shot is only that of adding and processing instructions.
+
+    The script is run with the shot as the variable shot, each of its
+    devices as a variable of the same name, np as NumPy, and any variables
+    given with the request. Scripts are trusted code: anyone able to connect
+    to the socket can run arbitrary code as the daemon's user, so the socket
+    is created accessible only to that user.
+
+    Connections are handled by an asyncio event loop, and shots are compiled
+    in a pool of max_workers threads, which share the templates, see the
+    threading notes of Shot. If ramp_cache, an evaluation.RampCache, or
+    cache, a shotcache.ShotCache, are given, they are used by all shots
+    compiled without chunking. Results are
+    as returned by sweep.shot_arrays(), or if the request gives a
+    chunk_size, the chunks passed to the sink of Shot.stop(), sent as they
+    are generated. See CompileClient for making requests.
+
+    serve() runs the daemon in the current event loop until shutdown() is
+    called, which may be done from any thread. run() does so in a new event
+    loop. A socket left at the path by a daemon that exited without shutting
+    down is replaced, but FileExistsError is raised if the path is anything
+    else, or another daemon is listening on it. The started attribute is a
+    threading.Event that is set once the daemon is listening."""
+
+    def __init__(self, path, templates, max_workers=None, ramp_cache=None, cache=None):
+        self.path = os.path.abspath(path)
+        for template in templates.values():
+            if not template.frozen:
+                template.freeze()
+        self.templates = dict(templates)
+        self.max_workers = max_workers
+        self.ramp_cache = ramp_cache
+        self.cache = cache
+        self.loop = None
+        self.started = threading.Event()
+        self._stopping = None
+        # The writer of each open connection, by the task handling it:
+        self._connections = {}
+
+    def run(self):
+        """Serve in a new event loop until shutdown() is called"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Serve in the current event loop until shutdown() is called"""
+        self.loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._remove_stale_socket()
+        pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix='compile')
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(
+                lambda reader, writer: self._handle(reader, writer, pool), self.path)
+        finally:
+            os.umask(umask)
+        try:
+            async with server:
+                self.started.set()
+                await self._stopping.wait()
+                # Close connections, letting their handlers finish any shots
+                # they are compiling:
+                for writer in self._connections.values():
+                    writer.close()
+                await asyncio.gather(*self._connections)
+        finally:
+            pool.shutdown(wait=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.started.clear()
+
+    def _remove_stale_socket(self):
+        # Remove a socket left at self.path by a daemon that did not shut
+        # down cleanly, so that it can be listened on again. Raise
+        # FileExistsError if the path is anything other than a socket, or if
+        # something is still listening on it:
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            msg = f"{self.path} exists and is not a socket"
+            raise FileExistsError(msg)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+                return
+        msg = f"Another server is already listening on {self.path}"
+        raise FileExistsError(msg)
+
+    def shutdown(self):
+        """Stop serving. Shots being compiled are finished first."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _handle(self, reader, writer, pool):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_length.size)
+                except asyncio.IncompleteReadError:
+                    break
+                (length,) = _length.unpack(header)
+                data = await reader.readexactly(length)
+                sink = _Sink(self, writer)
+                try:
+                    request = self._decode(data)
+                    stats = await self.loop.run_in_executor(pool, self._compile, request, sink)
+                except Exception as e:
+                    writer.write(_frame({'error': e.__class__.__name__, 'message': str(e),
+                                         'traceback': traceback.format_exc()}))
+                else:
+                    writer.write(_frame({'done': True, 'stats': stats}))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _send_arrays(self, writer, arrays):
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            writer.write(_frame({'array': name, 'dtype': array.dtype.str,
+                                 'length': len(array)}))
+            writer.write(array.data)
+        await writer.drain()
+
+    @staticmethod
+    def _decode(data):
+        # Decode a request frame, raising ValueError if it is malformed, to
+        # be sent to the client as an error:
+        request = json.loads(data)
+        if not isinstance(request, dict):
+            msg = f"Request must be a JSON object, not {type(request).__name__}"
+            raise ValueError(msg)
+        missing = [key for key in ['template', 'script', 'stop_time'] if key not in request]
+        if missing:
+            msg = f"Request is missing {', '.join(missing)}"
+            raise ValueError(msg)
+        return request
+
+    def _compile(self, request, sink):
+        # Called in a worker thread:
+        start_time = time.perf_counter()
+        try:
+            template = self.templates[request['template']]
+        except KeyError:
+            msg = f"No template named {request['template']!r}"
+            raise ValueError(msg) from None
+        chunk_size = request.get('chunk_size')
+        compact = request.get('compact', False)
+        with template.fork(request.get('name')) as shot:
+            namespace = {device.name: device for device in shot.all_devices}
+            namespace.update(shot=shot, np=np)
+            namespace.update(request.get('variables') or {})
+            fork_time = time.perf_counter()
+            code = compile(request['script'], f"<{request['template']}>", 'exec')
+            exec(code, namespace)
+            script_time = time.perf_counter()
+            if chunk_size is None:
+                shot.stop(request['stop_time'], ramp_cache=self.ramp_cache, cache=self.cache,
+                          compact=compact)
+                stop_time = time.perf_counter()
+                sink.append_arrays(shot_arrays(shot))
+            else:
+                shot.stop(request['stop_time'], chunk_size=chunk_size, sink=sink,
+                          compact=compact)
+                stop_time = time.perf_counter()
+        return {'fork': fork_time - start_time, 'script': script_time - fork_time,
+                'stop': stop_time - script_time,
+                'send': time.perf_counter() - stop_time}
+
+
+class CompileClient(object):
+    """A blocking client of a CompileDaemon listening on the given path.
+    Keeps its connection open for any number of calls to compile() until
+    close() is called, and can be used as a context manager."""
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rb')
+
+    def _read_frame(self):
+        header = self.file.read(_length.size)
+        if len(header) < _length.size:
+            raise ConnectionError("Connection to compile daemon closed")
+        (length,) = _length.unpack(header)
+        return json.loads(self.file.read(length))
+
+    def compile(self, template, script, stop_time, name=None, variables=None,
+                chunk_size=None, compact=False):
+        """Have the daemon compile a shot forked from the named template,
+        with instructions added by the given script source, and stopped at
+        stop_time with the given chunk_size and compact arguments. Return a
+        dict of the resulting arrays by name, as described in CompileDaemon,
+        and set self.stats to the daemon's timings of the compilation in
+        seconds. If compilation raises an
+        exception in the daemon, raise a CompileError."""
+        request = {'template': template, 'script': script, 'stop_time': stop_time,
+                   'name': name, 'variables': variables or {}, 'chunk_size': chunk_size,
+                   'compact': compact}
+        self.socket.sendall(_frame(request))
+        chunks = {}
+        while True:
+            message = self._read_frame()
+            if 'array' in message:
+                dtype = np.dtype(message['dtype'])
+                data = self.file.read(message['length'] * dtype.itemsize)
+                chunks.setdefault(message['array'], []).append(np.frombuffer(data, dtype))
+            elif 'error' in message:
+                raise CompileError(message['error'], message['message'], message['traceback'])
+            else:
+                self.stats = message['stats']
+                return {name: np.concatenate(arrays) for name, arrays in chunks.items()}
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a compile daemon")
+    parser.add_argument('socket', help="path of the Unix socket to listen on")
+    parser.add_argument('templates', help="module:function returning a dict of started "
+                                          "shots to use as templates, by name")
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    module_name, function_name = args.templates.split(':')
+    sys.path.insert(0, os.getcwd())
+    templates = getattr(importlib.import_module(module_name), function_name)()
+    daemon = CompileDaemon(args.socket, templates, args.max_workers)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
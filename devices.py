@@ -1,5 +1,14 @@
-from bases import Device, Output
+import numpy as np
+
+from bases import Device, Output, phase
 from instructions import Static
+from enforce_phase import enforce_phase
+import evaluation
+import clocking
+import checks
+import incremental
+from timing import (quantise_period, quantise_integer_period, integer_timebase,
+                    to_integer_time)
 
 
 class StaticDevice(Device):
@@ -47,13 +56,33 @@ class ClockLine(Device):
 
         self.clock_minimum_period = parent.clock_minimum_period
         self.timebase = parent.timebase
+        self.integer_timebase = None
 
         # To be determined during establish_common_limits:
         self.common_clock_minimum_period = None
+        self.quantised_clock_minimum_period = None
         self.common_clock_minimum_trigger = None
         self.clock_period_limiting_device = None
         self.clock_trigger_limiting_device = None
 
+        # To be determined during generate_ticks: the segment and quantised
+        # time of each clock tick:
+        self.tick_segments = None
+        self.ticks = None
+
+        # When streaming, instead of the above: generators of chunks of the
+        # evaluated samples of each Output, set by evaluate_functions(), and
+        # of chunks of clock ticks, set by generate_ticks() and consumed by
+        # our Pseudoclock's generate_ticks(), and the number of ticks,
+        # counted as they are consumed:
+        self.sample_chunks = None
+        self.tick_chunks = None
+        self.n_ticks = None
+
+        # If generate_ticks() compacts our ticks, statistics of the
+        # compaction, see compact_ticks():
+        self.compaction = None
+
     def establish_common_limits(self):
         super().establish_common_limits()
         # How slow is the slowest ClockableDevice clocked by this ClockLine,
@@ -66,17 +95,24 @@ class ClockLine(Device):
         self.common_clock_minimum_trigger = 0
         self.clock_trigger_limiting_device = None
 
-        for device in self.descendant_devices(recurse_into_pseudoclocks=False):
-            if isinstance(device, ClockableDevice):
-                if device.clock_minimum_period > self.common_clock_minimum_period:
-                    self.common_clock_minimum_period = device.clock_minimum_period
-                    self.clock_period_limiting_device = device
-                if device.clock_minimum_trigger > self.common_clock_minimum_trigger:
-                    self.common_clock_minimum_trigger = device.clock_minimum_trigger
-                    self.clock_trigger_limiting_device = device
+        for device in self.descendant_devices_of_type(ClockableDevice):
+            if device.clock_minimum_period > self.common_clock_minimum_period:
+                self.common_clock_minimum_period = device.clock_minimum_period
+                self.clock_period_limiting_device = device
+            if device.clock_minimum_trigger > self.common_clock_minimum_trigger:
+                self.common_clock_minimum_trigger = device.clock_minimum_trigger
+                self.clock_trigger_limiting_device = device
 
         # Round up to multiple of the timebase:
-        quantised = int(self.common_clock_minimum_period) + 1
+        if self.shot.timeline == 'integer':
+            epsilon = self.shot.epsilon
+            self.integer_timebase = integer_timebase(self.timebase, epsilon, self)
+            quantised = quantise_integer_period(
+                to_integer_time(self.common_clock_minimum_period, epsilon),
+                self.integer_timebase)
+        else:
+            quantised = quantise_period(self.common_clock_minimum_period, self.timebase)
+        self.quantised_clock_minimum_period = quantised
         self.common_clock_minimum_period = quantised * self.timebase
 
         # We don't round self.common_clock_minimum_trigger to anything about
@@ -86,6 +122,146 @@ class ClockLine(Device):
         # cycles are. It's up to the pseudoclock's implementation to produce
         # triggers long enough or to raise an exception.
 
+    @enforce_phase(phase.CHECK_INSTRUCTIONS_VALID, exactly_once=True)
+    def check_instructions_valid(self, wait_times, chunk_size=None):
+        """Check the instructions of all Outputs clocked by this ClockLine,
+        given the sorted times of the shot's waits, and return a list of
+        (instruction, message) pairs for all invalid instructions found. If
+        chunk_size is given, clock ticks are checked in chunks of at most
+        that many, unless some outputs have overlapping instructions."""
+        reuse = self.shot.reuse
+        if self in reuse:
+            # The same instructions were valid in the previous shot:
+            return []
+        outputs = self.descendant_devices_of_type(Output)
+        violations = []
+        for output in outputs:
+            if output not in reuse:
+                violations.extend(checks.output_violations(output, wait_times))
+        if violations:
+            # Timepoints of overlapping instructions are not in order, so
+            # they can't be streamed:
+            chunk_size = None
+        violations.extend(checks.clockline_violations(self, outputs, chunk_size))
+        return violations
+
+    @enforce_phase(phase.EVALUATE_FUNCTIONS, exactly_once=True)
+    def evaluate_functions(self, chunk_size=None, cache=None):
+        """Evaluate the Function and Constant instructions of all Outputs
+        clocked by this ClockLine, together in one batch, looking up ramps
+        in the given evaluation.RampCache if any. If chunk_size is given,
+        instead create a generator for each Output that evaluates its
+        instructions in chunks of at most that many samples when consumed
+        during generate_ticks(), and store nothing on the instructions. The
+        cache is not used in that case."""
+        outputs = self.descendant_devices_of_type(Output)
+        if chunk_size is None:
+            reuse = self.shot.reuse
+            evaluation.evaluate_functions([output for output in outputs if output not in reuse],
+                                          self.timebase, cache)
+            for output in outputs:
+                if output in reuse:
+                    incremental.reuse_values(output, reuse[output])
+        else:
+            self.sample_chunks = {output: evaluation.iter_evaluate(output, self.timebase,
+                                                                   chunk_size)
+                                  for output in outputs}
+
+    @enforce_phase(phase.GENERATE_CLOCK_TICKS, exactly_once=True)
+    def generate_ticks(self, sink=None, compact=False):
+        """Merge the evaluation timepoints of all Outputs clocked by this
+        ClockLine into a sorted sequence of unique clock ticks, and check
+        that they are no closer together than the common minimum period. If
+        evaluate_functions() was called with a chunk size, instead create a
+        generator that does this in chunks, to be consumed by our
+        Pseudoclock's generate_ticks(). As it is consumed, each chunk of
+        samples of each Output and each chunk of our ticks is passed to
+        sink.append(device, name, array) if a sink is given, with the names
+        'segments', 'timepoints' and 'values' for Outputs and
+        'tick_segments' and 'ticks' for ClockLines. If compact is True, ticks
+        at which no Output changes value are dropped, see compact_ticks(),
+        which cannot be done when streaming."""
+        previous = self.shot.reuse.get(self)
+        if previous is not None:
+            self.tick_segments, self.ticks = previous.tick_segments, previous.ticks
+            self.compaction = previous.compaction
+            for output in self.descendant_devices_of_type(Output):
+                previous_output = self.shot.reuse[output]
+                output.run_values = previous_output.run_values
+                output.run_lengths = previous_output.run_lengths
+        elif compact:
+            self.compact_ticks()
+        elif self.sample_chunks is None:
+            segments, ticks = clocking.output_ticks(self.descendant_devices_of_type(Output))
+            self.tick_segments, self.ticks, _ = clocking.unique_ticks(segments, ticks,
+                                                                      return_inverse=False)
+            clocking.check_spacing(self, self.tick_segments, self.ticks,
+                                   self.quantised_clock_minimum_period)
+        else:
+            self.tick_chunks = self._iter_ticks(sink)
+
+    @enforce_phase(phase.GENERATE_CLOCK_TICKS)
+    def compact_ticks(self):
+        """Generate our ticks, keeping only those at which the value of some
+        Output changes and the first of each segment, and run-length encode
+        the values of each Output at the remaining ticks, storing the
+        distinct values of each run in its run_values attribute and the
+        number of ticks each lasts in its run_lengths, so that its values
+        at our ticks are np.repeat(output.run_values, output.run_lengths).
+        Outputs with no instructions have empty runs. Spacing is checked
+        before ticks are dropped, so the same instructions are invalid as
+        without compaction. Statistics are stored in self.compaction: the
+        number of ticks before and after compaction, the total number of
+        values of all Outputs at our ticks before compaction, the total
+        number of runs after it, and the ratio of the two, as returned by
+        clocking.compaction_stats(). Called by generate_ticks()."""
+        outputs = self.descendant_devices_of_type(Output)
+        segments, ticks, values, counts = clocking.output_samples(outputs)
+        tick_segments, ticks, inverse = clocking.unique_ticks(segments, ticks)
+        clocking.check_spacing(self, tick_segments, ticks, self.quantised_clock_minimum_period)
+        held = {}
+        start = 0
+        for output, count in zip(outputs, counts):
+            if count:
+                held[output] = clocking.held_values(len(ticks), inverse[start:start + count],
+                                                    values[start:start + count])
+            start += count
+        keep = clocking.compact_ticks(tick_segments, held.values())
+        self.tick_segments, self.ticks = tick_segments[keep], ticks[keep]
+        n_runs = 0
+        for output in outputs:
+            if output in held:
+                output.run_values, output.run_lengths = clocking.run_length_encode(
+                    held[output][keep])
+            else:
+                output.run_values = np.zeros(0, dtype=float)
+                output.run_lengths = np.zeros(0, dtype=np.int64)
+            n_runs += len(output.run_values)
+        self.compaction = clocking.compaction_stats(len(ticks), len(self.ticks),
+                                                    len(ticks) * len(outputs), n_runs)
+
+    def _iter_ticks(self, sink):
+        # Generator of chunks of our ticks when streaming, see
+        # generate_ticks():
+        def output_ticks(output, chunks):
+            for segments, timepoints, values in chunks:
+                if sink is not None:
+                    sink.append(output, 'segments', segments)
+                    sink.append(output, 'timepoints', timepoints)
+                    sink.append(output, 'values', values)
+                yield segments, timepoints
+
+        merged = clocking.merge_ticks([output_ticks(output, chunks)
+                                       for output, chunks in self.sample_chunks.items()])
+        self.n_ticks = 0
+        for segments, ticks in clocking.iter_check_spacing(self, merged,
+                                                           self.quantised_clock_minimum_period):
+            self.n_ticks += len(ticks)
+            if sink is not None:
+                sink.append(self, 'tick_segments', segments)
+                sink.append(self, 'ticks', ticks)
+            yield segments, ticks
+
 
 class Pseudoclock(Device):
     allowed_devices = [ClockLine]
@@ -109,8 +285,78 @@ class Pseudoclock(Device):
         # tick.
         self.timebase = timebase
 
+        # The timebase as an integer number of the shot's epsilon, if it has
+        # timeline='integer', to be determined during establish_common_limits:
+        self.integer_timebase = None
+
         self.pseudoclock = self
 
+        # To be determined during establish_common_limits:
+        self.quantised_clock_minimum_period = None
+
+        # To be determined during generate_ticks: the segment and quantised
+        # time of each clock tick, and for each ClockLine, the indices of the
+        # ticks at which it ticks:
+        self.tick_segments = None
+        self.ticks = None
+        self.clockline_ticks = None
+
+        # When streaming, the number of ticks, instead of the above:
+        self.n_ticks = None
+
+    def establish_common_limits(self):
+        super().establish_common_limits()
+        if self.shot.timeline == 'integer':
+            epsilon = self.shot.epsilon
+            self.integer_timebase = integer_timebase(self.timebase, epsilon, self)
+            self.quantised_clock_minimum_period = quantise_integer_period(
+                to_integer_time(self.clock_minimum_period, epsilon), self.integer_timebase)
+        else:
+            self.quantised_clock_minimum_period = quantise_period(self.clock_minimum_period,
+                                                                  self.timebase)
+
+    @enforce_phase(phase.GENERATE_CLOCK_TICKS, exactly_once=True)
+    def generate_ticks(self, sink=None):
+        """Merge the ticks of all our ClockLines, which must have generated
+        their ticks already, and check that they are no closer together than
+        our minimum period. If our ClockLines are streaming their ticks (see
+        ClockLine.generate_ticks()), instead consume their streams, merging
+        them in chunks, and pass each chunk to sink.append(self, name, array)
+        with the names 'tick_segments' and 'ticks' if a sink is given. The
+        indices of each ClockLine's ticks in ours are not computed in this
+        case."""
+        clocklines = self.descendant_devices_of_type(ClockLine)
+        previous = self.shot.reuse.get(self)
+        if previous is not None:
+            self.tick_segments, self.ticks = previous.tick_segments, previous.ticks
+            previous_ticks = {clockline.name: ticks
+                              for clockline, ticks in previous.clockline_ticks.items()}
+            self.clockline_ticks = {clockline: previous_ticks[clockline.name]
+                                    for clockline in clocklines}
+            return
+        if any(clockline.tick_chunks is not None for clockline in clocklines):
+            merged = clocking.merge_ticks([clockline.tick_chunks for clockline in clocklines])
+            self.n_ticks = 0
+            for segments, ticks in clocking.iter_check_spacing(
+                    self, merged, self.quantised_clock_minimum_period):
+                self.n_ticks += len(ticks)
+                if sink is not None:
+                    sink.append(self, 'tick_segments', segments)
+                    sink.append(self, 'ticks', ticks)
+            return
+        empty = np.zeros(0, dtype=np.int64)
+        segments = np.concatenate([empty] + [c.tick_segments for c in clocklines])
+        ticks = np.concatenate([empty] + [c.ticks for c in clocklines])
+        self.tick_segments, self.ticks, inverse = clocking.unique_ticks(segments, ticks)
+        self.clockline_ticks = {}
+        start = 0
+        for clockline in clocklines:
+            stop = start + len(clockline.ticks)
+            self.clockline_ticks[clockline] = inverse[start:stop]
+            start = stop
+        clocking.check_spacing(self, self.tick_segments, self.ticks,
+                               self.quantised_clock_minimum_period)
+
 
 class PseudoclockDevice(TriggerableDevice):
     allowed_devices = [Pseudoclock]
@@ -1,13 +1,27 @@
-import weakref
+import time
+import threading
 from enum import IntEnum
 import functools
+import itertools
 from types import MethodType
 
-# Determines whether the enforce_phase decorator has any effect. Useful to set
-# to False when not debugging or developing, to ensure there is no adverse
-# performance hit from checking every method call.
+# Determines whether the enforce_phase decorator has any effect. Setting it
+# to False before import removes phase enforcement entirely. To turn it off
+# or reduce it for a particular shot instead, see Shot(phase_enforcement=...)
+# and PHASE_ENFORCEMENT_MODES.
 ENFORCE_PHASE = True
 
+# Per-shot phase enforcement modes. 'full' checks every call to a decorated
+# method. 'sampled' checks only one in every Shot.phase_check_interval calls
+# to methods that are not required to be called exactly once, and checks
+# every call to methods that are, so that it can still be verified at the
+# end of each phase that they were all called. Which calls are checked is
+# decided by a wrapper bound once per instance that counts calls against a
+# counter shared by the shot, see sampled_method(). 'off' checks nothing,
+# and calls to decorated methods go directly to the underlying function,
+# bound once per instance, see PhaseEnforcedFunction.__get__.
+PHASE_ENFORCEMENT_MODES = ('full', 'sampled', 'off')
+
 
 # Exception classes for when the phase enforcement detects a problem:
 class PhaseError(RuntimeError):
@@ -35,6 +49,8 @@ class phase(IntEnum):
     ADD_INSTRUCTIONS = 3
     CONVERT_TIMING = 4
     CHECK_INSTRUCTIONS_VALID = 5
+    EVALUATE_FUNCTIONS = 6
+    GENERATE_CLOCK_TICKS = 7
 
 
 class has_phase_enforced_methods(type):
@@ -48,14 +64,10 @@ class has_phase_enforced_methods(type):
     def __init__(cls, name, superclasses, attrs):
         # Create the class as usual:
         type.__init__(cls, name, superclasses, attrs)
-        # Inspect the class for methods that have been decorated with
-        # @enforce_phase and marked as methods that must be called exactly
-        # once in their phase:
-        for name, attr in cls.__dict__.items():
-            if isinstance(attr, PhaseEnforcedFunction) and attr.exactly_once:
-                # Add the decorated method to the  registry of decorated
-                # methods that are required to be called exactly once
-                enforce_phase.register_required_method(cls, attr)
+        # Register the methods of the class and its parents that have been
+        # decorated with @enforce_phase and marked as methods that must be
+        # called exactly once in their phase:
+        enforce_phase.register_class(cls)
 
 
 class PhaseEnforcedFunction(object):
@@ -65,15 +77,57 @@ class PhaseEnforcedFunction(object):
         self.function = function
         self.phase = phase
         self.exactly_once = exactly_once
+        self.is_init = function.__name__ == '__init__'
         functools.update_wrapper(self, function)
+        # The attribute name we are stored under, and whether looking up that
+        # name on instances of each class finds us rather than an override,
+        # in which case bindings may be cached on the instance:
+        self.name = function.__name__
+        self.binds_instances = {}
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
     def __get__(self, instance, class_):
         """Make sure our callable binds like an instance method. Otherwise
-        __call__ doesn't get the instance argument."""
+        __call__ doesn't get the instance argument. What is bound depends on
+        the phase enforcement mode and profiling of the instance's shot: the
+        underlying function if calls are not to be checked, so that __call__
+        is bypassed, and wrapped to be timed if the shot is being profiled.
+        Since neither changes during the life of a shot, the binding is
+        decided once per instance and cached in the instance's __dict__,
+        where attribute lookup finds it before reaching us, so later calls
+        do not go through __get__ at all. Instances still being initialised
+        may not have a shot yet, so __init__ methods always get __call__,
+        which checks the mode and does any timing itself."""
         if instance is None:
             return self
-        else:
+        shot = instance.__dict__.get('shot')
+        if shot is None or self.is_init:
             return MethodType(self, instance)
+        mode = shot.phase_enforcement
+        if mode == 'off':
+            bound = MethodType(self.function, instance)
+        elif mode == 'sampled' and not self.exactly_once:
+            bound = sampled_method(self, instance, shot)
+        else:
+            bound = MethodType(self, instance)
+        if shot.profile is not None:
+            # The shot is being profiled, see profiling.ShotProfile:
+            bound = shot.profile.timed(self, bound)
+        if self._binds(type(instance)):
+            instance.__dict__[self.name] = bound
+        return bound
+
+    def _binds(self, class_):
+        # Whether looking up our name on instances of the class finds us,
+        # rather than this being a call such as super().method() from an
+        # override, whose binding must not be cached:
+        try:
+            return self.binds_instances[class_]
+        except KeyError:
+            binds = self.binds_instances[class_] = getattr(class_, self.name, None) is self
+            return binds
 
     def __call__(self, instance, *args, **kwargs):
         """Call the underlying function, wrapped in our check that it's the
@@ -81,42 +135,131 @@ class PhaseEnforcedFunction(object):
         complete so that the .shot attribute exists by the time we do our
         checks, and to make it more likely that any problems result in an
         exception from the wrapped function rather than from us."""
+        start = time.perf_counter() if self.is_init else None
         result = self.function(instance, *args, **kwargs)
         shot = instance.shot
+        if start is not None and shot.profile is not None:
+            # __init__ methods are called before the instance has a shot to
+            # say whether it is being profiled, so are timed here rather than
+            # being bound to be timed by __get__:
+            shot.profile.record_call(self, time.perf_counter() - start)
+        mode = shot.phase_enforcement
+        if mode != 'full':
+            if mode == 'off':
+                return result
+            if self.is_init:
+                # Sampling of other methods is done by sampled_method():
+                if next(shot.phase_registry.call_counter) % shot.phase_check_interval:
+                    return result
         if shot.phase != self.phase:
             msg = (f"{instance.__class__.__name__}.{self.function.__name__}() "
                    f"cannot be called in phase {shot.phase.name}")
             raise WrongPhaseError(msg)
         if self.exactly_once:
-            called = enforce_phase.called_methods.setdefault(instance, set())
-            if self in called:
-                msg = (f"{instance} has already had {self.function.__name__}() "
-                       f"called once in phase {shot.phase.name}")
-                raise AlreadyCalledError(msg)
-            called.add(self)
+            enforce_phase.count_call(instance, self)
         return result
 
 
+def sampled_method(method, instance, shot):
+    """Return a callable for calling a PhaseEnforcedFunction on an instance
+    in 'sampled' mode, which checks only every shot.phase_check_interval-th
+    call made through any such callable of the shot, calling the underlying
+    function directly otherwise. The calls are counted by an
+    itertools.count, whose next() is atomic, so that the count stays
+    consistent when methods are called from multiple threads."""
+    call = functools.partial(_sampled_call, MethodType(method.function, instance),
+                             MethodType(method, instance), shot.phase_registry.call_counter,
+                             shot.phase_check_interval)
+    return functools.update_wrapper(call, method.function)
+
+
+def _sampled_call(unchecked, checked, counter, interval, *args, **kwargs):
+    # The body of the callables returned by sampled_method(), which is a
+    # single function so that utils.capture_call_site() can skip its frames:
+    if next(counter) % interval:
+        return unchecked(*args, **kwargs)
+    return checked(*args, **kwargs)
+
+
+class PhaseRegistry(object):
+    """The phase enforcer's records of the instances belonging to a shot and
+    of the calls made to their required methods, kept on the shot as
+    shot.phase_registry, so that they are released along with it, or
+    immediately by Shot.close(), rather than accumulating in global
+    registries. Each shot has its own lock, so that different shots may be
+    compiled in different threads without contending for it."""
+
+    def __init__(self):
+        # The instances belonging to the shot, by class, so that we can do
+        # checks on all of them when its phase changes. Format:
+        # {class: set(instances)}.
+        self.instances = {}
+
+        # The instances on which each required method has been called, over
+        # all phases so far, so that instances need no record of their own.
+        # Format: {method: set(instances)}.
+        self.calls = {}
+
+        # The total number of calls to required methods over all instances
+        # of each class, so that all instances of a class can be verified at
+        # once. Format: {class: count}.
+        self.call_counts = {}
+
+        # Held while updating the calls, so that required methods may be
+        # called from multiple threads, as in Shot.stop() with an executor:
+        self.lock = threading.Lock()
+
+        # Counts calls to decorated methods in 'sampled' mode, see
+        # sampled_method(). Starts at one so that the phase_check_interval-th
+        # call is the first to be checked:
+        self.call_counter = itertools.count(1)
+
+    def clear(self):
+        self.instances = {}
+        self.calls = {}
+        self.call_counts = {}
+
+    def __getstate__(self):
+        """Record called methods by their qualified names, since the methods
+        themselves can't be pickled. The instances need not have had their
+        state restored yet when the registry is unpickled."""
+        calls = {method.__qualname__: instances for method, instances in self.calls.items()}
+        return {'instances': self.instances, 'calls': calls,
+                'call_counts': self.call_counts}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.instances = state['instances']
+        self.call_counts = state['call_counts']
+        methods = {method.__qualname__: method for class_ in self.instances
+                   for phase_methods in enforce_phase.required_methods[class_].values()
+                   for method in phase_methods}
+        self.calls = {methods[name]: instances for name, instances in state['calls'].items()}
+
+
 class enforce_phase(object):
     """Decorate an instance method to enforce that it only be called in a
     particular phase of the compilation process, and if required, that it
-    be called exactly once during that phase """
-
-    # Class attribute to store a list of objects by what shot they belong to,
-    # so that we can do checks on all the descendants of a shot when its phase
-    # changes. WeakKeyDictionary so we don't prevent garbage collection when
-    # the shot is otherwise finished with.
-    instances_by_shot = weakref.WeakKeyDictionary()
+    be called exactly once during that phase. Records of which instances
+    belong to each shot and which of their required methods have been
+    called are kept in each shot's PhaseRegistry."""
 
-    # Set of methods of each class that are required to be called exactly once
-    # on each instance during a given phase. Format: {phase: {class:
-    # set(method, other_method, ...)}).
+    # Methods of each class (including those inherited) that are required to
+    # be called exactly once on each instance during a given phase. Format:
+    # {class: {phase: frozenset(methods)}}. Computed once per class when it
+    # is created.
     required_methods = {}
 
-    # Store methods that have been called on a given instance. Format:
-    # {instance: set([methods])}. WeakKeyDictionary so we don't prevent
-    # Garbage collection when the instances have no other references to them:
-    called_methods = weakref.WeakKeyDictionary()
+    # The total number of required methods of each class in all phases up to
+    # and including a given phase, which is the number of required calls
+    # each instance should have had by the end of that phase. Format:
+    # {class: {phase: count}}.
+    expected_calls = {}
+
+    # The attribute names of all methods of each class (including those
+    # inherited) decorated with @enforce_phase, under which bindings of them
+    # may be cached in the __dict__ of instances. Format: {class: frozenset(names)}.
+    method_names = {}
 
     def __init__(self, phase, exactly_once=False):
         """Instantiate the decorator with the passed arguments"""
@@ -134,36 +277,135 @@ class enforce_phase(object):
 
     @classmethod
     def register_instance(cls, instance):
-        """Add an instance to our registry of all instances that are
-        descendants of each shot"""
-        descendents_of_shot = cls.instances_by_shot.setdefault(instance.shot, set())
-        descendents_of_shot.add(instance)
+        """Add an instance to the registry of the shot it belongs to"""
+        shot = instance.shot
+        if shot.phase_enforcement == 'off':
+            return
+        instances = shot.phase_registry.instances
+        instances.setdefault(type(instance), set()).add(instance)
+
+    @classmethod
+    def register_instances(cls, instances):
+        """Add a number of instances of the same class belonging to the same
+        shot to its registry at once"""
+        if not instances or instances[0].shot.phase_enforcement == 'off':
+            return
+        registered = instances[0].shot.phase_registry.instances
+        registered.setdefault(type(instances[0]), set()).update(instances)
+
+    @classmethod
+    def register_copies(cls, original_shot, copies):
+        """Register copies of the instances of a shot that belong to a
+        different shot, as made by Shot.fork(), carrying over the records of
+        which required methods have already been called on the originals.
+        copies is a dict mapping each original to its copy."""
+        shot = copies[original_shot]
+        if shot.phase_enforcement == 'off':
+            return
+        registry = shot.phase_registry
+        for copy in copies.values():
+            registry.instances.setdefault(type(copy), set()).add(copy)
+        for method, called in original_shot.phase_registry.calls.items():
+            copied = {copies[instance] for instance in called if instance in copies}
+            registry.calls[method] = copied
+            for copy in copied:
+                class_ = type(copy)
+                registry.call_counts[class_] = registry.call_counts.get(class_, 0) + 1
+
+    @classmethod
+    def register_class(cls, class_):
+        """Compute and store the methods of a class, including those it
+        inherits, that have been decorated with @enforce_phase and marked as
+        needing to be called exactly once, by phase, as well as how many
+        calls to such methods each instance should have had by the end of
+        each phase"""
+        required_methods = {}
+        method_names = set()
+        for superclass in class_.__mro__:
+            for name, attr in superclass.__dict__.items():
+                if isinstance(attr, PhaseEnforcedFunction):
+                    method_names.add(name)
+                    if attr.exactly_once:
+                        required_methods.setdefault(attr.phase, set()).add(attr)
+        cls.method_names[class_] = frozenset(method_names)
+        cls.required_methods[class_] = {p: frozenset(methods)
+                                        for p, methods in required_methods.items()}
+        expected_calls = {}
+        total = 0
+        for p in phase:
+            total += len(required_methods.get(p, ()))
+            expected_calls[p] = total
+        cls.expected_calls[class_] = expected_calls
 
     @classmethod
-    def register_required_method(cls, class_, phase_enforced_function):
-        """Register that a method of a class can only be called in a
-        particular phase, and optionally that it needs to be called exactly
-        once in its phase"""
-        phase = phase_enforced_function.phase
-        methods = cls.required_methods.setdefault(phase, {}).setdefault(class_, set())
-        methods.add(phase_enforced_function)
+    def instance_state(cls, instance):
+        """Return a copy of the instance's __dict__ without any bindings of
+        its decorated methods cached there, which are specific to the
+        instance and its shot and so must not be copied to other instances,
+        as by Shot.fork(), or pickled"""
+        method_names = cls.method_names[type(instance)]
+        return {attr: value for attr, value in instance.__dict__.items()
+                if attr not in method_names}
+
+    @classmethod
+    def count_call(cls, instance, method):
+        """Record a call to a method that must be called exactly once on the
+        given instance, raising AlreadyCalledError if it has already been
+        called"""
+        registry = instance.shot.phase_registry
+        with registry.lock:
+            called = registry.calls.setdefault(method, set())
+            if instance in called:
+                msg = (f"{instance} has already had {method.function.__name__}() "
+                       f"called once in phase {method.phase.name}")
+                raise AlreadyCalledError(msg)
+            called.add(instance)
+            class_ = type(instance)
+            registry.call_counts[class_] = registry.call_counts.get(class_, 0) + 1
+
+    @classmethod
+    def record_calls(cls, instances, method):
+        """Record that a method decorated with @enforce_phase has been called
+        on each of the given instances, which must all belong to the same
+        shot. This is for code that does the work of a method for many
+        instances at once without calling it on each. The same checks are
+        made as if the method had been called on each instance."""
+        if not isinstance(method, PhaseEnforcedFunction) or not instances:
+            return
+        shot = instances[0].shot
+        if shot.phase_enforcement == 'off':
+            return
+        if shot.phase != method.phase:
+            msg = (f"{method.function.__name__}() cannot be called in "
+                   f"phase {shot.phase.name}")
+            raise WrongPhaseError(msg)
+        if method.exactly_once:
+            for instance in instances:
+                cls.count_call(instance, method)
 
     @classmethod
     def check_required_methods_called(cls, shot, phase):
         """Confirm that at the end of given phase, all methods that were
         marked as needing to be called exactly once were called on every
-        instance"""
-        if not ENFORCE_PHASE:
+        instance. Since each method can only be called once per instance, it
+        suffices to compare the total number of calls made on the instances
+        of each class with the number expected, and only look at individual
+        instances if there is a shortfall."""
+        if not ENFORCE_PHASE or shot.phase_enforcement == 'off':
             return
-        for instance in cls.instances_by_shot[shot]:
-            required_methods_by_class = cls.required_methods.get(phase, {})
-            for class_, required_methods in required_methods_by_class.items():
-                if isinstance(instance, class_):
-                    called_methods = cls.called_methods.get(instance, set())
-                    for method in (required_methods - called_methods):
+        registry = shot.phase_registry
+        for class_, instances in registry.instances.items():
+            expected = cls.expected_calls[class_][phase]
+            if registry.call_counts.get(class_, 0) == expected * len(instances):
+                continue
+            # Required methods of earlier phases were verified at their
+            # end, so the shortfall is in this phase's:
+            for method in cls.required_methods[class_].get(phase, ()):
+                called = registry.calls.get(method, ())
+                for instance in instances:
+                    if instance not in called:
                         # Just raise an exception about one of the required
                         # but uncalled methods:
                         msg = (f"{instance} has not had {method.__name__}() "
                                f"called by the end of phase {phase.name}")
                         raise NotCalledError(msg)
-
@@ -0,0 +1,315 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from table import InstructionColumns
+
+
+__all__ = ['sample_timepoints', 'iter_timepoints', 'RampCache', 'evaluate_functions',
+           'iter_evaluate']
+
+
+def _n_samples(quantised_duration, quantised_sample_period):
+    # The number of timepoints at which each instruction is evaluated:
+    n_samples = np.ones(len(quantised_duration), dtype=np.int64)
+    ramps = (quantised_duration > 0) & (quantised_sample_period > 0)
+    n_samples[ramps] = -(-quantised_duration[ramps] // quantised_sample_period[ramps])
+    return n_samples
+
+
+def sample_timepoints(quantised_t, quantised_duration, quantised_sample_period):
+    """Return the quantised times at which each of a number of Function
+    instructions is to be evaluated, concatenated into a single array, along
+    with an array of offsets such that the timepoints of instruction i are
+    timepoints[offsets[i]:offsets[i+1]]. A Function with a nonzero duration
+    and sample period is evaluated every sample period from its start time
+    up to but not including its end time. Otherwise, for example in the case
+    of a Constant, it is evaluated once at its start time."""
+    n_samples = _n_samples(quantised_duration, quantised_sample_period)
+    offsets = np.zeros(len(quantised_t) + 1, dtype=np.int64)
+    np.cumsum(n_samples, out=offsets[1:])
+    sample_index = np.arange(offsets[-1]) - np.repeat(offsets[:-1], n_samples)
+    timepoints = (np.repeat(quantised_t, n_samples)
+                  + np.repeat(quantised_sample_period, n_samples) * sample_index)
+    return timepoints, offsets
+
+
+def iter_timepoints(quantised_t, quantised_duration, quantised_sample_period, chunk_size):
+    """Generator equivalent of sample_timepoints(), yielding the same
+    timepoints in chunks of at most chunk_size, so that long ramps are never
+    materialised all at once. Each chunk is a (rows, timepoints) pair, where
+    rows gives the index of the instruction each timepoint belongs to."""
+    n_samples = _n_samples(quantised_duration, quantised_sample_period)
+    offsets = np.zeros(len(quantised_t) + 1, dtype=np.int64)
+    np.cumsum(n_samples, out=offsets[1:])
+    total = offsets[-1]
+    for start in range(0, total, chunk_size):
+        stop = min(start + chunk_size, total)
+        # The instructions with samples in this chunk, and how many each has:
+        first = np.searchsorted(offsets, start, side='right') - 1
+        last = np.searchsorted(offsets, stop, side='left')
+        counts = (np.minimum(offsets[first + 1:last + 1], stop)
+                  - np.maximum(offsets[first:last], start))
+        rows = np.repeat(np.arange(first, last), counts)
+        sample_index = np.arange(start, stop) - offsets[rows]
+        yield rows, quantised_t[rows] + quantised_sample_period[rows] * sample_index
+
+
+def _real_values(function, values):
+    # Return the values returned by a function as an array, raising TypeError
+    # if they are not real numbers, rather than having NumPy fail or discard
+    # their imaginary parts when they are stored as float64:
+    values = np.asarray(values)
+    if values.dtype.kind not in 'biuf':
+        msg = (f"Function {function!r} returned values of dtype {values.dtype}, "
+               f"but output values must be real numbers")
+        raise TypeError(msg)
+    return values
+
+
+def _evaluate_samples(rows, timepoints, quantised_t, is_constant, function_ids, functions,
+                      timebase):
+    # Return the values at the given timepoints of the instructions given by
+    # rows. Constants are filled in directly, and each distinct function of
+    # the other instructions is called once on all its samples, with times
+    # in seconds relative to the start of each instruction:
+    values = np.empty(len(timepoints), dtype=float)
+    sample_ids = function_ids[rows]
+    sample_is_constant = is_constant[rows]
+    lookup = np.zeros(len(functions), dtype=float)
+    for function_id in np.unique(sample_ids[sample_is_constant]):
+        lookup[function_id] = functions[function_id]
+    values[sample_is_constant] = lookup[sample_ids[sample_is_constant]]
+
+    sample_ids = np.where(sample_is_constant, -1, sample_ids)
+    order = np.argsort(sample_ids, kind='stable')
+    sorted_ids = sample_ids[order]
+    first = np.searchsorted(sorted_ids, 0)
+    distinct_ids, starts = np.unique(sorted_ids[first:], return_index=True)
+    bounds = np.append(starts, len(sorted_ids) - first) + first
+    for function_id, start, stop in zip(distinct_ids, bounds[:-1], bounds[1:]):
+        samples = order[start:stop]
+        t = (timepoints[samples] - quantised_t[rows[samples]]) * timebase
+        function = functions[function_id]
+        values[samples] = _real_values(function, function(t))
+    return values
+
+
+class RampCache(object):
+    """A least-recently-used cache of the evaluated values of Function
+    instructions, bounded by the total size of the cached arrays in bytes.
+    The values of a Function depend only on its function, its quantised
+    duration and sample period, and the timebase, not on its start time, so
+    these are the key. Functions are compared by equality, which for most
+    callables is identity, but for those in the functions module is by
+    their parameters. Functions that are not hashable are not cached.
+    Cached arrays are read-only, and are shared between the Function
+    objects that use them. Statistics of use are in the hits, misses and
+    evictions attributes, and returned by stats(). May be used from
+    multiple threads."""
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached values for the key, or None if not present"""
+        with self._lock:
+            try:
+                values = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return values
+
+    def put(self, key, values):
+        """Add values to the cache, making them read-only, and evict the
+        least recently used entries until the cache is within its size
+        limit. Values larger than the limit are not cached."""
+        values.setflags(write=False)
+        if values.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = values
+            self.nbytes += values.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return a dict of the number of hits, misses and evictions so far,
+        and the current number of entries and their total size in bytes"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self.nbytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _evaluate_cached(offsets, quantised_duration, quantised_sample_period, is_constant,
+                     function_ids, functions, timebase, cache):
+    # Equivalent of _evaluate_samples() for all the samples of all the given
+    # instructions, looking up the values of each distinct (function,
+    # quantised duration, quantised sample period) in the cache, and
+    # evaluating those not found, calling each function once on the samples
+    # of all its missing ramps. Return the values, and a dict mapping the
+    # rows whose values came from or were added to the cache to the cached
+    # array.
+    values = np.empty(offsets[-1], dtype=float)
+    n_samples = np.diff(offsets)
+    constant_rows = np.flatnonzero(is_constant)
+    constant_ids = function_ids[constant_rows]
+    lookup = np.zeros(len(functions), dtype=float)
+    for function_id in np.unique(constant_ids):
+        lookup[function_id] = functions[function_id]
+    values[offsets[constant_rows]] = lookup[constant_ids]
+
+    # Functions that are equal but distinct objects share cache entries, so
+    # give them the same id:
+    canonical_ids = np.arange(len(functions))
+    first_ids = {}
+    for function_id, function in enumerate(functions):
+        try:
+            canonical_ids[function_id] = first_ids.setdefault(function, function_id)
+        except TypeError:
+            pass
+    function_ids = canonical_ids[function_ids]
+
+    # Group the other instructions by their key:
+    rows = np.flatnonzero(~is_constant)
+    keys = np.stack([function_ids[rows], quantised_duration[rows],
+                     quantised_sample_period[rows]])
+    order = np.lexsort(keys[::-1])
+    rows = rows[order]
+    keys = keys[:, order]
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = (np.diff(keys, axis=1) != 0).any(axis=0)
+    bounds = np.append(np.flatnonzero(new), len(rows))
+
+    groups = []
+    missing = {}
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        group_rows = rows[start:stop]
+        row = group_rows[0]
+        function = functions[function_ids[row]]
+        key = (function, int(quantised_duration[row]), int(quantised_sample_period[row]),
+               timebase)
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+        cached = None if key is None else cache.get(key)
+        groups.append([group_rows, key, cached])
+        if cached is None:
+            missing.setdefault(function_ids[row], []).append(len(groups) - 1)
+
+    for function_id, indices in missing.items():
+        lengths = [n_samples[groups[i][0][0]] for i in indices]
+        t = np.concatenate([np.arange(n) * quantised_sample_period[groups[i][0][0]]
+                            for i, n in zip(indices, lengths)]) * timebase
+        function = functions[function_id]
+        result = np.broadcast_to(_real_values(function, function(t)).astype(float), t.shape)
+        start = 0
+        for i, n in zip(indices, lengths):
+            group_values = np.array(result[start:start + n])
+            start += n
+            if groups[i][1] is not None:
+                cache.put(groups[i][1], group_values)
+            groups[i][2] = group_values
+
+    shared = {}
+    for group_rows, key, group_values in groups:
+        n = len(group_values)
+        values[offsets[group_rows][:, np.newaxis] + np.arange(n)] = group_values
+        if key is not None:
+            shared.update(dict.fromkeys(group_rows.tolist(), group_values))
+    return values, shared
+
+
+def evaluate_functions(outputs, timebase, cache=None):
+    """Evaluate the Function and Constant instructions of the given outputs,
+    which must all be clocked by a single ClockLine with the given timebase,
+    after their timing has been converted. The timepoints of all
+    instructions are computed at once, and each distinct function is called
+    once on the timepoints of all instructions that use it, with times in
+    seconds relative to the start of each instruction. Constants are filled
+    in directly without calling any function. Results are stored in the
+    evaluation_timepoints and values attributes of Function objects, and
+    likewise for InstructionTables, for which value_offsets[i] gives the
+    start of the i'th row's values. Values are float64, and TypeError is
+    raised if a function returns any that are not real. If a RampCache is
+    given, the values of each distinct ramp are looked up in it rather than
+    evaluated if possible, and Function objects share the cached arrays."""
+    from instructions import Function
+    columns = InstructionColumns(outputs, ['quantised_t', 'quantised_duration',
+                                           'quantised_sample_period', 'is_constant'],
+                                 instruction_class=Function)
+    quantised_t = columns.columns['quantised_t']
+    timepoints, offsets = sample_timepoints(quantised_t,
+                                            columns.columns['quantised_duration'],
+                                            columns.columns['quantised_sample_period'])
+    function_ids, functions = columns.function_ids()
+    if cache is None:
+        rows = np.repeat(np.arange(len(columns)), np.diff(offsets))
+        values = _evaluate_samples(rows, timepoints, quantised_t, columns.columns['is_constant'],
+                                   function_ids, functions, timebase)
+        shared = {}
+    else:
+        values, shared = _evaluate_cached(offsets, columns.columns['quantised_duration'],
+                                          columns.columns['quantised_sample_period'],
+                                          columns.columns['is_constant'], function_ids,
+                                          functions, timebase, cache)
+
+    # Store the results:
+    for table, rows in columns.table_slices():
+        start, stop = offsets[rows.start], offsets[rows.stop]
+        table.evaluation_timepoints = timepoints[start:stop]
+        table.values = values[start:stop]
+        table.value_offsets = offsets[rows.start:rows.stop + 1] - start
+    for i, instruction in enumerate(columns.objects):
+        start, stop = offsets[i], offsets[i + 1]
+        instruction.evaluation_timepoints = timepoints[start:stop]
+        instruction.values = shared.get(i, values[start:stop])
+
+
+def iter_evaluate(output, timebase, chunk_size):
+    """Generator evaluating the Function and Constant instructions of a
+    single output as for evaluate_functions(), but in chunks of at most
+    chunk_size samples, so that peak memory use depends on the chunk size
+    rather than on the lengths of ramps. Yields (segments, timepoints,
+    values) for each chunk, sorted by segment and time over all chunks,
+    which requires that the output's instructions do not overlap. Nothing
+    is stored on the instructions."""
+    from instructions import Function
+    columns = InstructionColumns([output], ['segment', 'quantised_t', 'quantised_duration',
+                                            'quantised_sample_period', 'is_constant'],
+                                 instruction_class=Function)
+    function_ids, functions = columns.function_ids()
+    order = np.lexsort((columns.columns['quantised_t'], columns.columns['segment']))
+    segment, quantised_t, quantised_duration, quantised_sample_period, is_constant = (
+        columns.columns[name][order] for name in ['segment', 'quantised_t',
+                                                  'quantised_duration',
+                                                  'quantised_sample_period', 'is_constant'])
+    function_ids = function_ids[order]
+    for rows, timepoints in iter_timepoints(quantised_t, quantised_duration,
+                                            quantised_sample_period, chunk_size):
+        values = _evaluate_samples(rows, timepoints, quantised_t, is_constant, function_ids,
+                                   functions, timebase)
+        yield segment[rows], timepoints, values
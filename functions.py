@@ -0,0 +1,76 @@
+import numpy as np
+
+
+__all__ = ['Const', 'LinearRamp', 'Sine']
+
+
+# Functions of time for use with Output.function(), written as classes rather
+# than closures so that they can be pickled, for example to send shots to
+# other processes with sweep.compile_shots(). Each is called with an array of
+# times in seconds relative to the start of its instruction. Any other
+# picklable callable, such as a module-level function or a NumPy ufunc, can
+# be used in the same way. Instances compare equal and hash the same if they
+# are of the same class with equal parameters, so that equal functions
+# created separately share entries in an evaluation.RampCache.
+
+
+class _Parametrised(object):
+    # Base class for functions that compare by their parameters, which are
+    # listed in the params class attribute:
+    params = ()
+
+    def _key(self):
+        return tuple(getattr(self, name) for name in self.params)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._key() == self._key()
+
+    def __hash__(self):
+        return hash((type(self), self._key()))
+
+    def __repr__(self):
+        args = ', '.join(repr(value) for value in self._key())
+        return f"{self.__class__.__name__}({args})"
+
+
+class Const(_Parametrised):
+    """A constant function, as used for the function of a Constant
+    instruction"""
+    params = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, t):
+        if isinstance(t, np.ndarray):
+            return np.full_like(t, self.value, dtype=np.result_type(self.value))
+        else:
+            return self.value
+
+
+class LinearRamp(_Parametrised):
+    """A linear ramp from initial to final over the given duration"""
+    params = ('duration', 'initial', 'final')
+
+    def __init__(self, duration, initial, final):
+        self.duration = duration
+        self.initial = initial
+        self.final = final
+
+    def __call__(self, t):
+        return self.initial + (self.final - self.initial) * (t / self.duration)
+
+
+class Sine(_Parametrised):
+    """A sinusoid with the given amplitude, angular frequency, phase and
+    offset"""
+    params = ('amplitude', 'angfreq', 'phase', 'offset')
+
+    def __init__(self, amplitude, angfreq, phase=0, offset=0):
+        self.amplitude = amplitude
+        self.angfreq = angfreq
+        self.phase = phase
+        self.offset = offset
+
+    def __call__(self, t):
+        return self.amplitude * np.sin(self.angfreq * t + self.phase) + self.offset
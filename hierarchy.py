@@ -0,0 +1,126 @@
+import copy
+
+import numpy as np
+
+
+__all__ = ['HierarchyIndex']
+
+
+class HierarchyIndex(object):
+    """An index of a shot's device hierarchy, built once the hierarchy is
+    complete at the end of phase.ADD_DEVICES, so that queries for the
+    descendants of a device, optionally of a given type, are slices of
+    precomputed arrays rather than recursive walks of the hierarchy.
+
+    Devices (and the shot itself, at position 0) are stored in a flat list in
+    pre-order, such that the descendants of the device at position i are at
+    positions i+1 up to subtree_stop[i]. For queries that do not recurse into
+    pseudoclocks, devices are additionally stored partitioned by their
+    controlling pseudoclock (the device's .pseudoclock attribute, which is
+    the device itself for Pseudoclocks and None for devices not under any
+    pseudoclock), in pre-order within each partition. The descendants of a
+    device that are not pseudoclocks or under other pseudoclocks are then
+    also a contiguous range of its partition."""
+
+    def __init__(self, shot):
+        # Pre-order traversal of the hierarchy:
+        self.devices = []
+        parents = []
+        stack = [(shot, -1)]
+        while stack:
+            device, parent = stack.pop()
+            position = len(self.devices)
+            self.devices.append(device)
+            parents.append(parent)
+            stack.extend((child, position) for child in reversed(device.devices))
+        n_devices = len(self.devices)
+        self.positions = {device: i for i, device in enumerate(self.devices)}
+        self.parents = np.array(parents, dtype=np.int64)
+
+        # The size of each device's subtree, and of the part of it under the
+        # same pseudoclock. Children come after their parents, so we can
+        # accumulate sizes in reverse order:
+        subtree_size = np.ones(n_devices, dtype=np.int64)
+        partition_size = np.ones(n_devices, dtype=np.int64)
+        for i in range(n_devices - 1, 0, -1):
+            parent = parents[i]
+            subtree_size[parent] += subtree_size[i]
+            if self.devices[i].pseudoclock is self.devices[parent].pseudoclock:
+                partition_size[parent] += partition_size[i]
+        self.subtree_stop = np.arange(n_devices) + subtree_size
+
+        # Partition by pseudoclock, keeping pre-order within each partition:
+        partition_of = {}
+        for device in self.devices:
+            partition_of.setdefault(device.pseudoclock, len(partition_of))
+        partition_ids = np.array([partition_of[device.pseudoclock] for device in self.devices],
+                                 dtype=np.int64)
+        order = np.argsort(partition_ids, kind='stable')
+        self.partitioned = [self.devices[i] for i in order]
+        self.partition_positions = np.empty(n_devices, dtype=np.int64)
+        self.partition_positions[order] = np.arange(n_devices)
+        self.partition_stop = self.partition_positions + partition_size
+        bounds = np.searchsorted(partition_ids[order], np.arange(len(partition_of) + 1))
+        self.partitions = {pseudoclock: (bounds[i], bounds[i + 1])
+                           for pseudoclock, i in partition_of.items()}
+
+        # Sorted positions of the instances of each class, in both orders:
+        by_class = {}
+        for i, device in enumerate(self.devices):
+            for cls in type(device).__mro__:
+                by_class.setdefault(cls, []).append(i)
+        self.positions_by_class = {cls: np.array(positions, dtype=np.int64)
+                                   for cls, positions in by_class.items()}
+        self.partition_positions_by_class = {
+            cls: np.sort(self.partition_positions[positions])
+            for cls, positions in self.positions_by_class.items()}
+
+    def remap(self, mapping):
+        """Return an index of a copy of the hierarchy, given a dict mapping
+        each device of this hierarchy (and its shot) to the corresponding
+        device of the copy. The arrays of the index are shared, not copied."""
+        index = copy.copy(self)
+        index.devices = [mapping[device] for device in self.devices]
+        index.partitioned = [mapping[device] for device in self.partitioned]
+        index.positions = {mapping[device]: i for device, i in self.positions.items()}
+        index.partitions = {mapping.get(pseudoclock): bounds
+                            for pseudoclock, bounds in self.partitions.items()}
+        return index
+
+    def descendants(self, device, recurse_into_pseudoclocks=False):
+        """Return the descendants of a device (not including the device
+        itself) in pre-order, as HasDevices.descendant_devices()"""
+        i = self.positions[device]
+        if recurse_into_pseudoclocks:
+            return self.devices[i + 1:self.subtree_stop[i]]
+        return self.partitioned[self.partition_positions[i] + 1:self.partition_stop[i]]
+
+    def descendants_of_type(self, device, cls, recurse_into_pseudoclocks=False):
+        """Return the descendants of a device (not including the device
+        itself) that are instances of the given class, in pre-order"""
+        i = self.positions[device]
+        if recurse_into_pseudoclocks:
+            positions = self.positions_by_class.get(cls)
+            devices = self.devices
+            start, stop = i + 1, self.subtree_stop[i]
+        else:
+            positions = self.partition_positions_by_class.get(cls)
+            devices = self.partitioned
+            start, stop = self.partition_positions[i] + 1, self.partition_stop[i]
+        if positions is None:
+            return []
+        lower, upper = np.searchsorted(positions, [start, stop])
+        return [devices[j] for j in positions[lower:upper]]
+
+    def partition(self, pseudoclock):
+        """Return all devices controlled by a pseudoclock, including the
+        pseudoclock itself, but not devices controlled by other pseudoclocks
+        below it. pseudoclock=None gives the shot and devices not under any
+        pseudoclock."""
+        start, stop = self.partitions.get(pseudoclock, (0, 0))
+        return self.partitioned[start:stop]
+
+    def parent(self, device):
+        """Return the parent of a device, or None for the shot"""
+        parent = self.parents[self.positions[device]]
+        return None if parent < 0 else self.devices[parent]
@@ -0,0 +1,168 @@
+import hashlib
+
+import numpy as np
+
+from enforce_phase import enforce_phase
+from table import InstructionTable, InstructionColumns
+import timing
+
+
+__all__ = ['output_digest', 'match_previous', 'reuse_timing', 'reuse_values']
+
+
+# Attributes of Function objects and columns of InstructionTables computed
+# during phase.CONVERT_TIMING:
+_timing_names = ['segment', 'relative_t', 'quantised_t', 'quantised_duration',
+                 'quantised_sample_period']
+
+
+def _value_bytes(value):
+    # A canonical encoding of a Constant's value, exact for values of any
+    # type: its dtype and bytes as an array, or, for values such as Python
+    # ints too large for any integer dtype, its repr:
+    array = np.asarray(value)
+    if array.dtype.kind == 'O':
+        encoded = repr(value).encode('utf8')
+    else:
+        encoded = array.tobytes()
+    header = f'{array.dtype.str}:{len(encoded)}:'.encode('utf8')
+    return header + encoded
+
+
+def output_digest(output, wait_times, timebase):
+    """Return a digest of everything that the converted timing and evaluated
+    values of an Output's instructions depend on: their times, durations,
+    sample rates, functions (by identity) and constant values, how they are
+    stored, the timebase, and the times of those waits up to and including
+    the one that ends the last segment the instructions are in. Waits after
+    that do not affect them. Return None if the output has instructions other than Functions
+    and Constants, or whose class reimplements convert_timing(), whose
+    results are not reused. Comparing functions by identity is only valid
+    while the functions of both outputs being compared are alive."""
+    from instructions import Function
+    if not isinstance(output.instructions, InstructionTable):
+        for instruction in output.instructions:
+            if not isinstance(instruction, Function) or not timing._is_batchable(
+                    type(instruction)):
+                return None
+    columns = InstructionColumns([output], ['t', 'duration', 'samplerate', 'is_constant'])
+    function_ids, functions = columns.function_ids()
+    is_constant = columns.columns['is_constant']
+    constant_ids = set(function_ids[is_constant].tolist())
+    digest = hashlib.blake2b(type(output.instructions).__name__.encode('utf8'))
+    for name in ['t', 'duration', 'samplerate', 'is_constant']:
+        digest.update(columns.columns[name].tobytes())
+    digest.update(function_ids.tobytes())
+    for function_id, function in enumerate(functions):
+        if function_id in constant_ids:
+            digest.update(_value_bytes(function))
+        else:
+            digest.update(id(function).to_bytes(8, 'little'))
+    n_segments = 0
+    if len(columns):
+        n_segments = int(np.searchsorted(wait_times, columns.columns['t'], side='right').max())
+        n_segments += 1
+    digest.update(n_segments.to_bytes(8, 'little'))
+    digest.update(np.asarray(wait_times[:n_segments], dtype=float).tobytes())
+    digest.update(np.float64(timebase).tobytes())
+    return digest.digest()
+
+
+def _evaluated(output):
+    # Whether an Output of a stopped shot has evaluated instructions, which
+    # is not the case if they were evaluated in chunks:
+    instructions = output.instructions
+    if isinstance(instructions, InstructionTable):
+        return instructions.value_offsets is not None or not len(instructions)
+    return all(getattr(instruction, 'values', None) is not None for instruction in instructions)
+
+
+def match_previous(shot, previous, wait_times):
+    """Return a dict mapping Outputs, ClockLines and Pseudoclocks of a shot
+    to the devices of the same name in a previous shot, which must have been
+    stopped successfully without chunking, whose results can be reused.
+    Outputs are matched if their digests are equal, ClockLines if all their
+    Outputs are matched and their minimum periods are equal, and
+    Pseudoclocks if all their ClockLines are matched and their minimum
+    periods are equal. wait_times are the sorted times of the shot's waits."""
+    from bases import Output
+    from devices import ClockLine, Pseudoclock
+    reuse = {}
+    previous_wait_times = timing.wait_times(previous.instructions)
+    previous_devices = {device.name: device for device in previous.all_devices}
+
+    def match(device, cls):
+        previous_device = previous_devices.get(device.name)
+        if (type(previous_device) is type(device) and isinstance(device, cls)
+                and previous_device.quantised_clock_minimum_period
+                == device.quantised_clock_minimum_period):
+            return previous_device
+        return None
+
+    for clockline in shot.all_clocklines:
+        outputs = clockline.descendant_devices_of_type(Output)
+        previous_clockline = match(clockline, ClockLine)
+        if previous_clockline is None or previous_clockline.ticks is None:
+            continue
+        previous_outputs = {output.name: output for output in
+                            previous_clockline.descendant_devices_of_type(Output)}
+        matched = len(outputs) == len(previous_outputs)
+        for output in outputs:
+            previous_output = previous_outputs.get(output.name)
+            if previous_output is None or not _evaluated(previous_output):
+                matched = False
+                continue
+            timebase = clockline.timebase
+            digest = output_digest(output, wait_times, timebase)
+            if digest is not None and digest == output_digest(
+                    previous_output, previous_wait_times, previous_clockline.timebase):
+                reuse[output] = previous_output
+            else:
+                matched = False
+        if matched:
+            reuse[clockline] = previous_clockline
+
+    for pseudoclock in shot.all_pseudoclocks:
+        previous_pseudoclock = match(pseudoclock, Pseudoclock)
+        if previous_pseudoclock is None or previous_pseudoclock.ticks is None:
+            continue
+        clocklines = pseudoclock.descendant_devices_of_type(ClockLine)
+        previous_clocklines = previous_pseudoclock.descendant_devices_of_type(ClockLine)
+        if (len(clocklines) == len(previous_clocklines)
+                and all(reuse.get(clockline) in previous_clocklines
+                        for clockline in clocklines)):
+            reuse[pseudoclock] = previous_pseudoclock
+    return reuse
+
+
+def reuse_timing(output, previous):
+    """Copy the converted timing of the instructions of an Output from those
+    of the matching Output of a previous shot, as returned by
+    match_previous(), recording the calls with the phase enforcer as if
+    convert_timing() had been called on each instruction or table."""
+    from bases import Instruction
+    instructions = output.instructions
+    if isinstance(instructions, InstructionTable):
+        for name in _timing_names:
+            instructions.column(name)[:] = previous.instructions.column(name)
+        instructions.timing_converted = True
+        enforce_phase.record_calls([instructions], InstructionTable.convert_timing)
+    else:
+        for instruction, previous_instruction in zip(instructions, previous.instructions):
+            for name in _timing_names:
+                setattr(instruction, name, getattr(previous_instruction, name))
+        enforce_phase.record_calls(instructions, Instruction.convert_timing)
+
+
+def reuse_values(output, previous):
+    """Share the evaluated timepoints and values of the instructions of an
+    Output with those of the matching Output of a previous shot"""
+    instructions = output.instructions
+    if isinstance(instructions, InstructionTable):
+        instructions.evaluation_timepoints = previous.instructions.evaluation_timepoints
+        instructions.values = previous.instructions.values
+        instructions.value_offsets = previous.instructions.value_offsets
+    else:
+        for instruction, previous_instruction in zip(instructions, previous.instructions):
+            instruction.evaluation_timepoints = previous_instruction.evaluation_timepoints
+            instruction.values = previous_instruction.values
@@ -1,11 +1,27 @@
 from bases import Instruction, OutputInstruction
-from utils import _const, formatobj
+from utils import formatobj
+from functions import Const
+from timing import to_integer_time, to_integer_times
+from enforce_phase import enforce_phase
 
 class Wait(Instruction):
     def __init__(self, parent, t, name, _inst_depth=1, **kwargs):
         super().__init__(parent, t, _inst_depth=_inst_depth+1, **kwargs)
         self.name = name
 
+    def convert_timing(self, waits):
+        super().convert_timing(waits)
+        # A wait is the last thing in the segment that it ends, rather than
+        # the first thing in the segment that follows it:
+        self.segment -= 1
+        if self.segment and self.shot.timeline == 'integer':
+            relative_t = self.integer_t - waits[self.segment - 1].integer_t
+            self.relative_t = relative_t * self.shot.epsilon
+        elif self.segment:
+            self.relative_t = self.t - waits[self.segment - 1].t
+        else:
+            self.relative_t = self.t
+
     def __str__(self):
         return formatobj(self, 'parent', 't', 'name')
 
@@ -17,6 +33,8 @@ class Function(OutputInstruction):
         super().__init__(parent, t, _inst_depth=_inst_depth+1, **kwargs)
         self.function = function
         self.duration = duration
+        if self.shot.timeline == 'integer':
+            self.integer_duration = to_integer_time(duration, self.shot.epsilon)
         self.samplerate = samplerate
 
         # Timing details to be computed during processing:
@@ -29,8 +47,16 @@ class Function(OutputInstruction):
 
 
     def convert_timing(self, waits):
+        from timing import quantise_instruction_durations, quantise_sample_periods
         super().convert_timing(waits)
-        pass
+        # Instructions not controlled by a pseudoclock are not quantised:
+        if self.pseudoclock is None:
+            return
+        timebase = self.pseudoclock.timebase
+        self.quantised_duration = quantise_instruction_durations(
+            self.duration, getattr(self, 'integer_duration', 0), timebase,
+            self.pseudoclock.integer_timebase).item()
+        self.quantised_sample_period = quantise_sample_periods(self.samplerate, timebase).item()
 
     def __str__(self):
         return formatobj(self, 'parent', 't', 'duration', 'function', 'samplerate')
@@ -41,7 +67,7 @@ class Constant(Function):
     def __init__(self, parent, t, value, _inst_depth=1, **kwargs):
         # A constant instruction is just a function instruction with no
         # duration and a zero sample rate:
-        super().__init__(parent, t, 0, _const(value), 0,
+        super().__init__(parent, t, 0, Const(value), 0,
                          _inst_depth=_inst_depth+1, **kwargs)
         self.value = value
 
@@ -49,6 +75,47 @@ class Constant(Function):
         return formatobj(self, 'parent', 't', 'value')
 
 
+def make_instructions(cls, parent, t, duration, functions, function_ids, samplerate,
+                      call_site=None):
+    """Create and add to their parent a number of Function or Constant
+    instructions at once, with the same attributes as if each had been
+    created individually, but without calling __init__, for use by
+    Output.functions() and Output.constants(). Arguments are as for
+    InstructionTable.extend(), except that call_site must already be in
+    the form of Instruction._call_site for the shot's traceback_capture
+    mode."""
+    shot = parent.shot
+    common = dict(parent=parent, shot=shot, pseudoclock=parent.pseudoclock, segment=None,
+                  relative_t=None, quantised_t=None, _call_site=call_site,
+                  quantised_duration=None, quantised_sample_period=None,
+                  evaluation_timepoints=None, values=None)
+    columns = {'t': t.tolist(), 'duration': duration.tolist(),
+               'samplerate': samplerate.tolist(), 'function_id': function_ids.tolist(),
+               'instruction_number': range(shot.total_instructions,
+                                           shot.total_instructions + len(t))}
+    if shot.timeline == 'integer':
+        columns['integer_t'] = to_integer_times(t, shot.epsilon).tolist()
+        columns['integer_duration'] = to_integer_times(duration, shot.epsilon).tolist()
+    if cls is Constant:
+        wrapped = [Const(value) for value in functions]
+    instructions = []
+    for row in zip(*columns.values()):
+        instruction = cls.__new__(cls)
+        instruction.__dict__.update(common)
+        instruction.__dict__.update(zip(columns, row))
+        function_id = instruction.__dict__.pop('function_id')
+        if cls is Constant:
+            instruction.value = functions[function_id]
+            instruction.function = wrapped[function_id]
+        else:
+            instruction.function = functions[function_id]
+        instructions.append(instruction)
+    parent.add_instructions(instructions)
+    enforce_phase.register_instances(instructions)
+    shot.total_instructions += len(instructions)
+    return instructions
+
+
 class Static(OutputInstruction):
     """An instruction for setting an unchanging output's value for the
     duration of the experiment"""
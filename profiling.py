@@ -0,0 +1,154 @@
+import threading
+import time
+import functools
+
+from enforce_phase import phase
+
+
+__all__ = ['ShotProfile']
+
+
+class ShotProfile(object):
+    """Statistics of where the time goes in compiling a shot, collected when
+    it is created with Shot(..., profile=True) and available as shot.profile.
+    The shot feeds it each phase transition, from which the wall and CPU
+    time of each phase are recorded, CPU time being that of the whole
+    process, including any threads of an executor passed to Shot.stop().
+    The ADD_INSTRUCTIONS phase includes the time spent in user code adding
+    instructions. Also recorded are the number of calls to and total time
+    spent in each method decorated with @enforce_phase, including __init__
+    methods, inclusive of any decorated methods it calls, the number of
+    call sites captured for instructions and the time spent capturing them,
+    and, when stop() begins, the number of devices and instructions
+    clocked by each pseudoclock. as_dict() returns all of these as a dict
+    of plain values suitable for logging or exporting as JSON.
+
+    When a shot is not being profiled, shot.profile is None and nothing is
+    recorded, at the cost of a check of that attribute per phase transition
+    and instruction. Whether to time calls to a decorated method is decided
+    when it is first bound to each instance, see
+    enforce_phase.PhaseEnforcedFunction.__get__, so later calls pay nothing
+    for it, other than those to __init__ methods, which are called before
+    the instance has a shot and so always pay for a check of shot.profile
+    and a call to time.perf_counter()."""
+
+    def __init__(self):
+        # {phase name: {'wall': seconds, 'cpu': seconds}}:
+        self.phases = {}
+        # {qualified method name: {'calls': int, 'time': seconds}}:
+        self.methods = {}
+        self.traceback_captures = 0
+        self.traceback_time = 0.0
+        # {pseudoclock name: {'devices': int, 'outputs': int, 'instructions': int}}:
+        self.pseudoclocks = {}
+        self._phase = None
+        self._phase_start = None
+        self._lock = threading.Lock()
+
+    def _end_phase(self):
+        if self._phase is None:
+            return
+        wall, cpu = self._phase_start
+        stats = self.phases.setdefault(self._phase.name, {'wall': 0.0, 'cpu': 0.0})
+        stats['wall'] += time.perf_counter() - wall
+        stats['cpu'] += time.process_time() - cpu
+        self._phase = None
+
+    def enter_phase(self, shot, new_phase):
+        """Record the end of the current phase, if any, and the start of a
+        new one. Called by Shot._set_phase()."""
+        self._end_phase()
+        if new_phase == phase.CONVERT_TIMING:
+            self.count_devices(shot)
+        self._phase = new_phase
+        self._phase_start = time.perf_counter(), time.process_time()
+
+    def finish(self):
+        """Record the end of the current phase. Called at the end of
+        Shot.stop()."""
+        self._end_phase()
+
+    def count_devices(self, shot):
+        """Record the number of devices, Outputs, and instructions of those
+        Outputs clocked by each of the shot's pseudoclocks"""
+        from bases import Output
+        counts = {pseudoclock: {'devices': 0, 'outputs': 0, 'instructions': 0}
+                  for pseudoclock in shot.all_pseudoclocks}
+        for device in shot.all_devices:
+            if device.pseudoclock not in counts or device is device.pseudoclock:
+                continue
+            pseudoclock_counts = counts[device.pseudoclock]
+            pseudoclock_counts['devices'] += 1
+            if isinstance(device, Output):
+                pseudoclock_counts['outputs'] += 1
+                pseudoclock_counts['instructions'] += len(device.instructions)
+        self.pseudoclocks = {pseudoclock.name: pseudoclock_counts
+                             for pseudoclock, pseudoclock_counts in counts.items()}
+
+    def timed(self, method, bound):
+        """Return a callable that calls a bound method decorated with
+        @enforce_phase, recording the time taken against the decorated
+        method"""
+        return functools.partial(self._timed_call, method, bound)
+
+    def _timed_call(self, method, bound, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return bound(*args, **kwargs)
+        finally:
+            self.record_call(method, time.perf_counter() - start)
+
+    def record_call(self, method, elapsed):
+        """Record a call to a method decorated with @enforce_phase that took
+        the given time in seconds"""
+        with self._lock:
+            stats = self.methods.setdefault(method.__qualname__, {'calls': 0, 'time': 0.0})
+            stats['calls'] += 1
+            stats['time'] += elapsed
+
+    def add_traceback_capture(self, elapsed):
+        """Record the capture of an instruction's call site"""
+        with self._lock:
+            self.traceback_captures += 1
+            self.traceback_time += elapsed
+
+    def as_dict(self):
+        """Return all statistics as a dict of dicts, lists and numbers"""
+        return {'phases': {name: dict(stats) for name, stats in self.phases.items()},
+                'methods': {name: dict(stats) for name, stats in self.methods.items()},
+                'traceback_captures': self.traceback_captures,
+                'traceback_time': self.traceback_time,
+                'pseudoclocks': {name: dict(counts)
+                                 for name, counts in self.pseudoclocks.items()}}
+
+    def __str__(self):
+        lines = ['phases:']
+        for name, stats in self.phases.items():
+            lines.append(f"  {name}: {1e3 * stats['wall']:.3f} ms wall, "
+                         f"{1e3 * stats['cpu']:.3f} ms cpu")
+        lines.append('methods:')
+        for name, stats in sorted(self.methods.items(), key=lambda item: -item[1]['time']):
+            lines.append(f"  {name}: {stats['calls']} calls, {1e3 * stats['time']:.3f} ms")
+        lines.append(f"traceback capture: {self.traceback_captures} captures, "
+                     f"{1e3 * self.traceback_time:.3f} ms")
+        lines.append('pseudoclocks:')
+        for name, counts in self.pseudoclocks.items():
+            lines.append(f"  {name}: {counts['devices']} devices, {counts['outputs']} outputs, "
+                         f"{counts['instructions']} instructions")
+        return '\n'.join(lines)
+
+    def __getstate__(self):
+        # The start times of the current phase are not meaningful in another
+        # process, so count the phase so far and restart it when unpickled:
+        current = self._phase
+        self._end_phase()
+        self._phase = current
+        self._phase_start = time.perf_counter(), time.process_time()
+        state = self.__dict__.copy()
+        del state['_lock'], state['_phase_start']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._phase_start = time.perf_counter(), time.process_time()
+        self._lock = threading.Lock()
@@ -1,27 +1,131 @@
-from bases import HasDevices, HasInstructions, phase
+import copy
+from concurrent.futures import wait
+
+import numpy as np
+
+from bases import HasParent, HasDevices, HasInstructions, phase
 from instructions import Wait
-from devices import PseudoclockDevice, StaticDevice, Pseudoclock
-from enforce_phase import enforce_phase
-from utils import formatobj, sort_by_time
+from devices import PseudoclockDevice, StaticDevice, Pseudoclock, ClockLine
+from enforce_phase import enforce_phase, PhaseRegistry, PHASE_ENFORCEMENT_MODES
+from utils import formatobj, sort_by_time, TRACEBACK_CAPTURE_MODES
+from hierarchy import HierarchyIndex
+from table import InstructionTable
+import timing
+from timing import TIMELINE_MODES
+import incremental
+import shotcache
+import clocking
+from sweep import shot_arrays
+from checks import InvalidInstructionsError
+from profiling import ShotProfile
 
 
 __all__ = ['Shot']
 
 
 class Shot(HasDevices, HasInstructions):
-    """Top level object for the compilation"""
+    """Top level object for the compilation.
+
+    Independent shots may be built and compiled concurrently in different
+    threads of one process. Everything a shot records while being compiled,
+    including its instruction count and the phase enforcer's records in
+    shot.phase_registry, is kept on the shot, so shots share no mutable
+    state and need no locks between them, and shots forked from the same
+    template only read from it. A single shot must only have devices and
+    instructions added to it by one thread at a time, though stop() may
+    use an executor to process its pseudoclocks in several threads."""
     allowed_instructions = [Wait]
     allowed_devices = [PseudoclockDevice, StaticDevice]
 
-    def __init__(self, name, epsilon, **kwargs):
+    def __init__(self, name, epsilon, traceback_capture='lazy',
+                 instruction_storage='objects', phase_enforcement='full',
+                 phase_check_interval=100, profile=False, timeline='float', **kwargs):
+        """traceback_capture determines how the call site of each instruction
+        is recorded for error reporting. 'lazy' (the default) records the
+        stack cheaply and formats it only if needed, 'full' formats it
+        immediately, and 'off' records nothing, which is fastest and suitable
+        for trusted production scripts.
+
+        instruction_storage determines how Outputs store their instructions.
+        'objects' (the default) creates an Instruction object for each
+        instruction, and 'columnar' stores them as rows of an
+        InstructionTable, which uses much less memory per instruction.
+
+        phase_enforcement determines how calls to methods decorated with
+        @enforce_phase are checked for this shot: 'full' (the default) checks
+        every call, 'sampled' checks only one in every phase_check_interval
+        calls except those to methods required to be called exactly once,
+        and 'off' checks nothing. How each method is bound is decided on its
+        first call on each instance and cached, so that in 'off' mode later
+        calls cost the same as those to undecorated methods, in 'full' mode
+        only the check itself, and in 'sampled' mode counting the call and
+        only occasionally the check. __init__ methods
+        always pay for the check of the mode. See
+        enforce_phase.PHASE_ENFORCEMENT_MODES.
+
+        If profile is True, statistics of the time spent in each phase and
+        in decorated methods are collected in self.profile, a
+        profiling.ShotProfile. Otherwise self.profile is None.
+
+        timeline determines how times are represented during processing.
+        'float' (the default) processes instruction times as floats in
+        seconds, and 'integer' converts them once, as instructions are
+        created, to integer numbers of epsilon, after which all arithmetic
+        and comparisons of times are exact. Timebases must then be
+        multiples of epsilon. See timing.TIMELINE_MODES."""
+        if traceback_capture not in TRACEBACK_CAPTURE_MODES:
+            msg = (f"traceback_capture must be one of {TRACEBACK_CAPTURE_MODES}, "
+                   f"not {traceback_capture!r}")
+            raise ValueError(msg)
+        if instruction_storage not in ('objects', 'columnar'):
+            msg = (f"instruction_storage must be 'objects' or 'columnar', "
+                   f"not {instruction_storage!r}")
+            raise ValueError(msg)
+        if phase_enforcement not in PHASE_ENFORCEMENT_MODES:
+            msg = (f"phase_enforcement must be one of {PHASE_ENFORCEMENT_MODES}, "
+                   f"not {phase_enforcement!r}")
+            raise ValueError(msg)
+        if timeline not in TIMELINE_MODES:
+            msg = f"timeline must be one of {TIMELINE_MODES}, not {timeline!r}"
+            raise ValueError(msg)
+        self.traceback_capture = traceback_capture
+        self.timeline = timeline
+        self.phase_enforcement = phase_enforcement
+        self.phase_check_interval = phase_check_interval
+        self.instruction_storage = instruction_storage
+        self.profile = ShotProfile() if profile else None
+        self.phase_registry = PhaseRegistry()
+        self.closed = False
         super().__init__(self, **kwargs)
         self.epsilon = epsilon
         self.name = name
         self.master_pseudoclock = None
+        self.hierarchy = None
         self.all_devices = None
         self.all_pseudoclocks = None
+        self.all_clocklines = None
         self.total_instructions = 0
 
+        # Devices whose results are reused from a previous shot during stop(),
+        # mapped to the corresponding devices of the previous shot, and the
+        # names of those devices:
+        self.reuse = {}
+        self.reused_devices = []
+
+        # The results of this shot as returned by sweep.shot_arrays(), if
+        # they were found in a ShotCache by stop(), in which case they are
+        # not stored on the devices and instructions:
+        self.cached_arrays = None
+
+        # Whether stop() compacted the ticks of ClockLines, and if so, the
+        # statistics of each, by name, see ClockLine.compact_ticks():
+        self.compacted = False
+        self.compaction = {}
+
+        # Whether this shot is a template that can be forked, but not have
+        # instructions added to it:
+        self.frozen = False
+
         # For our child devices looking to inherit shot and pseudoclock from
         # their parent:
         self.shot = self
@@ -42,6 +146,11 @@ class Shot(HasDevices, HasInstructions):
         super().add_device(device)
 
     def _set_phase(self, phase):
+        if self.closed:
+            msg = "Cannot continue compiling a closed shot"
+            raise RuntimeError(msg)
+        if self.profile is not None:
+            self.profile.enter_phase(self, phase)
         if self.phase is not None:
             # Check that all required methods were called in the previous phase:
             enforce_phase.check_required_methods_called(self.shot, self.phase)
@@ -49,9 +158,14 @@ class Shot(HasDevices, HasInstructions):
         self.phase = phase
 
     def start(self):
+        # The device hierarchy is now complete. Index it so that devices can
+        # look up their descendants without recursing:
+        self.hierarchy = HierarchyIndex(self)
+
         # Populate lists of devices:
         self.all_devices = self.descendant_devices(recurse_into_pseudoclocks=True)
-        self.all_pseudoclocks = [d for d in self.all_devices if isinstance(d, Pseudoclock)]
+        self.all_pseudoclocks = self.descendant_devices_of_type(Pseudoclock, True)
+        self.all_clocklines = self.descendant_devices_of_type(ClockLine, True)
 
         # Have devices compute the limitations common to their children
         self._set_phase(phase.ESTABLISH_COMMON_LIMITS)
@@ -68,15 +182,167 @@ class Shot(HasDevices, HasInstructions):
         # TODO: return max delay? Maybe only max delay of pseudoclocks that didn't have
         # an initial trigger time other than minimum set.
 
+    def freeze(self):
+        """Make this shot a template from which shots can be made with
+        fork(). Must be called after start() and before any instructions
+        have been added. Instructions cannot be added to a frozen shot."""
+        if self.phase != phase.ADD_INSTRUCTIONS or self.total_instructions:
+            msg = "Can only freeze a shot after start() and before adding instructions"
+            raise RuntimeError(msg)
+        self.frozen = True
+
+    def fork(self, name=None):
+        """Return a new shot with the same device hierarchy as this frozen
+        shot, ready for instructions to be added to it, without repeating
+        the construction of the hierarchy or the work done in start(). Each
+        device is copied, along with any lists, tuples, sets, dicts and
+        arrays among its attributes, so that modifying them in one shot does
+        not affect this shot or other forks, with references to devices in
+        them replaced by the devices' copies. Attributes of other types are
+        shared, and instructions are fresh and empty. The new shot has this
+        shot's name unless one is given."""
+        if not self.frozen:
+            msg = "Can only fork a frozen shot. Call freeze() first"
+            raise RuntimeError(msg)
+        if self.closed:
+            msg = "Cannot fork a closed shot"
+            raise RuntimeError(msg)
+        # Not copy.copy(), which would share the shot's phase registry.
+        # Attributes are set below:
+        mapping = {device: object.__new__(type(device)) for device in self.hierarchy.devices}
+
+        def remap(value):
+            # Containers are copied, keeping subclasses such as defaultdict:
+            if isinstance(value, HasParent):
+                return mapping.get(value, value)
+            elif isinstance(value, list):
+                copied = copy.copy(value)
+                copied[:] = [remap(item) for item in value]
+                return copied
+            elif isinstance(value, dict):
+                copied = copy.copy(value)
+                copied.clear()
+                copied.update((remap(key), remap(item)) for key, item in value.items())
+                return copied
+            elif isinstance(value, set):
+                copied = copy.copy(value)
+                copied.clear()
+                copied.update(remap(item) for item in value)
+                return copied
+            elif type(value) in (tuple, frozenset):
+                return type(value)(remap(item) for item in value)
+            elif isinstance(value, np.ndarray):
+                return value.copy()
+            return value
+
+        for original, new in mapping.items():
+            for attr, value in enforce_phase.instance_state(original).items():
+                setattr(new, attr, remap(value))
+        shot = mapping[self]
+        shot.name = self.name if name is None else name
+        shot.frozen = False
+        shot.total_instructions = 0
+        shot.hierarchy = self.hierarchy.remap(mapping)
+        shot.phase_registry = PhaseRegistry()
+        if self.profile is not None:
+            shot.profile = ShotProfile()
+            shot.profile.enter_phase(shot, shot.phase)
+        enforce_phase.register_copies(self, mapping)
+        for original, new in mapping.items():
+            if isinstance(original.instructions if isinstance(original, HasInstructions)
+                          else None, InstructionTable):
+                new.instructions = InstructionTable(new)
+            elif isinstance(new, HasInstructions):
+                new.instructions = []
+        return shot
+
     def establish_common_limits(self):
         super().establish_common_limits()
         # TODO: determine nominal_wait_delay from pseudoclocks.
 
     def wait(self, t, name, _inst_depth=1):
+        # Each wait ends a segment, so two at the same time would leave their
+        # segments ambiguous. In the integer timeline, times are compared
+        # once converted to integers, as they are processed:
+        if self.timeline == 'integer':
+            integer_t = timing.to_integer_time(t, self.epsilon)
+            existing = [wait for wait in self.instructions if wait.integer_t == integer_t]
+        else:
+            existing = [wait for wait in self.instructions if wait.t == t]
+        if existing:
+            msg = (f"Cannot add wait {name!r} at t={t}: wait {existing[0].name!r} "
+                   f"is already at that time")
+            raise ValueError(msg)
         Wait(self, t, name, _inst_depth=_inst_depth+1)
         # TODO: triggers
 
-    def stop(self, t):
+    def stop(self, t, executor=None, chunk_size=None, sink=None, previous=None,
+             ramp_cache=None, cache=None, compact=False):
+        """Process all instructions. Each pseudoclock's instructions and
+        devices are independent once the waits are known, so if an executor
+        (a concurrent.futures.Executor sharing memory with this process, such
+        as a ThreadPoolExecutor) is given, the work of each phase is done for
+        all pseudoclocks concurrently in it, with each phase finishing for all
+        pseudoclocks before the next begins. Most of the work is in NumPy,
+        which releases the GIL.
+
+        If chunk_size is given, functions are evaluated and clock ticks
+        generated in chunks of at most about that many samples per Output,
+        which are streamed through tick generation and passed to
+        sink.append(device, name, array) if a sink is given, rather than
+        being stored on instructions and devices, so that peak memory use
+        depends on the chunk size rather than on the lengths of ramps. See
+        ClockLine.generate_ticks() and Pseudoclock.generate_ticks() for what
+        is passed to the sink, which must be thread-safe if an executor is
+        also given.
+
+        If previous is given, it must be a shot with the same devices, such
+        as one forked from the same template, which has been stopped without
+        chunking and is still alive. The converted timing and evaluated
+        values of each Output whose instructions are the same as those of
+        the Output of the same name in the previous shot are reused instead
+        of being computed again, as are the clock ticks of ClockLines whose
+        Outputs all have their results reused, and of Pseudoclocks whose
+        ClockLines all do, see incremental.match_previous(). Functions are
+        compared by identity, so they should not be modified between shots.
+        The names of the devices whose results were reused are stored in
+        self.reused_devices.
+
+        If ramp_cache, an evaluation.RampCache, is given, the values of
+        Function instructions are looked up in it and added to it, so that
+        ramps repeated within the shot or across shots sharing the cache are
+        evaluated only once. It is not used if chunk_size is given.
+
+        If cache, a shotcache.ShotCache, is given, the shot's results are
+        looked up in it by shotcache.shot_digest(). If found, nothing is
+        processed: the shot moves straight to its final phase, and its
+        results are stored in self.cached_arrays, from which
+        sweep.shot_arrays() returns them, rather than on its devices and
+        instructions. Otherwise the shot is processed and its results added
+        to the cache. Cannot be used with chunk_size.
+
+        If compact is True, each ClockLine drops the ticks at which none of
+        its Outputs change value, and stores the values of each Output at
+        the remaining ticks run-length encoded, see ClockLine.compact_ticks().
+        The statistics of each ClockLine's compaction are stored in
+        self.compaction, by name. Cannot be used with chunk_size, and if
+        previous is given, it must have been stopped with the same setting."""
+        if self.frozen:
+            msg = "Cannot stop a frozen shot. Use shot.fork()"
+            raise RuntimeError(msg)
+        if previous is not None and chunk_size is not None:
+            msg = "Cannot reuse the results of a previous shot when evaluating in chunks"
+            raise ValueError(msg)
+        if cache is not None and chunk_size is not None:
+            msg = "Cannot cache the results of a shot when evaluating in chunks"
+            raise ValueError(msg)
+        if compact and chunk_size is not None:
+            msg = "Cannot compact clock ticks when evaluating in chunks"
+            raise ValueError(msg)
+        if previous is not None and previous.compacted != compact:
+            msg = (f"Cannot reuse the results of a previous shot stopped with "
+                   f"compact={previous.compacted}")
+            raise ValueError(msg)
 
         # TODO: add stop instruction?
 
@@ -85,23 +351,137 @@ class Shot(HasDevices, HasInstructions):
         # convert_timing() calls?
         sort_by_time(self.instructions)
 
+        digest = None
+        if cache is not None and self.phase == phase.ADD_INSTRUCTIONS and not self.closed:
+            digest = shotcache.shot_digest(self, t, compact)
+            if digest is not None:
+                self.cached_arrays = cache.get(digest)
+            if self.cached_arrays is not None:
+                # Nothing is processed, so the checks that required methods
+                # were called in each phase are skipped along with it:
+                self.phase = phase.GENERATE_CLOCK_TICKS
+                self.compacted = compact
+                if compact:
+                    self.compaction = {
+                        clockline.name: clocking.compaction_stats(
+                            *self.cached_arrays[f'{clockline.name}/compaction'].tolist())
+                        for clockline in self.all_clocklines}
+                if self.profile is not None:
+                    self.profile.finish()
+                return
+
+        if previous is not None:
+            self.reuse = incremental.match_previous(self, previous,
+                                                    timing.wait_times(self.instructions))
+            self.reused_devices = [device.name for device in self.reuse]
+        try:
+            self._stop(executor, chunk_size, sink, ramp_cache, compact)
+            if digest is not None:
+                cache.put(digest, shot_arrays(self))
+        finally:
+            # Don't keep the previous shot alive:
+            self.reuse = {}
+            if self.profile is not None:
+                self.profile.finish()
+
+    def _stop(self, executor, chunk_size, sink, ramp_cache, compact):
         self._set_phase(phase.CONVERT_TIMING)
-        # TODO tell all instructions to convert their timing
-        self.convert_timing(self.instructions)
+        self.convert_timing(self.instructions, executor)
 
         self._set_phase(phase.CHECK_INSTRUCTIONS_VALID)
-        # Todo call the recursive methods that check validity of instructions at each level
-
-        
-        
-        # TODO: Tell all instructions to quantise and relativise their times 
-        # TODO Error check upward. First on all instructions, then on parent devices upward one
-        # layer at a time. Each layer should do the error checks that are most appropriate for that
-        # level.
-        
-    def convert_timing(self, waits):
-        for instruction in self.descendant_instructions(recurse_into_pseudoclocks=True):
+        if self.timeline == 'integer':
+            wait_times = timing.integer_wait_times(self.instructions)
+        else:
+            wait_times = timing.wait_times(self.instructions)
+
+        def check_instructions_valid(pseudoclock):
+            violations = []
+            for clockline in pseudoclock.descendant_devices_of_type(ClockLine):
+                violations.extend(clockline.check_instructions_valid(wait_times, chunk_size))
+            return violations
+
+        violations = []
+        for pseudoclock_violations in self._map_pseudoclocks(check_instructions_valid,
+                                                             executor):
+            violations.extend(pseudoclock_violations)
+        if violations:
+            violations.sort(key=lambda violation: violation[0].instruction_number)
+            raise InvalidInstructionsError(violations)
+        # TODO: Error check upward from the clocklines, on parent devices one layer at
+        # a time, each layer doing the error checks most appropriate for that level.
+
+        self._set_phase(phase.EVALUATE_FUNCTIONS)
+
+        def evaluate_functions(pseudoclock):
+            for clockline in pseudoclock.descendant_devices_of_type(ClockLine):
+                clockline.evaluate_functions(chunk_size, ramp_cache)
+
+        self._map_pseudoclocks(evaluate_functions, executor)
+
+        self._set_phase(phase.GENERATE_CLOCK_TICKS)
+
+        def generate_ticks(pseudoclock):
+            for clockline in pseudoclock.descendant_devices_of_type(ClockLine):
+                clockline.generate_ticks(sink, compact)
+            pseudoclock.generate_ticks(sink)
+
+        self._map_pseudoclocks(generate_ticks, executor)
+        self.compacted = compact
+        if compact:
+            self.compaction = {clockline.name: clockline.compaction
+                               for clockline in self.all_clocklines}
+
+    def _map_pseudoclocks(self, function, executor=None):
+        """Call function(pseudoclock) for each of the shot's pseudoclocks,
+        concurrently in the executor if one is given, and return a list of
+        the results. If any call raises an exception, the one for the
+        earliest pseudoclock is raised once all calls have finished."""
+        if executor is None:
+            return [function(pseudoclock) for pseudoclock in self.all_pseudoclocks]
+        futures = [executor.submit(function, pseudoclock)
+                   for pseudoclock in self.all_pseudoclocks]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def convert_timing(self, waits, executor=None):
+        for instruction in self.instructions:
             instruction.convert_timing(waits)
 
+        # Convert all instructions under each pseudoclock at once, other than
+        # those whose timing is reused from a previous shot:
+        def convert_timing(pseudoclock):
+            outputs = pseudoclock.descendant_devices_of_type(HasInstructions)
+            timing.convert_timing([output for output in outputs if output not in self.reuse],
+                                  waits, pseudoclock.timebase, pseudoclock.integer_timebase,
+                                  self.epsilon)
+            for output in outputs:
+                if output in self.reuse:
+                    incremental.reuse_timing(output, self.reuse[output])
+
+        self._map_pseudoclocks(convert_timing, executor)
+        # Instructions not under any pseudoclock, i.e. those of static
+        # devices:
+        for device in self.descendant_devices_of_type(HasInstructions):
+            for instruction in device.instructions:
+                instruction.convert_timing(waits)
+
+    def close(self):
+        """Release the phase enforcer's records of this shot's instances and
+        anything else kept only for compiling it, leaving its results
+        readable. A closed shot cannot be compiled further. Shots are also
+        context managers that close on exit. Without closing, this state is
+        released only when the shot is garbage collected, which as the
+        shot's objects refer to each other in cycles, is not until Python's
+        cyclic garbage collector next runs."""
+        self.phase_registry.clear()
+        self.reuse = {}
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __str__(self):
         return formatobj(self, 'name')
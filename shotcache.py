@@ -0,0 +1,323 @@
+import os
+import dis
+import types
+import pickle
+import marshal
+import hashlib
+import threading
+import functools
+
+import numpy as np
+
+from bases import HasParent
+from enforce_phase import enforce_phase
+from table import InstructionTable, InstructionColumns
+from shotfile import ShotFile, ShotFileWriter
+import timing
+
+
+__all__ = ['CACHE_VERSION', 'shot_digest', 'ShotCache']
+
+
+# Included in every digest. Must be incremented whenever a change to this
+# package changes the results of compiling a shot, so that results cached by
+# earlier versions are not used:
+CACHE_VERSION = 2
+
+# Types of device attributes and globals read by functions included in the
+# digest of a shot by value:
+_scalar_types = (bool, int, float, str, bytes, type(None), np.integer, np.floating)
+
+# Types of globals read by functions that are included in the digest by name,
+# as pickled:
+_named_types = (type, types.FunctionType, types.BuiltinFunctionType, np.ufunc)
+
+
+class _Uncacheable(Exception):
+    # Raised when a shot cannot be digested
+    pass
+
+
+def _qualified_name(cls):
+    return f'{cls.__module__}.{cls.__qualname__}'
+
+
+@functools.lru_cache(maxsize=1024)
+def _global_names(code):
+    # The names of the globals and builtins read by a code object, including
+    # in code nested within it such as comprehensions:
+    names = {instruction.argval for instruction in dis.get_instructions(code)
+             if instruction.opname in ('LOAD_GLOBAL', 'LOAD_NAME')}
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return frozenset(names)
+
+
+def _global_key(value):
+    # A key identifying the value of a global read by a function: modules by
+    # name, numbers and strings by value, and functions and classes by
+    # pickle, which is by name, plus their code if written in Python. Raise
+    # _Uncacheable for any other value, such as a list or dict that might be
+    # modified between shots:
+    if isinstance(value, types.ModuleType):
+        return value.__name__.encode('utf8')
+    if not isinstance(value, _scalar_types + _named_types):
+        raise _Uncacheable
+    try:
+        key = pickle.dumps(value, protocol=4)
+    except Exception:
+        raise _Uncacheable
+    code = getattr(value, '__code__', None)
+    if code is not None:
+        key += marshal.dumps(code)
+    return key
+
+
+def _function_key(function):
+    # A key identifying a function, or the value of a Constant, across
+    # processes: its pickle, which for functions and classes is by name, plus
+    # the code of the function or of its class's __call__() method if written
+    # in Python, so that editing it changes the key, plus the values of the
+    # globals that code reads, see _global_key(). Raise _Uncacheable if it
+    # cannot be pickled, as is the case for lambdas and closures, or reads a
+    # global that cannot be given a key.
+    try:
+        key = pickle.dumps(function, protocol=4)
+    except Exception:
+        raise _Uncacheable
+    if hasattr(function, '__code__'):
+        code_function = function
+    else:
+        code_function = getattr(type(function), '__call__', None)
+    code = getattr(code_function, '__code__', None)
+    if code is not None:
+        key += marshal.dumps(code)
+        function_globals = code_function.__globals__
+        for name in sorted(_global_names(code)):
+            # Names not in the function's globals are builtins:
+            if name in function_globals:
+                global_key = _global_key(function_globals[name])
+                key += name.encode('utf8') + len(global_key).to_bytes(8, 'little') + global_key
+    return key
+
+
+def _attribute_key(value):
+    # A representation of the value of a device attribute for the digest,
+    # with devices identified by name. Raise _Uncacheable if it is not a
+    # number, string, None, device, array, or list, tuple or dict of them:
+    if isinstance(value, _scalar_types):
+        return value
+    elif isinstance(value, HasParent):
+        return ('device', value.name)
+    elif isinstance(value, (list, tuple)):
+        return (type(value).__name__, [_attribute_key(item) for item in value])
+    elif isinstance(value, dict):
+        return ('dict', sorted((repr(_attribute_key(key)), _attribute_key(item))
+                               for key, item in value.items()))
+    elif isinstance(value, np.ndarray) and value.dtype.kind in 'biuf':
+        return ('array', value.dtype.str, value.shape, value.tobytes())
+    raise _Uncacheable
+
+
+def shot_digest(shot, stop_time, compact=False):
+    """Return a hex digest of everything the results of stopping a started
+    shot with instructions at the given time, with or without compacting
+    its clock ticks, depend on, for use as the key
+    of a ShotCache: the classes, names and parents of its devices, and all
+    their attributes, such as connections and limits like
+    clock_minimum_period, timebase, wait_delay and minimum_trigger, the
+    shot's epsilon and timeline mode, the times and names of waits, and the
+    times, durations, sample rates and functions of all Function
+    instructions and the values of all Constants, and CACHE_VERSION and the
+    NumPy version. Functions are identified by their pickle, the code of
+    their body, and the values of the globals it reads, but not by any other
+    code they call or the globals that code reads. Return None if the shot
+    cannot be digested: if it has a function that cannot be pickled, or
+    that reads a global other than a module, number, string, function or
+    class, or a device with an attribute other than a number, string, None,
+    device, array, or list, tuple or dict of them, or instructions other
+    than Functions, Constants and Waits, or whose class reimplements
+    convert_timing(). The digest does not depend on the shot's name or
+    instruction storage, which do not affect the results."""
+    try:
+        return _shot_digest(shot, stop_time, compact)
+    except _Uncacheable:
+        return None
+
+
+def _shot_digest(shot, stop_time, compact):
+    from instructions import Function, Wait
+    digest = hashlib.sha256()
+
+    def update(*values):
+        digest.update(repr(values).encode('utf8'))
+        digest.update(b'\x00')
+
+    update(CACHE_VERSION, np.__version__, shot.epsilon, shot.timeline, float(stop_time),
+           bool(compact))
+    for wait in sorted(shot.instructions, key=lambda wait: wait.t):
+        if type(wait) is not Wait:
+            raise _Uncacheable
+        update(wait.t, wait.name)
+
+    outputs = []
+    for device in shot.hierarchy.devices[1:]:
+        attrs = sorted((name, _attribute_key(value))
+                       for name, value in enforce_phase.instance_state(device).items()
+                       if name not in ('parent', 'shot', 'instructions')
+                       and not name.startswith('_'))
+        parent = None if device.parent is shot else device.parent.name
+        update(_qualified_name(type(device)), parent, attrs)
+        instructions = getattr(device, 'instructions', None)
+        if isinstance(instructions, InstructionTable):
+            outputs.append(device)
+        elif instructions is not None:
+            for instruction in instructions:
+                if (not isinstance(instruction, Function)
+                        or not timing._is_batchable(type(instruction))):
+                    raise _Uncacheable
+            outputs.append(device)
+
+    # The instructions of all outputs as columns, from Instruction objects
+    # first, then from InstructionTables:
+    names = ['t', 'duration', 'samplerate', 'is_constant']
+    columns = InstructionColumns(outputs, names)
+    outputs.sort(key=lambda output: isinstance(output.instructions, InstructionTable))
+    update([(output.name, len(output.instructions)) for output in outputs])
+    for name in names:
+        digest.update(columns.columns[name].tobytes())
+    # Constant values that can be stored in an InstructionTable's value
+    # column are digested as an array, and only functions and other values
+    # are pickled:
+    values, value_types, function_ids, functions = columns.value_columns()
+    digest.update(values.tobytes())
+    digest.update(value_types.tobytes())
+    # Identify functions by key rather than identity, so that equal
+    # functions that are distinct objects do not change the digest:
+    keys = {}
+    key_ids = [keys.setdefault(_function_key(function), len(keys)) for function in functions]
+    # Number the keys in order of the first row using each, as the order of
+    # the list of functions differs between instruction storages:
+    has_function = function_ids != -1
+    row_keys = np.array(key_ids, dtype=np.int64)[function_ids[has_function]]
+    distinct, first, inverse = np.unique(row_keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    row_ranks = np.full(len(function_ids), -1, dtype=np.int64)
+    row_ranks[has_function] = ranks[inverse.reshape(-1)]
+    digest.update(row_ranks.tobytes())
+    keys = list(keys)
+    for key_id in distinct[order].tolist():
+        digest.update(len(keys[key_id]).to_bytes(8, 'little'))
+        digest.update(keys[key_id])
+    return digest.hexdigest()
+
+
+class ShotCache(object):
+    """A cache of the results of compiling shots, as returned by
+    sweep.shot_arrays(), stored as shot files in a directory, keyed by the
+    digests returned by shot_digest(). Passed to Shot.stop(cache=...), a
+    shot whose results are in the cache is not processed at all. When the
+    files in the directory total more than max_bytes, those least recently
+    used are removed. The directory may be shared by multiple threads and
+    processes, and persists between them. Statistics of use by this
+    instance are in the hits, misses and evictions attributes, and returned
+    by stats(). Those of copies made by pickling, as in
+    sweep.compile_shots(), are not included."""
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def path(self, digest):
+        """Return the path of the shot file for the given digest"""
+        return os.path.join(self.directory, f'{digest}.shot')
+
+    def get(self, digest):
+        """Return the cached results for the digest as a dict of arrays, or
+        None if not present"""
+        path = self.path(digest)
+        try:
+            shot_file = ShotFile(path)
+            arrays = {name: np.array(shot_file[name]) for name in shot_file.keys()}
+            # Mark as recently used:
+            os.utime(path)
+        except FileNotFoundError:
+            # Including if evicted by another process after being opened:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arrays
+
+    def put(self, digest, arrays):
+        """Add the results of a shot to the cache, and remove the least
+        recently used entries until the cache is within its size limit"""
+        with ShotFileWriter(self.path(digest)) as writer:
+            for name, array in arrays.items():
+                writer.append_array(name, array)
+        self.evict()
+
+    def _entries(self):
+        # [(mtime, size, path)] of all the shot files in the directory:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.shot'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within
+        its size limit"""
+        entries = sorted(self._entries())
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.evictions += 1
+            nbytes -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return a dict of the number of hits, misses and evictions so far,
+        and the current number of entries and their total size in bytes"""
+        entries = self._entries()
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(entries), 'nbytes': sum(size for _, size, _ in entries)}
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
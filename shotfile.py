@@ -0,0 +1,179 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+
+__all__ = ['ShotFileWriter', 'ShotFile', 'write_shot_file']
+
+
+# Format of a shot file: the 8 byte MAGIC, then the length of the header as
+# a little-endian uint64, then the header, which is JSON in UTF-8 of the form
+# {"version": 1, "arrays": {name: {"dtype": str, "offset": int, "length": int}}},
+# then the arrays, each contiguous, starting at the given byte offsets from
+# the start of the file, which are multiples of ALIGNMENT. Array names are
+# as returned by sweep.shot_arrays(): '<device name>/<name>'.
+MAGIC = b'LSCSHOT\x00'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _copy(source, destination, nbytes, buffer_size=2**20):
+    # Copy nbytes from the current position of one file to another, a
+    # bounded amount at a time:
+    while nbytes:
+        data = source.read(min(nbytes, buffer_size))
+        destination.write(data)
+        nbytes -= len(data)
+
+
+class ShotFileWriter(object):
+    """Write a shot file incrementally, as a sink for Shot.stop(chunk_size=...,
+    sink=writer) or by calling append() directly. Chunks of all arrays are
+    written to a single temporary spool file as they arrive, with the
+    position of each recorded, so that nothing is held in memory and only
+    one file is open however many arrays there are, and close() assembles
+    them into the shot file. The file appears at the given path only once
+    close() succeeds. Can be used as a context manager, in which case the
+    file is not written if an exception is raised. append() may be called
+    from multiple threads."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._tempdir = tempfile.mkdtemp(prefix='.shotfile-', dir=os.path.dirname(self.path))
+        self._spool = open(os.path.join(self._tempdir, 'spool'), 'w+b')
+        self._spool_size = 0
+        # {name: (dtype, length, [(spool offset, nbytes) of each chunk])}:
+        self._arrays = {}
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def append(self, device, name, array):
+        """Append a chunk to the array '<device name>/<name>'. All chunks of
+        an array must have the same dtype."""
+        self.append_array(f'{device.name}/{name}', array)
+
+    def append_array(self, name, array):
+        """Append a chunk to the named array"""
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            if self.closed:
+                raise ValueError(f"Cannot append to closed {self.__class__.__name__}")
+            try:
+                dtype, length, chunks = self._arrays[name]
+            except KeyError:
+                dtype, length, chunks = array.dtype, 0, []
+            if array.dtype != dtype:
+                msg = f"Chunk of {name} has dtype {array.dtype}, expected {dtype}"
+                raise TypeError(msg)
+            self._spool.write(array.data)
+            chunks.append((self._spool_size, array.nbytes))
+            self._spool_size += array.nbytes
+            self._arrays[name] = dtype, length + len(array), chunks
+
+    def close(self):
+        """Write the shot file and remove the temporary files"""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            self._spool.flush()
+            # The header's length depends on the offsets, which depend on the
+            # header's length. Iterate until they agree:
+            header_length = 0
+            while True:
+                offset = _aligned(len(MAGIC) + 8 + header_length)
+                arrays = {}
+                for name, (dtype, length, _) in self._arrays.items():
+                    arrays[name] = {'dtype': dtype.str, 'offset': offset, 'length': length}
+                    offset = _aligned(offset + length * dtype.itemsize)
+                header = json.dumps({'version': VERSION, 'arrays': arrays}).encode('utf8')
+                if len(header) == header_length:
+                    break
+                header_length = len(header)
+            temp_path = os.path.join(self._tempdir, 'shot')
+            with open(temp_path, 'wb') as f:
+                f.write(MAGIC)
+                f.write(len(header).to_bytes(8, 'little'))
+                f.write(header)
+                for name, (_, _, chunks) in self._arrays.items():
+                    f.seek(arrays[name]['offset'])
+                    for start, nbytes in chunks:
+                        self._spool.seek(start)
+                        _copy(self._spool, f, nbytes)
+                f.truncate(offset)
+            os.replace(temp_path, self.path)
+        finally:
+            self._spool.close()
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+
+    def discard(self):
+        """Remove the temporary files without writing the shot file"""
+        with self._lock:
+            self.closed = True
+        self._spool.close()
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def write_shot_file(path, shot):
+    """Write the results of a shot that has been stopped without streaming
+    to a shot file"""
+    from sweep import shot_arrays
+    with ShotFileWriter(path) as writer:
+        for name, array in shot_arrays(shot).items():
+            writer.append_array(name, array)
+
+
+class ShotFile(object):
+    """Read a shot file. Indexing with an array name returns a read-only
+    np.memmap of it, so that the data is only read from disk as it is
+    accessed, and is not copied."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a shot file")
+            header_length = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_length).decode('utf8'))
+        if header['version'] != VERSION:
+            raise ValueError(f"Unsupported shot file version {header['version']}")
+        self.arrays = header['arrays']
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        info = self.arrays[name]
+        if not info['length']:
+            return np.zeros(0, dtype=info['dtype'])
+        return np.memmap(self.path, dtype=info['dtype'], mode='r', offset=info['offset'],
+                         shape=(info['length'],))
+
+    def device_arrays(self, device_name):
+        """Return a dict of all the arrays of the given device, keyed by
+        name without the device name"""
+        prefix = f'{device_name}/'
+        return {name[len(prefix):]: self[name] for name in self.arrays
+                if name.startswith(prefix)}
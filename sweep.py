@@ -0,0 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bases import Output
+from table import InstructionTable
+
+
+__all__ = ['shot_arrays', 'compile_shots']
+
+
+def _output_values(output):
+    # The segments, timepoints and values of all the evaluated instructions
+    # of an output, sorted by segment and time:
+    instructions = output.instructions
+    if isinstance(instructions, InstructionTable):
+        if instructions.value_offsets is None:
+            segments = timepoints = np.zeros(0, dtype=np.int64)
+            values = np.zeros(0, dtype=float)
+        else:
+            n_samples = np.diff(instructions.value_offsets)
+            segments = np.repeat(instructions.column('segment'), n_samples)
+            timepoints = instructions.evaluation_timepoints
+            values = instructions.values
+    else:
+        evaluated = [instruction for instruction in instructions
+                     if getattr(instruction, 'values', None) is not None]
+        empty = np.zeros(0, dtype=np.int64)
+        segments = np.concatenate([empty] + [np.full(len(instruction.values),
+                                                     instruction.segment, dtype=np.int64)
+                                             for instruction in evaluated])
+        timepoints = np.concatenate([empty] + [instruction.evaluation_timepoints
+                                               for instruction in evaluated])
+        values = np.concatenate([np.zeros(0, dtype=float)]
+                                + [instruction.values for instruction in evaluated])
+    order = np.lexsort((timepoints, segments))
+    return segments[order], timepoints[order], values[order]
+
+
+def shot_arrays(shot):
+    """Return the results of compiling a shot, which must have been
+    stopped, as a flat dict of NumPy arrays keyed by '<device name>/<name>'.
+    For each Pseudoclock, 'tick_segments' and 'ticks' are the segment and
+    quantised time of each of its clock ticks. For each ClockLine,
+    'tick_indices' are the indices into its pseudoclock's ticks at which it
+    ticks. For each Output under a ClockLine, 'segments', 'timepoints' and
+    'values' are the segment, quantised time and value of each of its
+    evaluated samples, sorted by segment and time. If the shot was stopped
+    with compact=True, each ClockLine also has 'compaction', the numbers of
+    ticks before and after compaction, values and runs, as passed to
+    clocking.compaction_stats(), and each of its Outputs 'run_values' and
+    'run_lengths', its values at the ClockLine's ticks, run-length encoded.
+    This is much more compact
+    than the shot itself, for example to return from another process. If
+    the results were found in a ShotCache, they are returned from there."""
+    if shot.cached_arrays is not None:
+        return dict(shot.cached_arrays)
+    arrays = {}
+    for pseudoclock in shot.all_pseudoclocks:
+        arrays[f'{pseudoclock.name}/tick_segments'] = pseudoclock.tick_segments
+        arrays[f'{pseudoclock.name}/ticks'] = pseudoclock.ticks
+        for clockline, indices in pseudoclock.clockline_ticks.items():
+            arrays[f'{clockline.name}/tick_indices'] = indices
+    for clockline in shot.all_clocklines:
+        if clockline.compaction is not None:
+            stats = clockline.compaction
+            arrays[f'{clockline.name}/compaction'] = np.array(
+                [stats['ticks'], stats['compacted_ticks'], stats['values'], stats['runs']],
+                dtype=np.int64)
+        for output in clockline.descendant_devices_of_type(Output):
+            segments, timepoints, values = _output_values(output)
+            arrays[f'{output.name}/segments'] = segments
+            arrays[f'{output.name}/timepoints'] = timepoints
+            arrays[f'{output.name}/values'] = values
+            if output.run_values is not None:
+                arrays[f'{output.name}/run_values'] = output.run_values
+                arrays[f'{output.name}/run_lengths'] = output.run_lengths
+    return arrays
+
+
+def _compile(shot, stop_time):
+    shot.stop(stop_time)
+    return shot_arrays(shot)
+
+
+def compile_shots(shots, stop_times, max_workers=None, cache=None):
+    """Compile a number of shots in parallel in a pool of worker processes,
+    returning a list of the results of each as returned by shot_arrays(), in
+    the same order as the shots. Each shot must have been started and had
+    all its instructions added, for example having been made with
+    Shot.fork(), and is stopped at the corresponding time in stop_times, or
+    at stop_times if it is a single number. Shots are pickled to send them
+    to the workers, so the functions of all their Function instructions must
+    be picklable, such as those in the functions module or any module-level
+    function, but not lambdas or closures. The shots in this process are not
+    modified. If compiling a shot raises an exception, it is raised here.
+
+    If cache, a shotcache.ShotCache, is given, shots whose results are in it
+    are not sent to the workers, and the results of the others are added
+    to it."""
+    from shotcache import shot_digest
+    shots = list(shots)
+    if np.ndim(stop_times) == 0:
+        stop_times = [stop_times] * len(shots)
+    results = [None] * len(shots)
+    digests = [None] * len(shots)
+    if cache is not None:
+        for i, (shot, stop_time) in enumerate(zip(shots, stop_times)):
+            digests[i] = shot_digest(shot, stop_time)
+            if digests[i] is not None:
+                results[i] = cache.get(digests[i])
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        with ProcessPoolExecutor(max_workers) as executor:
+            compiled = executor.map(_compile, [shots[i] for i in misses],
+                                    [stop_times[i] for i in misses])
+            for i, result in zip(misses, compiled):
+                results[i] = result
+                if digests[i] is not None:
+                    cache.put(digests[i], result)
+    return results
@@ -0,0 +1,550 @@
+import time
+
+import numpy as np
+
+from bases import HasParent, phase
+from enforce_phase import enforce_phase
+from utils import capture_call_site, formatobj
+from functions import Const
+from timing import to_integer_time, to_integer_times
+
+
+__all__ = ['InstructionTable', 'InstructionColumns']
+
+
+class InstructionTable(HasParent):
+    """Columnar storage for the Function and Constant instructions of an
+    Output, used in place of a list of Instruction objects when the shot is
+    created with instruction_storage='columnar'. Each instruction is a row in
+    a set of growable NumPy arrays rather than an object of its own, and is
+    neither registered with the phase enforcer nor given a __dict__. Rich
+    Instruction objects are created on demand when the table is indexed or
+    iterated over, for example when reporting an error. These objects are
+    read-only snapshots: modifying them does not modify the table."""
+
+    # Column names and dtypes. function_id is an index into self.functions,
+    # which holds the function of a Function instruction, or the value of a
+    # Constant instruction whose value can't be stored in the value column.
+    # Other Constants have a function_id of -1, and their value stored as a
+    # float in the value column and its type as an index into VALUE_TYPES in
+    # the value_type column. call_site_id is an index into self.call_sites,
+    # or -1 if call sites are not being captured. integer_t and
+    # integer_duration are only filled in if the shot has timeline='integer'.
+    dtypes = {'t': np.float64,
+              'duration': np.float64,
+              'integer_t': np.int64,
+              'integer_duration': np.int64,
+              'samplerate': np.float64,
+              'function_id': np.int64,
+              'value': np.float64,
+              'value_type': np.uint8,
+              'is_constant': np.bool_,
+              'instruction_number': np.int64,
+              'call_site_id': np.int64,
+              'segment': np.int64,
+              'relative_t': np.float64,
+              'quantised_t': np.int64,
+              'quantised_duration': np.int64,
+              'quantised_sample_period': np.int64}
+
+    # The value of rows of columns that have not been written to. Columns
+    # are only allocated once a row needs a value other than this, so that
+    # for example a table of Constants has no duration column until its
+    # timing is converted, and a shot with timeline='float' has no integer_t
+    # column:
+    fills = {'function_id': -1, 'call_site_id': -1}
+
+    # Types of Constant values stored in the value column, converted to and
+    # from float64 exactly. Integers are only stored there if they are
+    # within 2**53 of zero:
+    VALUE_TYPES = (float, int, bool, np.float64, np.int64, np.bool_)
+    _value_type_ids = {value_type: i for i, value_type in enumerate(VALUE_TYPES)}
+    _int_value_type_ids = frozenset(i for i, value_type in enumerate(VALUE_TYPES)
+                                    if value_type in (int, np.int64))
+    _max_exact_int = 2**53
+
+    # The value_type returned by value_columns() for rows with no value in
+    # the value column:
+    NO_VALUE_TYPE = 255
+
+    initial_capacity = 16
+
+    def __init__(self, parent, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.pseudoclock = parent.pseudoclock
+        self._capacity = self.initial_capacity
+        self._columns = {}
+        self._length = 0
+
+        # Whether the segment, relative_t, and quantised_* columns have been
+        # computed:
+        self.timing_converted = False
+
+        # Results of evaluating the instructions, computed by
+        # evaluation.evaluate_functions(). The timepoints and values of row i
+        # are evaluation_timepoints[value_offsets[i]:value_offsets[i+1]] and
+        # likewise for values:
+        self.evaluation_timepoints = None
+        self.values = None
+        self.value_offsets = None
+
+        # Distinct functions and constant values not in the value column,
+        # and the captured call sites of user code, each along with a dict
+        # mapping them to their index so that repeated ones are only stored
+        # once. Functions and values are deduplicated by identity, call
+        # sites by equality:
+        self.functions = []
+        self._function_ids = {}
+        self.call_sites = []
+        self._call_site_ids = {}
+
+    def _full_column(self, name):
+        # The named column at its full capacity, allocating it if need be:
+        try:
+            return self._columns[name]
+        except KeyError:
+            column = self._columns[name] = np.full(self._capacity, self.fills.get(name, 0),
+                                                   dtype=self.dtypes[name])
+            return column
+
+    def _grow(self):
+        self._capacity *= 2
+        for name, column in self._columns.items():
+            new_column = np.full(self._capacity, self.fills.get(name, 0), dtype=column.dtype)
+            new_column[:self._length] = column[:self._length]
+            self._columns[name] = new_column
+
+    def _function_id(self, function):
+        try:
+            return self._function_ids[id(function)]
+        except KeyError:
+            function_id = self._function_ids[id(function)] = len(self.functions)
+            self.functions.append(function)
+            return function_id
+
+    @classmethod
+    def _value_type_id(cls, value):
+        # The index into VALUE_TYPES of the type of a Constant value, or None
+        # if it can't be stored exactly in the value column:
+        value_type = cls._value_type_ids.get(type(value))
+        if value_type in cls._int_value_type_ids and abs(value) > cls._max_exact_int:
+            return None
+        return value_type
+
+    def _call_site_id(self, call_site):
+        if call_site is None:
+            return -1
+        try:
+            return self._call_site_ids[call_site]
+        except KeyError:
+            call_site_id = self._call_site_ids[call_site] = len(self.call_sites)
+            self.call_sites.append(call_site)
+            return call_site_id
+
+    def _check_class(self, cls):
+        # Raise an exception if instructions of class cls can't be added:
+        from instructions import Function, Constant
+        if self.shot.frozen:
+            msg = "Cannot add instructions to a frozen shot. Use shot.fork()"
+            raise RuntimeError(msg)
+        if cls not in (Function, Constant):
+            msg = f"{self.__class__.__name__} cannot store {cls.__name__} instructions"
+            raise TypeError(msg)
+        if not any(issubclass(cls, allowed) for allowed in self.parent.allowed_instructions):
+            msg = (f"Instruction of type {cls.__name__} "
+                   f"not permitted by {self.parent}")
+            raise TypeError(msg)
+
+    @enforce_phase(phase.ADD_INSTRUCTIONS)
+    def append(self, cls, t, duration, function, samplerate, _inst_depth=1):
+        """Add a row for an instruction of class cls, which must be Function
+        or Constant. For a Constant, function is the constant value, and
+        duration and samplerate must be zero. _inst_depth has the same
+        meaning as for Instruction.__init__()."""
+        from instructions import Constant
+        self._check_class(cls)
+        capture = self.shot.traceback_capture
+        if capture == 'off':
+            call_site = None
+        elif self.shot.profile is None:
+            call_site = capture_call_site(_inst_depth)
+        else:
+            start = time.perf_counter()
+            call_site = capture_call_site(_inst_depth)
+            self.shot.profile.add_traceback_capture(time.perf_counter() - start)
+        if self._length == self._capacity:
+            self._grow()
+        i = self._length
+        self._full_column('t')[i] = t
+        if self.shot.timeline == 'integer':
+            self._full_column('integer_t')[i] = to_integer_time(t, self.shot.epsilon)
+            self._full_column('integer_duration')[i] = to_integer_time(duration,
+                                                                       self.shot.epsilon)
+        if cls is Constant:
+            value_type = self._value_type_id(function)
+        else:
+            value_type = None
+            self._full_column('duration')[i] = duration
+            self._full_column('samplerate')[i] = samplerate
+        if value_type is None:
+            self._full_column('function_id')[i] = self._function_id(function)
+        else:
+            self._full_column('value')[i] = function
+            self._full_column('value_type')[i] = value_type
+        self._full_column('is_constant')[i] = cls is Constant
+        self._full_column('instruction_number')[i] = self.shot.total_instructions
+        if call_site is not None:
+            self._full_column('call_site_id')[i] = self._call_site_id(call_site)
+        self.shot.total_instructions += 1
+        self._length += 1
+
+    @enforce_phase(phase.ADD_INSTRUCTIONS)
+    def extend(self, cls, t, duration, functions, function_ids, samplerate, call_site=None):
+        """Add rows for a number of instructions of class cls at once, as for
+        append(). t, duration and samplerate are arrays with one element
+        per instruction, functions is a list of functions, or of values for
+        Constants, and function_ids gives the index into functions of each
+        instruction's. All the rows share the given call site, as returned
+        by utils.capture_call_site(), or None."""
+        from instructions import Constant
+        self._check_class(cls)
+        n = len(t)
+        while self._length + n > self._capacity:
+            self._grow()
+        rows = slice(self._length, self._length + n)
+        self._full_column('t')[rows] = t
+        if self.shot.timeline == 'integer':
+            self._full_column('integer_t')[rows] = to_integer_times(t, self.shot.epsilon)
+            self._full_column('integer_duration')[rows] = to_integer_times(duration,
+                                                                           self.shot.epsilon)
+        if cls is Constant:
+            value_types = {self._value_type_id(value) for value in functions}
+        else:
+            value_types = None
+            self._full_column('duration')[rows] = duration
+            self._full_column('samplerate')[rows] = samplerate
+        if value_types is None or len(value_types) != 1 or None in value_types:
+            ids = np.array([self._function_id(function) for function in functions],
+                           dtype=np.int64)
+            self._full_column('function_id')[rows] = ids[function_ids]
+        else:
+            # Constants all of one type that can be stored in the value column:
+            self._full_column('value')[rows] = np.array(functions, dtype=float)[function_ids]
+            self._full_column('value_type')[rows] = value_types.pop()
+        self._full_column('is_constant')[rows] = cls is Constant
+        self._full_column('instruction_number')[rows] = (self.shot.total_instructions
+                                                         + np.arange(n))
+        if call_site is not None:
+            self._full_column('call_site_id')[rows] = self._call_site_id(call_site)
+        self.shot.total_instructions += n
+        self._length += n
+
+    def column(self, name):
+        """Return a view of the given column, containing one entry per
+        instruction. Columns not yet allocated are allocated, see fills."""
+        return self._full_column(name)[:self._length]
+
+    def constant_values(self):
+        """Return a list of the distinct Constant values in the value column,
+        as instances of their original types, an array of the rows holding
+        values there, and an array of the index into the list of each of
+        those rows' values"""
+        if 'value' not in self._columns:
+            return [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.flatnonzero(self.column('is_constant') & (self.column('function_id') == -1))
+        keys = np.empty(len(rows), dtype=[('value', np.float64), ('value_type', np.uint8)])
+        keys['value'] = self.column('value')[rows]
+        keys['value_type'] = self.column('value_type')[rows]
+        distinct, inverse = np.unique(keys, return_inverse=True)
+        values = [self.VALUE_TYPES[value_type](value) for value, value_type in distinct.tolist()]
+        return values, rows, inverse.reshape(-1)
+
+    def value_columns(self):
+        """Return copies of the value, value_type and function_id columns,
+        without allocating them, in which rows with no value in the value
+        column have a value_type of NO_VALUE_TYPE, and Constants whose
+        values could be stored in the value column but are in self.functions,
+        as happens when extend() is passed values of several types, have
+        their values and types moved to the value columns and a function_id
+        of -1. So each row is either a Constant with a value and type, or a
+        Function or Constant with a function_id, regardless of how it was
+        added."""
+        def copy(name, fill):
+            if name in self._columns:
+                return self.column(name).copy()
+            return np.full(self._length, fill, dtype=self.dtypes[name])
+
+        values = copy('value', 0)
+        function_ids = copy('function_id', -1)
+        value_types = copy('value_type', self.NO_VALUE_TYPE)
+        value_types[function_ids != -1] = self.NO_VALUE_TYPE
+        if not self._length:
+            return values, value_types, function_ids
+        is_constant = self.column('is_constant')
+        for function_id in np.unique(function_ids[is_constant & (function_ids != -1)]).tolist():
+            value = self.functions[function_id]
+            value_type = self._value_type_id(value)
+            if value_type is not None:
+                rows = function_ids == function_id
+                values[rows] = value
+                value_types[rows] = value_type
+                function_ids[rows] = -1
+        return values, value_types, function_ids
+
+    @enforce_phase(phase.CONVERT_TIMING, exactly_once=True)
+    def convert_timing(self, waits):
+        """Columnar equivalent of Instruction.convert_timing(), converting
+        the times of all rows of the table at once. Shot.convert_timing()
+        instead converts all tables and Instruction objects under each
+        pseudoclock together using timing.convert_timing()."""
+        from timing import (convert_instruction_times, quantise_instruction_durations,
+                            quantise_sample_periods)
+        timebase = self.pseudoclock.timebase
+        integer_timebase = self.pseudoclock.integer_timebase
+        integer = integer_timebase is not None
+        segment, relative_t, quantised_t = convert_instruction_times(
+            self.column('t'), self.column('integer_t') if integer else None, waits, timebase,
+            integer_timebase, self.shot.epsilon)
+        self.column('segment')[:] = segment
+        self.column('relative_t')[:] = relative_t
+        self.column('quantised_t')[:] = quantised_t
+        self.column('quantised_duration')[:] = quantise_instruction_durations(
+            self.column('duration'), self.column('integer_duration') if integer else None,
+            timebase, integer_timebase)
+        self.column('quantised_sample_period')[:] = quantise_sample_periods(
+            self.column('samplerate'), timebase)
+        self.timing_converted = True
+
+    def __setstate__(self, state):
+        """Restore the table after unpickling. Functions are deduplicated by
+        identity, so their ids must be recomputed"""
+        self.__dict__.update(state)
+        self._function_ids = {id(function): i for i, function in enumerate(self.functions)}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        """Return a new Function or Constant instance with the data from the
+        given row of the table"""
+        from instructions import Function, Constant
+        if not -self._length <= i < self._length:
+            raise IndexError(f"{self.__class__.__name__} index out of range")
+        i %= self._length
+        row = {name: self.fills.get(name, 0) for name in self.dtypes}
+        row.update((name, column[i].item()) for name, column in self._columns.items())
+        if row['function_id'] == -1:
+            function = self.VALUE_TYPES[row['value_type']](row['value'])
+        else:
+            function = self.functions[row['function_id']]
+        if row['is_constant']:
+            instruction = Constant.__new__(Constant)
+            instruction.value = function
+            function = Const(function)
+        else:
+            instruction = Function.__new__(Function)
+        call_site = None
+        if row['call_site_id'] != -1:
+            call_site = self.call_sites[row['call_site_id']]
+        converted = self.timing_converted
+        evaluation_timepoints = values = None
+        if self.value_offsets is not None:
+            start, stop = self.value_offsets[i], self.value_offsets[i + 1]
+            evaluation_timepoints = self.evaluation_timepoints[start:stop]
+            values = self.values[start:stop]
+        instruction.__dict__.update(
+            parent=self.parent,
+            shot=self.shot,
+            pseudoclock=self.pseudoclock,
+            t=row['t'],
+            duration=row['duration'],
+            function=function,
+            samplerate=row['samplerate'],
+            instruction_number=row['instruction_number'],
+            segment=row['segment'] if converted else None,
+            relative_t=row['relative_t'] if converted else None,
+            quantised_t=row['quantised_t'] if converted else None,
+            quantised_duration=row['quantised_duration'] if converted else None,
+            quantised_sample_period=row['quantised_sample_period'] if converted else None,
+            evaluation_timepoints=evaluation_timepoints,
+            values=values,
+            _call_site=call_site)
+        if self.shot.timeline == 'integer':
+            instruction.integer_t = row['integer_t']
+            instruction.integer_duration = row['integer_duration']
+        return instruction
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self[i]
+
+    def __str__(self):
+        return formatobj(self, 'parent')
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class InstructionColumns(object):
+    """Columns of data gathered from the instructions of a number of Outputs,
+    whether they are stored as Instruction objects or in InstructionTables,
+    so that they can be processed together as arrays. Rows from Instruction
+    objects come first, in the order of self.objects, followed by the rows of
+    each table in self.tables. If instruction_class is given, only
+    Instruction objects of that class are included. Tables are always
+    included in full, since all their rows are Functions or Constants."""
+
+    # Values for columns that do not apply to instruction objects of some
+    # classes, for example the duration of a Static instruction:
+    defaults = {'duration': 0,
+                'integer_duration': 0,
+                'samplerate': 0,
+                'quantised_duration': 0,
+                'quantised_sample_period': 0}
+
+    def __init__(self, outputs, names, instruction_class=None, objects=None):
+        """Gather the named columns (see InstructionTable.dtypes) from the
+        instructions of the given outputs, plus the given list of Instruction
+        objects if any."""
+        self.objects = [] if objects is None else list(objects)
+        self.tables = []
+        for output in outputs:
+            if isinstance(output.instructions, InstructionTable):
+                self.tables.append(output.instructions)
+            elif instruction_class is None:
+                self.objects.extend(output.instructions)
+            else:
+                self.objects.extend(instruction for instruction in output.instructions
+                                    if isinstance(instruction, instruction_class))
+        self.n_objects = len(self.objects)
+        self.columns = {name: self._gather(name) for name in names}
+
+    def __len__(self):
+        return self.n_objects + sum(len(table) for table in self.tables)
+
+    def _gather(self, name):
+        dtype = InstructionTable.dtypes[name]
+        if name == 'is_constant':
+            from instructions import Constant
+            values = (isinstance(instruction, Constant) for instruction in self.objects)
+        elif name in self.defaults:
+            default = self.defaults[name]
+            values = (getattr(instruction, name, default) for instruction in self.objects)
+        else:
+            values = (getattr(instruction, name) for instruction in self.objects)
+        from_objects = np.fromiter(values, dtype=dtype, count=self.n_objects)
+        return np.concatenate([from_objects] + [table.column(name) for table in self.tables])
+
+    def instruction(self, row):
+        """Return the Instruction object for the given row, creating it if
+        the row came from an InstructionTable"""
+        if row < self.n_objects:
+            return self.objects[row]
+        for table, rows in self.table_slices():
+            if row < rows.stop:
+                return table[row - rows.start]
+        raise IndexError(row)
+
+    def table_slices(self):
+        """Yield each table along with the slice of the rows of the gathered
+        columns that came from it"""
+        start = self.n_objects
+        for table in self.tables:
+            stop = start + len(table)
+            yield table, slice(start, stop)
+            start = stop
+
+    def scatter(self, name, values):
+        """Write an array of values, one per row, to the named column of the
+        tables and attribute of the Instruction objects. For objects, only
+        the column names of InstructionColumns.defaults that do not apply to
+        them are skipped."""
+        for table, rows in self.table_slices():
+            table.column(name)[:] = values[rows]
+        values = values[:self.n_objects].tolist()
+        for instruction, value in zip(self.objects, values):
+            if name not in self.defaults or hasattr(instruction, name):
+                setattr(instruction, name, value)
+
+    def function_ids(self):
+        """Return an array of one integer per row identifying the function of
+        each Function instruction or the value of each Constant instruction,
+        along with the list of distinct functions and values that it indexes.
+        Functions and values are distinguished by identity."""
+        from instructions import Constant
+        functions = []
+        ids_by_identity = {}
+
+        def function_id(function):
+            try:
+                return ids_by_identity[id(function)]
+            except KeyError:
+                ids_by_identity[id(function)] = len(functions)
+                functions.append(function)
+                return ids_by_identity[id(function)]
+
+        from_objects = np.fromiter(
+            (function_id(instruction.value if isinstance(instruction, Constant)
+                         else instruction.function)
+             for instruction in self.objects),
+            dtype=np.int64, count=self.n_objects)
+        from_tables = []
+        for table in self.tables:
+            ids = np.array([function_id(function) for function in table.functions] + [-1],
+                           dtype=np.int64)[table.column('function_id')]
+            values, rows, value_ids = table.constant_values()
+            ids[rows] = np.array([function_id(value) for value in values],
+                                 dtype=np.int64)[value_ids]
+            from_tables.append(ids)
+        return np.concatenate([from_objects] + from_tables), functions
+
+    def value_columns(self):
+        """Like function_ids(), but with the values of Constants that can be
+        stored exactly in the value column of an InstructionTable returned
+        as arrays rather than in the list of functions, see
+        InstructionTable.value_columns(). Return arrays of the value,
+        value_type and function_id of each row, and the list of distinct
+        functions and values that the function ids index. This is much
+        faster than function_ids() when there are many distinct values, as
+        values in tables are not converted to Python objects."""
+        from instructions import Constant
+        functions = []
+        ids_by_identity = {}
+
+        def function_id(function):
+            try:
+                return ids_by_identity[id(function)]
+            except KeyError:
+                ids_by_identity[id(function)] = len(functions)
+                functions.append(function)
+                return ids_by_identity[id(function)]
+
+        no_value_type = InstructionTable.NO_VALUE_TYPE
+        values = []
+        value_types = []
+        ids = []
+        for instruction in self.objects:
+            value_type = None
+            if isinstance(instruction, Constant):
+                value_type = InstructionTable._value_type_id(instruction.value)
+            if value_type is None:
+                values.append(0)
+                value_types.append(no_value_type)
+                ids.append(function_id(instruction.value if isinstance(instruction, Constant)
+                                       else instruction.function))
+            else:
+                values.append(instruction.value)
+                value_types.append(value_type)
+                ids.append(-1)
+        all_values = [np.array(values, dtype=np.float64)]
+        all_value_types = [np.array(value_types, dtype=np.uint8)]
+        all_ids = [np.array(ids, dtype=np.int64)]
+        for table in self.tables:
+            table_values, table_value_types, table_ids = table.value_columns()
+            table_ids = np.array([function_id(function) for function in table.functions]
+                                 + [-1], dtype=np.int64)[table_ids]
+            all_values.append(table_values)
+            all_value_types.append(table_value_types)
+            all_ids.append(table_ids)
+        return (np.concatenate(all_values), np.concatenate(all_value_types),
+                np.concatenate(all_ids), functions)
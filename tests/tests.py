@@ -9,11 +9,43 @@ import sys
 import os
 import time
 import threading
+import pickle
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, parent_dir)
 
+import numpy as np
+
 import core
+from enforce_phase import enforce_phase, PhaseEnforcedFunction
+
+
+def make_shot(**kwargs):
+    """Return a started shot with a single analog output, as in core.py but
+    with devices that can be clocked every timebase"""
+    shot = core.Shot('<shot>', 100e-9, **kwargs)
+    pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+    pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                          clock_minimum_period=0.1, wait_delay=0.5, timebase=0.1)
+    clockline = core.ClockLine('clockline', pulseblaster_clock, 'flag 1')
+    ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                   clock_minimum_trigger=0.1, clock_minimum_period=0.1)
+    ao = core.Output('ao', ni_card, 'ao0')
+    shot.start()
+    return shot, ao
+
+# Globals read by functions, to test that the digests of shots depend on them:
+GAIN = 1.0
+OFFSETS = [0.0]
+
+
+def gained(t):
+    return GAIN * t
+
+
+def offset(t):
+    return t + OFFSETS[0]
+
 
 class  ReprTest(unittest.TestCase):
     """test the string representation of objects"""
@@ -39,6 +71,1703 @@ class  ReprTest(unittest.TestCase):
     #     assert False
 
 
+class CallSiteTest(unittest.TestCase):
+    """test capturing of the user code that created each instruction"""
+
+    def test_lazy_matches_full(self):
+        tracebacks = {}
+        for mode in ['lazy', 'full']:
+            shot, ao = make_shot(traceback_capture=mode)
+            ao.constant(t=0, value=1) # same line for both modes
+            tracebacks[mode] = ao.instructions[0].traceback
+        self.assertEqual(tracebacks['lazy'], tracebacks['full'])
+
+    def test_traceback_ends_at_user_code(self):
+        for mode in ['full', 'sampled', 'off']:
+            for storage in ['objects', 'columnar']:
+                shot, ao = make_shot(phase_enforcement=mode, instruction_storage=storage,
+                                     phase_check_interval=2)
+                ao.constant(t=0, value=1)
+                ao.function(t=1, duration=1, function=np.sin, samplerate=2)
+                shot.wait(t=3, name='wait')
+                for instruction in [*ao.instructions, shot.instructions[0]]:
+                    last_line = instruction.traceback.splitlines()[-1]
+                    expected = {0: 'ao.constant', 1: 'ao.function', 3: 'shot.wait'}
+                    self.assertIn(expected[instruction.t], last_line, (mode, storage))
+
+    def test_capture_off(self):
+        shot, ao = make_shot(traceback_capture='off')
+        ao.constant(t=0, value=1)
+        self.assertIsNone(ao.instructions[0].traceback)
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            core.Shot('<shot>', 100e-9, traceback_capture='sometimes')
+
+
+class InstructionTableTest(unittest.TestCase):
+    """test columnar storage of instructions"""
+
+    def test_rows_match_objects(self):
+        instructions = {}
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage)
+            ao.constant(t=0, value=7)
+            ao.function(t=1, duration=2, function=np.sin, samplerate=2)
+            shot.stop(3)
+            instructions[storage] = list(ao.instructions)
+        for obj, row in zip(*instructions.values()):
+            self.assertIs(obj.__class__, row.__class__)
+            self.assertEqual(obj.t, row.t)
+            self.assertEqual(obj.duration, row.duration)
+            self.assertEqual(obj.function(0.5), row.function(0.5))
+            self.assertEqual(obj.instruction_number, row.instruction_number)
+            self.assertEqual(obj.traceback.splitlines()[:-2],
+                             row.traceback.splitlines()[:-2])
+
+    def test_growth_and_dedup(self):
+        shot, ao = make_shot(instruction_storage='columnar')
+        for i in range(1000):
+            ao.constant(t=i, value=i % 3)
+        self.assertEqual(len(ao.instructions), 1000)
+        np.testing.assert_array_equal(ao.instructions.column('t'), np.arange(1000))
+        self.assertEqual(len(ao.instructions.call_sites), 1)
+        self.assertEqual(ao.instructions[-1].value, 999 % 3)
+
+    def test_value_column(self):
+        # Values of these types are stored in the value column, others in
+        # the list of functions:
+        values = [1.5, 3, True, np.float64(2.5), np.int64(-4), np.bool_(False),
+                  2**60 + 1, np.float32(0.25), np.array(6.0)]
+        shot, ao = make_shot(instruction_storage='columnar')
+        for i, value in enumerate(values):
+            ao.constant(t=i, value=value)
+        table = ao.instructions
+        self.assertEqual(len(table.functions), 3)
+        # Columns no row needs a value in are not allocated:
+        for name in ['duration', 'samplerate', 'integer_t', 'segment', 'quantised_t']:
+            self.assertNotIn(name, table._columns)
+        for value, instruction in zip(values, table):
+            self.assertIs(type(instruction.value), type(value))
+            self.assertEqual(instruction.value, value)
+        shot.stop(10)
+        self.assertEqual(table.values.tolist(), [float(value) for value in values])
+
+    def test_not_permitted(self):
+        shot, ao = make_shot(instruction_storage='columnar')
+        with self.assertRaises(TypeError):
+            ao.instructions.append(core.Static, 0, 0, 0, 0)
+
+
+class BulkInstructionsTest(unittest.TestCase):
+    """test adding many instructions at once from arrays"""
+
+    def add(self, storage, bulk, timeline='float'):
+        shot, ao = make_shot(instruction_storage=storage, timeline=timeline)
+        ao.constant(t=0, value=5)
+        t = np.arange(1, 6, dtype=float)
+        values = [3, 1, 3, 2, 1]
+        if bulk:
+            ao.constants(t, values)
+            ao.functions([7, 9], duration=[1, 0.5], function=np.sin, samplerate=2)
+        else:
+            for t_i, value in zip(t, values):
+                ao.constant(t_i, value)
+            ao.function(7, duration=1, function=np.sin, samplerate=2)
+            ao.function(9, duration=0.5, function=np.sin, samplerate=2)
+        return shot, ao
+
+    def test_matches_individual(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            for timeline in ['float', 'integer']:
+                expected_shot, expected_ao = self.add(storage, False, timeline)
+                shot, ao = self.add(storage, True, timeline)
+                self.assertEqual(shot.total_instructions, expected_shot.total_instructions)
+                for instruction, expected in zip(ao.instructions, expected_ao.instructions):
+                    self.assertIs(type(instruction), type(expected))
+                    self.assertEqual(sorted(vars(instruction)), sorted(vars(expected)))
+                    self.assertEqual(instruction.t, expected.t)
+                    if isinstance(expected, core.Constant):
+                        self.assertEqual(instruction.value, expected.value)
+                        self.assertIs(type(instruction.value), type(expected.value))
+                    self.assertEqual(instruction.instruction_number,
+                                     expected.instruction_number)
+                    self.assertIn('ao.constant' if instruction.t < 7 else 'ao.function',
+                                  expected.traceback.splitlines()[-1])
+                    if instruction.t:
+                        self.assertIn('ao.constants' if instruction.t < 7 else 'ao.functions',
+                                      instruction.traceback.splitlines()[-1])
+                expected_shot.stop(10)
+                shot.stop(10)
+                expected = shot_arrays(expected_shot)
+                result = shot_arrays(shot)
+                for name in expected:
+                    self.assertTrue(np.array_equal(result[name], expected[name]), name)
+
+    def test_value_types(self):
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage)
+            ao.constants([0, 1, 2], [True, False, True])
+            ao.constants([3, 4], 7)
+            ao.constants([5, 6], np.array([0.5, 2]))
+            self.assertEqual([(type(i.value), i.value) for i in ao.instructions],
+                             [(bool, True), (bool, False), (bool, True), (int, 7), (int, 7),
+                              (float, 0.5), (float, 2.0)])
+
+    def test_validation(self):
+        shot, ao = make_shot()
+        for args in [([[0, 1]], 1), ([0, 1], [1, 2, 3]), ([0, np.nan], 1)]:
+            with self.assertRaises(ValueError):
+                ao.constants(*args)
+        with self.assertRaises(ValueError):
+            ao.functions([0, 1], duration=[1, -1], function=np.sin, samplerate=1)
+        # Non-finite values are rejected alike singly and in bulk:
+        for value in [np.nan, np.inf, -np.inf, np.float32(np.nan)]:
+            with self.assertRaises(ValueError):
+                ao.constants([0], [value])
+            with self.assertRaises(ValueError):
+                ao.constant(t=0, value=value)
+        self.assertEqual(len(ao.instructions), 0)
+
+    def test_violation(self):
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage)
+            ao.constants([0, 1, 1], [1, 2, 3])
+            with self.assertRaises(core.InvalidInstructionsError) as context:
+                shot.stop(2)
+            [(instruction, message)] = context.exception.violations
+            self.assertEqual(instruction.t, 1)
+            self.assertIn('ao.constants', str(context.exception))
+
+
+class ConvertTimingTest(unittest.TestCase):
+    """test conversion of instruction times relative to waits"""
+
+    def make_instructions(self, storage):
+        shot, ao = make_shot(instruction_storage=storage)
+        shot.wait(t=7, name='first_wait')
+        shot.wait(t=3, name='zeroth_wait')
+        for t in [0, 2.5, 3, 6.95, 7.3]:
+            ao.constant(t=t, value=t)
+        ao.function(t=8, duration=2, function=np.sin, samplerate=2)
+        shot.stop(11)
+        return shot, ao
+
+    def test_conversion(self):
+        for storage in ['objects', 'columnar']:
+            shot, ao = self.make_instructions(storage)
+            instructions = list(ao.instructions)
+            self.assertEqual([i.segment for i in instructions], [0, 0, 1, 1, 2, 2])
+            self.assertEqual([i.quantised_t for i in instructions], [0, 25, 0, 40, 3, 10])
+            self.assertAlmostEqual(instructions[3].relative_t, 3.95)
+            self.assertEqual(instructions[-1].quantised_duration, 20)
+            self.assertEqual(instructions[-1].quantised_sample_period, 5)
+            self.assertEqual([w.segment for w in shot.instructions], [0, 1])
+            self.assertEqual([w.relative_t for w in shot.instructions], [3, 4])
+
+    def test_individual_matches_batched(self):
+        shot, ao = self.make_instructions('objects')
+        batched = [(i.segment, i.relative_t, i.quantised_t) for i in ao.instructions]
+        for instruction in ao.instructions:
+            instruction.segment = instruction.relative_t = instruction.quantised_t = None
+            core.Instruction.convert_timing.function(instruction, shot.instructions)
+        individual = [(i.segment, i.relative_t, i.quantised_t) for i in ao.instructions]
+        self.assertEqual(batched, individual)
+
+    def test_static_device_instructions(self):
+        for timeline in ['float', 'integer']:
+            shot = core.Shot('<shot>', 100e-9, timeline=timeline)
+            static_device = core.StaticDevice('static_device', shot, None)
+            output = core.Output('output', static_device, 'x')
+            shot.start()
+            output.constant(t=1, value=2.0)
+            shot.stop(3)
+            instruction = output.instructions[0]
+            self.assertEqual(instruction.relative_t, 1)
+            self.assertIsNone(instruction.quantised_t)
+            self.assertIsNone(instruction.quantised_duration)
+            self.assertIsNone(instruction.quantised_sample_period)
+
+    def test_duplicate_wait(self):
+        for timeline in ['float', 'integer']:
+            shot, ao = make_shot(timeline=timeline)
+            shot.wait(t=3, name='first_wait')
+            with self.assertRaises(ValueError):
+                shot.wait(t=3, name='second_wait')
+            if timeline == 'integer':
+                # Within epsilon, so the same time once converted:
+                with self.assertRaises(ValueError):
+                    shot.wait(t=3 + shot.epsilon / 4, name='second_wait')
+            self.assertEqual([w.name for w in shot.instructions], ['first_wait'])
+
+    def test_already_called(self):
+        shot, ao = self.make_instructions('objects')
+        shot.phase = core.phase.CONVERT_TIMING
+        with self.assertRaises(core.AlreadyCalledError):
+            ao.instructions[0].convert_timing(shot.instructions)
+
+
+class EvaluationTest(unittest.TestCase):
+    """test batched evaluation of functions"""
+
+    def test_evaluation(self):
+        calls = []
+        def ramp(t):
+            calls.append(len(t))
+            return 2 * t
+        for storage in ['objects', 'columnar']:
+            del calls[:]
+            shot, ao = make_shot(instruction_storage=storage)
+            ao.constant(t=0, value=7)
+            ao.function(t=1, duration=2, function=ramp, samplerate=2)
+            ao.function(t=4, duration=1, function=ramp, samplerate=5)
+            ao.function(t=6, duration=1, function=np.cos, samplerate=1)
+            shot.stop(8)
+            self.assertEqual(calls, [9])
+            constant, first, second, cosine = ao.instructions
+            self.assertEqual(list(constant.evaluation_timepoints), [0])
+            self.assertEqual(list(constant.values), [7])
+            self.assertEqual(list(first.evaluation_timepoints), [10, 15, 20, 25])
+            np.testing.assert_allclose(first.values, [0, 1, 2, 3])
+            self.assertEqual(list(second.evaluation_timepoints), [40, 42, 44, 46, 48])
+            np.testing.assert_allclose(second.values, [0, 0.4, 0.8, 1.2, 1.6])
+            np.testing.assert_allclose(cosine.values, [1])
+
+    def test_sample_timepoints(self):
+        from evaluation import sample_timepoints
+        timepoints, offsets = sample_timepoints(np.array([0, 10, 20]), np.array([0, 5, 3]),
+                                                np.array([0, 2, 0]))
+        self.assertEqual(list(timepoints), [0, 10, 12, 14, 20])
+        self.assertEqual(list(offsets), [0, 1, 4, 5])
+
+    def test_ramp_cache(self):
+        from evaluation import RampCache
+        from functions import Const, LinearRamp
+        calls = []
+        def ramp(t):
+            calls.append(len(t))
+            return 2 * t
+        for storage in ['objects', 'columnar']:
+            cache = RampCache()
+            results = []
+            for cached in [None, cache, cache]:
+                del calls[:]
+                shot, ao = make_shot(instruction_storage=storage)
+                ao.constant(t=0, value=7)
+                ao.function(t=1, duration=2, function=ramp, samplerate=2)
+                ao.function(t=3, duration=2, function=ramp, samplerate=2)
+                ao.function(t=5, duration=1, function=ramp, samplerate=5)
+                ao.function(t=6, duration=1, function=LinearRamp(1, 0, 1), samplerate=5)
+                ao.function(t=7, duration=1, function=LinearRamp(1, 0, 1), samplerate=5)
+                shot.stop(8, ramp_cache=cached)
+                results.append([(list(instruction.evaluation_timepoints),
+                                 list(instruction.values)) for instruction in ao.instructions])
+                if cached is not None:
+                    self.assertEqual(calls, [9] if len(results) == 2 else [])
+            self.assertEqual(results[1], results[0])
+            self.assertEqual(results[2], results[0])
+            self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3, 'evictions': 0,
+                                             'entries': 3, 'nbytes': 14 * 8})
+            if storage == 'objects':
+                _, first, second, _, third, fourth = ao.instructions
+                self.assertIs(first.values, second.values)
+                self.assertIs(third.values, fourth.values)
+                self.assertFalse(first.values.flags.writeable)
+
+        self.assertEqual(Const(1), Const(1))
+        self.assertEqual(hash(LinearRamp(1, 0, 1)), hash(LinearRamp(1, 0, 1)))
+        self.assertNotEqual(LinearRamp(1, 0, 1), LinearRamp(1, 0, 2))
+
+    def test_ramp_cache_eviction(self):
+        from evaluation import RampCache
+        cache = RampCache(max_bytes=80)
+        first, second, third = np.zeros(5), np.ones(5), np.zeros(20)
+        cache.put('first', first)
+        cache.put('second', second)
+        self.assertIs(cache.get('first'), first)
+        cache.put('third', third)
+        self.assertEqual(len(cache), 2)
+        cache.put('fourth', np.zeros(5))
+        self.assertIs(cache.get('second'), None)
+        self.assertIs(cache.get('first'), first)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 1,
+                                         'entries': 2, 'nbytes': 80})
+
+
+    def test_real_values(self):
+        from evaluation import RampCache
+        from functions import Const
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage)
+            for value in ['1', np.array([1.0, 2.0]), 1j, None]:
+                with self.assertRaises(TypeError):
+                    ao.constant(t=0, value=value)
+            with self.assertRaises(TypeError):
+                ao.constants([0, 1], ['1', '2'])
+            self.assertEqual(len(ao.instructions), 0)
+            ao.constant(t=0, value=np.array(2))
+            ao.constant(t=1, value=True)
+            ao.constant(t=2, value=np.float32(0.5))
+            shot.stop(3)
+            self.assertEqual([list(i.values) for i in ao.instructions], [[2], [1], [0.5]])
+            # Functions returning complex values raise, with or without a
+            # RampCache, rather than having their imaginary parts dropped:
+            for cache in [None, RampCache()]:
+                shot, ao = make_shot(instruction_storage=storage)
+                ao.function(t=0, duration=1, function=lambda t: t + 1j, samplerate=2)
+                with self.assertRaises(TypeError):
+                    shot.stop(2, ramp_cache=cache)
+        t = np.arange(3.0)
+        self.assertEqual(Const(np.array(2.0))(t).dtype, np.float64)
+        self.assertEqual(list(Const(2)(t)), [2, 2, 2])
+
+
+class TimelineTest(unittest.TestCase):
+    """test processing times as integers of the shot's epsilon"""
+
+    def compile(self, storage, timeline):
+        shot, ao = make_shot(instruction_storage=storage, timeline=timeline)
+        shot.wait(t=3, name='wait')
+        shot.wait(t=5.25, name='second_wait')
+        ao.constant(t=0, value=1)
+        ao.function(t=1, duration=1.5, function=np.sin, samplerate=2)
+        ao.constant(t=3.35, value=2)
+        ao.function(t=6, duration=0.95, function=np.cos, samplerate=5)
+        shot.stop(8)
+        return shot, ao
+
+    def test_matches_float(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            expected_shot, expected_ao = self.compile(storage, 'float')
+            shot, ao = self.compile(storage, 'integer')
+            expected = shot_arrays(expected_shot)
+            result = shot_arrays(shot)
+            for name in expected:
+                self.assertTrue(np.array_equal(result[name], expected[name]), name)
+            for instruction, expected_instruction in zip(ao.instructions,
+                                                         expected_ao.instructions):
+                self.assertEqual(instruction.segment, expected_instruction.segment)
+                self.assertAlmostEqual(instruction.relative_t, expected_instruction.relative_t)
+            self.assertEqual([instruction.integer_t for instruction in ao.instructions],
+                             [0, 10000000, 33500000, 60000000])
+            self.assertEqual(list(ao.instructions)[1].integer_duration, 15000000)
+            self.assertEqual([wait.relative_t for wait in shot.instructions], [3, 2.25])
+
+    def test_exact_comparison(self):
+        for timeline in ['float', 'integer']:
+            # 0.1 + 0.2 > 0.3 in floating point, but the Function ends at the
+            # wait once times are quantised:
+            shot, ao = make_shot(timeline=timeline)
+            shot.wait(t=0.3, name='wait')
+            ao.function(t=0.1, duration=0.2, function=np.sin, samplerate=10)
+            shot.stop(1)
+            shot, ao = make_shot(timeline=timeline)
+            shot.wait(t=0.3, name='wait')
+            ao.function(t=0.1, duration=0.3, function=np.sin, samplerate=10)
+            with self.assertRaises(core.InvalidInstructionsError) as context:
+                shot.stop(1)
+            self.assertIn('wait at t=0.3', str(context.exception))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            core.Shot('<shot>', 100e-9, timeline='double')
+        shot = core.Shot('<shot>', 0.3, timeline='integer')
+        pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+        core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                         clock_minimum_period=1, wait_delay=0.5, timebase=1)
+        with self.assertRaises(ValueError):
+            shot.start()
+
+
+class PhaseEnforcementTest(unittest.TestCase):
+    """test checking that required methods were called"""
+
+    def test_required_methods(self):
+        required = enforce_phase.required_methods[core.Constant]
+        self.assertEqual(required[core.phase.CONVERT_TIMING],
+                         {core.Instruction.convert_timing})
+        self.assertEqual(enforce_phase.expected_calls[core.ClockLine]
+                         [core.phase.EVALUATE_FUNCTIONS], 4)
+
+    def test_not_called(self):
+        shot, ao = make_shot()
+        ao.constant(t=0, value=1)
+        ao.constant(t=1, value=2)
+        shot._set_phase(core.phase.CONVERT_TIMING)
+        ao.instructions[0].convert_timing(shot.instructions)
+        with self.assertRaises(core.NotCalledError) as context:
+            shot._set_phase(core.phase.CHECK_INSTRUCTIONS_VALID)
+        self.assertIn('t=1', str(context.exception))
+
+    def test_modes(self):
+        class Probe(core.StaticDevice):
+            @enforce_phase(core.phase.ADD_DEVICES)
+            def probe(self):
+                pass
+
+        for mode, expected_errors in [('full', 10), ('sampled', 2), ('off', 0)]:
+            shot = core.Shot('<shot>', 100e-9, phase_enforcement=mode,
+                             phase_check_interval=5)
+            probe = Probe('probe', shot, None)
+            shot.start()
+            errors = 0
+            for i in range(10):
+                try:
+                    probe.probe()
+                except core.WrongPhaseError:
+                    errors += 1
+            self.assertEqual(errors, expected_errors, mode)
+
+    def test_sampled_bindings(self):
+        class Probe(core.StaticDevice):
+            @enforce_phase(core.phase.ADD_DEVICES)
+            def probe(self):
+                pass
+
+        shot = core.Shot('<shot>', 100e-9, phase_enforcement='sampled',
+                         phase_check_interval=100)
+        probe = Probe('probe', shot, None)
+        shot.start()
+        probe.probe()
+        # The sampling wrapper is cached on the instance:
+        self.assertIs(probe.probe, probe.__dict__['probe'])
+
+        # Calls from multiple threads are counted consistently:
+        errors = []
+        def call_probe():
+            for i in range(5000):
+                try:
+                    probe.probe()
+                except core.WrongPhaseError:
+                    errors.append(i)
+        threads = [threading.Thread(target=call_probe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 200)
+
+    def test_call_records_by_method(self):
+        shot, ao = make_shot()
+        ao.constant(t=0, value=1)
+        shot.stop(1)
+        # Calls are recorded per required method, not per instance:
+        calls = shot.phase_registry.calls
+        self.assertTrue(all(isinstance(method, PhaseEnforcedFunction) for method in calls))
+        self.assertIn(ao, calls[type(ao).establish_common_limits])
+        self.assertIn(ao.instructions[0], calls[core.Instruction.convert_timing])
+
+    def test_off_skips_registration(self):
+        shot, ao = make_shot(phase_enforcement='off')
+        ao.constant(t=0, value=1)
+        self.assertEqual(shot.phase_registry.instances, {})
+        shot.stop(1)
+
+    def test_cached_bindings(self):
+        class Probe(core.StaticDevice):
+            @enforce_phase(core.phase.ADD_DEVICES)
+            def probe(self):
+                return 'probe'
+
+        class SubProbe(Probe):
+            @enforce_phase(core.phase.ADD_DEVICES)
+            def probe(self):
+                return 'sub' + super().probe()
+
+        for mode in ['full', 'off']:
+            shot = core.Shot('<shot>', 100e-9, phase_enforcement=mode)
+            probe = SubProbe('probe', shot, None)
+            self.assertEqual(probe.probe(), 'subprobe')
+            # The binding is cached on the instance, but not that of the
+            # overridden method called with super():
+            self.assertIs(probe.__dict__['probe'].__self__, probe)
+            self.assertEqual(probe.probe(), 'subprobe')
+            if mode == 'off':
+                self.assertIs(probe.probe.__func__, SubProbe.probe.function)
+            else:
+                self.assertIs(probe.probe.__func__, SubProbe.probe)
+            pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None,
+                                                  minimum_trigger=0.1)
+            core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                             clock_minimum_period=0.1, wait_delay=0.5, timebase=0.1)
+            shot.start()
+            shot.freeze()
+            # Not copied to forks or pickled:
+            fork = shot.fork()
+            fork_probe, = [device for device in fork.all_devices if device.name == 'probe']
+            self.assertNotIn('probe', fork_probe.__dict__)
+            if mode == 'full':
+                with self.assertRaises(core.WrongPhaseError):
+                    fork_probe.probe()
+
+        shot, ao = make_shot()
+        ao.constant(t=0, value=1)
+        self.assertIn('add_instruction', ao.__dict__)
+        self.assertNotIn('add_instruction', pickle.loads(pickle.dumps(ao)).__dict__)
+
+
+class MemoryTest(unittest.TestCase):
+    """test that compiling many shots in one process doesn't leak memory"""
+
+    def compile_shot(self, storage):
+        shot, ao = make_shot(instruction_storage=storage)
+        with shot:
+            ao.constant(t=0, value=1)
+            ao.function(t=1, duration=1, function=np.sin, samplerate=5)
+            shot.stop(3)
+
+    def test_soak(self):
+        import gc
+        import tracemalloc
+        for storage in ['objects', 'columnar']:
+            for _ in range(100):
+                self.compile_shot(storage)
+            gc.collect()
+            objects = len(gc.get_objects())
+            for _ in range(2000):
+                self.compile_shot(storage)
+            gc.collect()
+            self.assertLess(len(gc.get_objects()) - objects, 100, storage)
+
+            # Shots leaked about 17 kB each before their phase enforcement
+            # records were kept on the shot:
+            tracemalloc.start()
+            try:
+                gc.collect()
+                before = tracemalloc.get_traced_memory()[0]
+                for _ in range(300):
+                    self.compile_shot(storage)
+                gc.collect()
+                growth = tracemalloc.get_traced_memory()[0] - before
+            finally:
+                tracemalloc.stop()
+            self.assertLess(growth, 100e3, storage)
+
+    def test_columnar_size(self):
+        import gc
+        import tracemalloc
+        # Distinct values, which can't be shared between instructions:
+        n = 20000
+        values = (np.arange(n) * 0.001 + 0.5).tolist()
+        sizes = {}
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage, traceback_capture='off')
+            gc.collect()
+            tracemalloc.start()
+            try:
+                for i, value in enumerate(values):
+                    ao.constant(t=i * 1e-3, value=value)
+                gc.collect()
+                sizes[storage] = tracemalloc.get_traced_memory()[0] / n
+            finally:
+                tracemalloc.stop()
+        # About 35 bytes per instruction, against about 480 for objects:
+        self.assertLess(sizes['columnar'], 60)
+        self.assertGreater(sizes['objects'] / sizes['columnar'], 8)
+
+    def test_close(self):
+        shot, ao = make_shot()
+        ao.constant(t=0, value=1)
+        with shot:
+            shot.stop(1)
+        self.assertTrue(shot.closed)
+        self.assertEqual(shot.phase_registry.instances, {})
+        with self.assertRaises(RuntimeError):
+            shot.stop(1)
+        with self.assertRaises(RuntimeError):
+            shot.fork()
+
+
+class ConcurrencyTest(unittest.TestCase):
+    """test building and compiling independent shots in parallel threads"""
+
+    n_threads = 12
+
+    def fill(self, shot, ao, i):
+        from functions import LinearRamp
+        shot.wait(t=2.5 + 0.1 * (i % 3), name='wait')
+        for k in range(10 + i):
+            if k % 2:
+                ao.function(t=k, duration=0.5, function=LinearRamp(0.5, 0, i), samplerate=4)
+            else:
+                ao.constant(t=k, value=i * k)
+        return 11 + i
+
+    def build(self, i, storage, template=None):
+        if template is None:
+            shot, ao = make_shot(instruction_storage=storage)
+        else:
+            shot = template.fork()
+            [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        return shot, ao, self.fill(shot, ao, i)
+
+    def run_threads(self, target):
+        """Call target(i) in n_threads threads at once, switching between
+        them as often as possible, and return the result or exception of
+        each"""
+        barrier = threading.Barrier(self.n_threads)
+        results = [None] * self.n_threads
+
+        def run(i):
+            barrier.wait()
+            try:
+                results[i] = target(i)
+            except Exception as e:
+                results[i] = e
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(self.n_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        return results
+
+    def test_parallel_shots(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            for forked in [False, True]:
+                template = None
+                if forked:
+                    template, _ = make_shot(instruction_storage=storage)
+                    template.freeze()
+                expected = []
+                for i in range(self.n_threads):
+                    shot, ao, stop_time = self.build(i, storage, template)
+                    shot.stop(stop_time)
+                    expected.append(shot_arrays(shot))
+
+                def compile_shot(i):
+                    shot, ao, stop_time = self.build(i, storage, template)
+                    numbers = [instruction.instruction_number
+                               for instruction in ao.instructions]
+                    shot.stop(stop_time)
+                    return shot, numbers, shot_arrays(shot)
+
+                for i, result in enumerate(self.run_threads(compile_shot)):
+                    self.assertNotIsInstance(result, Exception)
+                    shot, numbers, arrays = result
+                    # The wait is instruction 0:
+                    self.assertEqual(sorted(numbers), list(range(1, 11 + i)))
+                    self.assertEqual(shot.total_instructions, 11 + i)
+                    self.assertEqual(list(arrays), list(expected[i]))
+                    for name in arrays:
+                        self.assertTrue(np.array_equal(arrays[name], expected[i][name]))
+                    for instances in shot.phase_registry.instances.values():
+                        for instance in instances:
+                            self.assertIs(instance.shot, shot)
+
+    def test_isolated_phase_checks(self):
+        # Every other shot misses a required call, which must only raise in
+        # that shot:
+        def convert_timing(i):
+            shot, ao, stop_time = self.build(i, 'objects')
+            shot._set_phase(core.phase.CONVERT_TIMING)
+            for instruction in ao.instructions[i % 2:] + shot.instructions:
+                instruction.convert_timing(shot.instructions)
+            shot._set_phase(core.phase.CHECK_INSTRUCTIONS_VALID)
+            return shot
+
+        for i, result in enumerate(self.run_threads(convert_timing)):
+            if i % 2:
+                self.assertIsInstance(result, core.NotCalledError)
+            else:
+                self.assertEqual(result.phase, core.phase.CHECK_INSTRUCTIONS_VALID)
+
+
+def make_nested_shot(**kwargs):
+    """Return a shot, not yet started, with a secondary pseudoclock triggered
+    by an output of the first, and a static device"""
+    shot = core.Shot('<shot>', 100e-9, **kwargs)
+    pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+    pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                          clock_minimum_period=1, wait_delay=0.5, timebase=0.1)
+    clockline = core.ClockLine('clockline', pulseblaster_clock, 'flag 1')
+    ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                   clock_minimum_trigger=0.1, clock_minimum_period=1.2)
+    core.Output('ao', ni_card, 'ao0')
+    trigger = core.Trigger('trigger', ni_card, 'do0')
+    secondary = core.PseudoclockDevice('secondary', trigger, None, minimum_trigger=0.1)
+    secondary_clock = core.Pseudoclock('secondary_clock', secondary, 'clock',
+                                       clock_minimum_period=0.5, wait_delay=0.5, timebase=0.1)
+    secondary_clockline = core.ClockLine('secondary_clockline', secondary_clock, 'flag 1')
+    novatech = core.ClockableDevice('novatech', secondary_clockline, 'clock',
+                                    clock_minimum_trigger=0.1, clock_minimum_period=0.8)
+    core.Output('dds', novatech, 'ch0')
+    core.Output('ao1', ni_card, 'ao1')
+    static_device = core.StaticDevice('static_device', shot, None)
+    core.StaticOutput('static_output', static_device, 'ch0')
+    return shot
+
+
+class HierarchyIndexTest(unittest.TestCase):
+    """test the index of the device hierarchy"""
+
+    def test_matches_recursion(self):
+        shot = make_nested_shot()
+        devices = [shot] + shot.descendant_devices(recurse_into_pseudoclocks=True)
+        expected = {}
+        for device in devices:
+            for recurse in [False, True]:
+                expected[device, recurse] = (
+                    device.descendant_devices(recurse),
+                    device.descendant_devices_of_type(core.Output, recurse))
+        shot.start()
+        self.assertEqual(shot.all_devices, devices[1:])
+        for device in devices:
+            for recurse in [False, True]:
+                self.assertEqual((device.descendant_devices(recurse),
+                                  device.descendant_devices_of_type(core.Output, recurse)),
+                                 expected[device, recurse])
+
+    def test_partitions(self):
+        shot = make_nested_shot()
+        shot.start()
+        names = {pseudoclock: [device.name for device in shot.hierarchy.partition(pseudoclock)]
+                 for pseudoclock in shot.all_pseudoclocks}
+        self.assertEqual(list(names.values()),
+                         [['pulseblaster_clock', 'clockline', 'ni_card', 'ao', 'trigger',
+                           'secondary', 'ao1'],
+                          ['secondary_clock', 'secondary_clockline', 'novatech', 'dds']])
+        self.assertEqual(shot.hierarchy.parent(shot.all_devices[0]), shot)
+
+
+class ClockTicksTest(unittest.TestCase):
+    """test generation of clock ticks"""
+
+    def make_shot(self, storage):
+        shot = core.Shot('<shot>', 100e-9, instruction_storage=storage)
+        pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+        clock = core.Pseudoclock('clock', pulseblaster, 'clock',
+                                 clock_minimum_period=0.2, wait_delay=0.5, timebase=0.1)
+        first = core.ClockLine('first', clock, 'flag 1')
+        second = core.ClockLine('second', clock, 'flag 2')
+        ni_card = core.ClockableDevice('ni_card', first, 'clock',
+                                       clock_minimum_trigger=0.1, clock_minimum_period=0.5)
+        other_card = core.ClockableDevice('other_card', second, 'clock',
+                                          clock_minimum_trigger=0.1, clock_minimum_period=0.3)
+        outputs = [core.Output('ao0', ni_card, 'ao0'), core.Output('ao1', ni_card, 'ao1'),
+                   core.Output('ao2', other_card, 'ao0')]
+        shot.start()
+        return shot, clock, (first, second), outputs
+
+    def test_ticks(self):
+        for storage in ['objects', 'columnar']:
+            shot, clock, (first, second), (ao0, ao1, ao2) = self.make_shot(storage)
+            self.assertEqual(first.quantised_clock_minimum_period, 5)
+            self.assertAlmostEqual(first.common_clock_minimum_period, 0.5)
+            shot.wait(t=3, name='wait')
+            ao0.constant(t=0, value=1)
+            ao0.function(t=1, duration=1, function=np.sin, samplerate=2)
+            ao1.constant(t=1, value=1)
+            ao1.constant(t=3, value=1)
+            ao2.constant(t=0.3, value=1)
+            ao2.constant(t=1, value=1)
+            shot.stop(4)
+            self.assertEqual(list(first.tick_segments), [0, 0, 0, 1])
+            self.assertEqual(list(first.ticks), [0, 10, 15, 0])
+            self.assertEqual(list(clock.tick_segments), [0, 0, 0, 0, 1])
+            self.assertEqual(list(clock.ticks), [0, 3, 10, 15, 0])
+            self.assertEqual(list(clock.clockline_ticks[first]), [0, 2, 3, 4])
+            self.assertEqual(list(clock.clockline_ticks[second]), [1, 2])
+
+    def test_too_close(self):
+        shot, clock, (first, second), (ao0, ao1, ao2) = self.make_shot('objects')
+        ao0.constant(t=0, value=1)
+        ao1.constant(t=0.4, value=1)
+        with self.assertRaises(core.InvalidInstructionsError) as context:
+            shot.stop(1)
+        [(instruction, message)] = context.exception.violations
+        self.assertEqual(instruction.t, 0.4)
+        self.assertIn('minimum period 0.5', message)
+
+    def test_unique_ticks(self):
+        from clocking import unique_ticks
+        segments = np.array([1, 0, 1, 0, 0])
+        ticks = np.array([5, 7, 5, -2, 7])
+        for huge in [False, True]:
+            if huge:
+                ticks = ticks * 2**61
+            unique_segments, unique, inverse = unique_ticks(segments, ticks)
+            self.assertEqual(list(unique_segments), [0, 0, 1])
+            self.assertEqual(list(unique), list(np.array([-2, 7, 5]) * (2**61 if huge else 1)))
+            self.assertEqual(list(inverse), [2, 1, 2, 0, 1])
+
+    def test_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from sweep import shot_arrays
+        results = []
+        for executor in [None, ThreadPoolExecutor(2)]:
+            shot = make_nested_shot()
+            shot.start()
+            outputs = {output.name: output
+                       for output in shot.descendant_devices_of_type(core.Output, True)}
+            ao, dds, ao1 = outputs['ao'], outputs['dds'], outputs['ao1']
+            shot.wait(t=5, name='wait')
+            ao.function(t=0, duration=4, function=np.sin, samplerate=0.5)
+            ao1.constant(t=6, value=1)
+            dds.function(t=1, duration=2, function=np.cos, samplerate=1)
+            shot.stop(8, executor=executor)
+            results.append(shot_arrays(shot))
+        serial, threaded = results
+        self.assertEqual(list(threaded), list(serial))
+        for name in serial:
+            self.assertTrue(np.array_equal(threaded[name], serial[name]), name)
+
+    def test_executor_error(self):
+        from concurrent.futures import ThreadPoolExecutor
+        shot = make_nested_shot()
+        shot.start()
+        outputs = {output.name: output
+                   for output in shot.descendant_devices_of_type(core.Output, True)}
+        ao, dds = outputs['ao'], outputs['dds']
+        ao.constant(t=0, value=1)
+        ao.constant(t=0, value=2)
+        dds.constant(t=0, value=1)
+        dds.constant(t=0.1, value=1)
+        with ThreadPoolExecutor(2) as executor:
+            with self.assertRaises(core.InvalidInstructionsError) as context:
+                shot.stop(1, executor=executor)
+        self.assertEqual(len(context.exception.violations), 2)
+
+
+class ChunkCollector(object):
+    """A sink for streamed results that concatenates the chunks"""
+    def __init__(self):
+        self.chunks = {}
+
+    def append(self, device, name, array):
+        self.chunks.setdefault(f'{device.name}/{name}', []).append(array)
+
+    def arrays(self):
+        return {name: np.concatenate(chunks) for name, chunks in self.chunks.items()}
+
+
+class StreamingTest(unittest.TestCase):
+    """test evaluating functions and generating ticks in chunks"""
+
+    def compile(self, storage, chunk_size, sink=None):
+        shot, clock, (first, second), (ao0, ao1, ao2) = ClockTicksTest.make_shot(None, storage)
+        shot.wait(t=3, name='wait')
+        ao0.constant(t=0, value=1)
+        ao0.function(t=1, duration=1.5, function=np.sin, samplerate=2)
+        ao1.function(t=1, duration=1, function=np.cos, samplerate=1)
+        ao1.constant(t=3, value=2)
+        ao2.function(t=0, duration=2.5, function=np.exp, samplerate=2)
+        ao2.constant(t=3.5, value=3)
+        shot.stop(4, chunk_size=chunk_size, sink=sink)
+        return shot
+
+    def test_matches_batch(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            expected = shot_arrays(self.compile(storage, None))
+            for clockline in ['first', 'second']:
+                indices = expected.pop(f'{clockline}/tick_indices')
+                expected[f'{clockline}/tick_segments'] = expected['clock/tick_segments'][indices]
+                expected[f'{clockline}/ticks'] = expected['clock/ticks'][indices]
+            for chunk_size in [1, 2, 3, 7, 1000]:
+                sink = ChunkCollector()
+                shot = self.compile(storage, chunk_size, sink)
+                result = sink.arrays()
+                self.assertEqual(sorted(result), sorted(expected))
+                for name, array in result.items():
+                    self.assertTrue(np.array_equal(array, expected[name]), name)
+                self.assertEqual(shot.all_pseudoclocks[0].n_ticks,
+                                 len(expected['clock/ticks']))
+
+    def test_iter_timepoints(self):
+        from evaluation import sample_timepoints, iter_timepoints
+        quantised_t = np.array([0, 100, 7])
+        duration = np.array([10, 0, 5])
+        period = np.array([3, 0, 1])
+        timepoints, offsets = sample_timepoints(quantised_t, duration, period)
+        for chunk_size in [1, 4, 100]:
+            chunks = list(iter_timepoints(quantised_t, duration, period, chunk_size))
+            self.assertTrue(all(len(chunk) <= chunk_size for _, chunk in chunks))
+            rows = np.concatenate([rows for rows, _ in chunks])
+            self.assertEqual(list(np.concatenate([chunk for _, chunk in chunks])),
+                             list(timepoints))
+            self.assertEqual(list(np.bincount(rows)), list(np.diff(offsets)))
+
+    def test_too_close(self):
+        for chunk_size in [None, 1, 2]:
+            shot, clock, (first, second), (ao0, ao1, ao2) = ClockTicksTest.make_shot(
+                None, 'objects')
+            ao0.function(t=0, duration=2, function=np.sin, samplerate=1)
+            ao1.constant(t=1.4, value=1)
+            with self.assertRaises(core.InvalidInstructionsError) as context:
+                shot.stop(3, chunk_size=chunk_size)
+            [(instruction, message)] = context.exception.violations
+            self.assertEqual(instruction.t, 1.4)
+
+
+class ShotFileTest(unittest.TestCase):
+    """test writing and reading compiled shots to and from disk"""
+
+    def test_streamed_matches_batch(self):
+        import tempfile
+        from shotfile import ShotFileWriter, ShotFile, write_shot_file
+        with tempfile.TemporaryDirectory() as tempdir:
+            batch_path = os.path.join(tempdir, 'batch.shot')
+            streamed_path = os.path.join(tempdir, 'streamed.shot')
+            write_shot_file(batch_path, StreamingTest.compile(None, 'columnar', None))
+            with ShotFileWriter(streamed_path) as writer:
+                StreamingTest.compile(None, 'columnar', 2, writer)
+            batch = ShotFile(batch_path)
+            streamed = ShotFile(streamed_path)
+            self.assertIsInstance(streamed['ao2/values'], np.memmap)
+            for name in ['clock/ticks', 'ao0/timepoints', 'ao1/values', 'ao2/segments']:
+                self.assertTrue(np.array_equal(streamed[name], batch[name]), name)
+            self.assertEqual(set(batch.device_arrays('ao0')), {'segments', 'timepoints', 'values'})
+            for info in streamed.arrays.values():
+                self.assertEqual(info['offset'] % 64, 0)
+            del batch, streamed
+            self.assertEqual(sorted(os.listdir(tempdir)), ['batch.shot', 'streamed.shot'])
+
+    def test_discarded_on_error(self):
+        import tempfile
+        from shotfile import ShotFileWriter
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'shot')
+            with self.assertRaises(TypeError):
+                with ShotFileWriter(path) as writer:
+                    writer.append_array('a', np.zeros(3))
+                    writer.append_array('a', np.zeros(3, dtype=int))
+            self.assertEqual(os.listdir(tempdir), [])
+
+    def test_many_arrays(self):
+        import tempfile
+        import resource
+        from shotfile import ShotFileWriter, ShotFile
+        n_open = len(os.listdir('/proc/self/fd')) if os.path.exists('/proc/self/fd') else 64
+        limit = n_open + 32
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'shot')
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            try:
+                # Many more arrays than files may be open, in interleaved chunks:
+                with ShotFileWriter(path) as writer:
+                    for chunk in range(2):
+                        for i in range(4 * limit):
+                            writer.append_array(f'a{i}', np.arange(3) + 10 * chunk + i)
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+            shot_file = ShotFile(path)
+            self.assertEqual(len(shot_file.keys()), 4 * limit)
+            self.assertEqual(list(shot_file['a5']), [5, 6, 7, 15, 16, 17])
+
+
+class IncrementalTest(unittest.TestCase):
+    """test reusing the results of a previous shot"""
+
+    def compile(self, template, ao1_value=1, second_wait=8, previous=None):
+        shot = template.fork()
+        outputs = {output.name: output
+                   for output in shot.descendant_devices_of_type(core.Output, True)}
+        shot.wait(t=5, name='first_wait')
+        shot.wait(t=second_wait, name='second_wait')
+        outputs['ao'].function(t=0, duration=4, function=np.sin, samplerate=0.5)
+        outputs['ao1'].constant(t=7, value=ao1_value)
+        outputs['dds'].function(t=1, duration=2, function=np.cos, samplerate=1)
+        shot.stop(10, previous=previous)
+        return shot
+
+    def test_reuse(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            template = make_nested_shot(instruction_storage=storage)
+            template.start()
+            template.freeze()
+            previous = self.compile(template)
+            for changes, expected_reused in [
+                    ({}, ['ao', 'trigger', 'ao1', 'clockline', 'dds', 'secondary_clockline',
+                          'pulseblaster_clock', 'secondary_clock']),
+                    ({'ao1_value': 2}, ['ao', 'trigger', 'dds', 'secondary_clockline',
+                                        'secondary_clock']),
+                    ({'second_wait': 8.5}, ['ao', 'trigger', 'dds', 'secondary_clockline',
+                                            'secondary_clock'])]:
+                shot = self.compile(template, previous=previous, **changes)
+                self.assertEqual(sorted(shot.reused_devices), sorted(expected_reused))
+                self.assertEqual(shot.reuse, {})
+                expected = shot_arrays(self.compile(template, **changes))
+                result = shot_arrays(shot)
+                for name in expected:
+                    self.assertTrue(np.array_equal(result[name], expected[name]), name)
+                [ao1] = [output for output in shot.all_devices if output.name == 'ao1']
+                self.assertEqual(list(ao1.instructions)[0].values[0], changes.get('ao1_value', 1))
+
+    def test_constant_digest(self):
+        from incremental import output_digest
+        for storage in ['objects', 'columnar']:
+            digests = []
+            # Equal as float64, but not as the values given:
+            for value in [2**53, 2**53 + 1, 2**70, 2**70 + 1, True, np.float32(0.1), 2**53]:
+                shot, ao = make_shot(instruction_storage=storage)
+                ao.constant(t=0, value=value)
+                digests.append(output_digest(ao, np.array([]), 0.1))
+            self.assertEqual(len(set(digests)), 6)
+            self.assertEqual(digests[0], digests[-1])
+
+    def test_chunked_previous(self):
+        template = make_nested_shot()
+        template.start()
+        template.freeze()
+        previous = self.compile(template)
+        with self.assertRaises(ValueError):
+            template.fork().stop(10, chunk_size=10, previous=previous)
+
+
+class CheckInstructionsTest(unittest.TestCase):
+    """test finding invalid instructions"""
+
+    def test_violations(self):
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage)
+            shot.wait(t=10, name='wait')
+            ao.constant(t=0, value=1)
+            ao.constant(t=0, value=2)                                   # same time
+            ao.function(t=1, duration=2, function=np.sin, samplerate=2)
+            ao.constant(t=2, value=1)                                   # overlaps
+            ao.function(t=4, duration=1, function=np.sin, samplerate=20) # too fast
+            ao.constant(t=6, value=1)
+            ao.constant(t=6.04, value=1)                                # same tick
+            ao.function(t=9, duration=2, function=np.sin, samplerate=1) # straddles
+            ao.constant(t=10, value=1)
+            ao.constant(t=10.01, value=1)                               # same tick
+            with self.assertRaises(core.InvalidInstructionsError) as context:
+                shot.stop(12)
+            violations = context.exception.violations
+            self.assertEqual([(i.t, message.split()[0]) for i, message in violations],
+                             [(0, 'instruction'), (2, 'instruction'), (4, 'sample'),
+                              (6.04, 'instruction'), (9, 'Function'), (10.01, 'instruction')])
+            self.assertIn('ao.constant(t=2, value=1)', str(context.exception))
+
+
+class ShotTemplateTest(unittest.TestCase):
+    """test forking shots from a frozen template"""
+
+    def test_fork(self):
+        for storage in ['objects', 'columnar']:
+            template, ao = make_shot(instruction_storage=storage)
+            template.freeze()
+            with self.assertRaises(RuntimeError):
+                ao.constant(t=0, value=1)
+            shots = [template.fork(name=f'shot {i}') for i in range(2)]
+            for i, shot in enumerate(shots):
+                [pseudoclock] = shot.all_pseudoclocks
+                self.assertIsNot(pseudoclock, template.all_pseudoclocks[0])
+                [fork_ao] = pseudoclock.descendant_devices_of_type(core.Output)
+                self.assertIs(fork_ao.shot, shot)
+                fork_ao.constant(t=0, value=i)
+                fork_ao.constant(t=1 + i, value=i)
+            for i, shot in enumerate(shots):
+                shot.stop(5)
+                [pseudoclock] = shot.all_pseudoclocks
+                self.assertEqual(list(pseudoclock.ticks), [0, 10 + 10 * i])
+            self.assertEqual(template.total_instructions, 0)
+            self.assertEqual(len(ao.instructions), 0)
+            self.assertEqual(template.phase, core.phase.ADD_INSTRUCTIONS)
+
+    def test_fork_isolation(self):
+        from collections import defaultdict
+
+        class CountingClockLine(core.ClockLine):
+            # Modifies a dict attribute of itself when stopped:
+            def evaluate_functions(self, chunk_size=None, cache=None):
+                self.counts['evaluate_functions'] += 1
+                super().evaluate_functions(chunk_size, cache)
+
+        shot = core.Shot('<shot>', 100e-9)
+        pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+        pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                              clock_minimum_period=0.1, wait_delay=0.5,
+                                              timebase=0.1)
+        clockline = CountingClockLine('clockline', pulseblaster_clock, 'flag 1')
+        ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                       clock_minimum_trigger=0.1, clock_minimum_period=0.1)
+        core.Output('ao', ni_card, 'ao0')
+        shot.start()
+        clockline.counts = defaultdict(int)
+        clockline.settings = {'limiting': [ni_card]}
+        shot.freeze()
+        template = shot
+        forks = [template.fork() for _ in range(2)]
+        devices = [{device.name: device for device in shot.all_devices}
+                   for shot in [template] + forks]
+        _, fork, sibling = devices
+        self.assertIsInstance(fork['clockline'].counts, defaultdict)
+        self.assertIs(fork['clockline'].settings['limiting'][0], fork['ni_card'])
+        fork['ao'].constant(t=0, value=1)
+        forks[0].stop(2, compact=True)
+        self.assertEqual(fork['clockline'].counts, {'evaluate_functions': 1})
+        self.assertIn('clockline', forks[0].compaction)
+        for shot, shot_devices in [(template, devices[0]), (forks[1], sibling)]:
+            self.assertEqual(shot_devices['clockline'].counts, {})
+            self.assertIs(shot_devices['clockline'].settings['limiting'][0],
+                          shot_devices['ni_card'])
+            self.assertEqual(shot.compaction, {})
+            self.assertEqual(shot.reuse, {})
+            self.assertEqual(shot.phase, core.phase.ADD_INSTRUCTIONS)
+        # The sibling is unaffected and can be stopped in turn:
+        sibling['ao'].constant(t=0, value=2)
+        forks[1].stop(2)
+        self.assertEqual(sibling['clockline'].counts, {'evaluate_functions': 1})
+        self.assertEqual(devices[0]['clockline'].counts, {})
+
+    def test_fork_requires_frozen(self):
+        shot, ao = make_shot()
+        with self.assertRaises(RuntimeError):
+            shot.fork()
+        ao.constant(t=0, value=1)
+        with self.assertRaises(RuntimeError):
+            shot.freeze()
+
+
+class SweepTest(unittest.TestCase):
+    """test pickling shots and compiling them in worker processes"""
+
+    def make_shots(self, storage, n_shots=3):
+        from functions import LinearRamp
+        template, _ = make_shot(instruction_storage=storage)
+        template.freeze()
+        shots = []
+        for i in range(n_shots):
+            shot = template.fork()
+            [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+            ao.constant(t=0, value=i)
+            ao.function(t=1, duration=1, function=LinearRamp(1, 0, i), samplerate=5)
+            shots.append(shot)
+        return shots
+
+    def test_pickle(self):
+        import pickle
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            shot = self.make_shots(storage, n_shots=1)[0]
+            copy = pickle.loads(pickle.dumps(shot))
+            self.assertIsNot(copy.all_devices[0], shot.all_devices[0])
+            self.assertIs(copy.all_devices[0].shot, copy)
+            shot.stop(3)
+            copy.stop(3)
+            with self.assertRaises(core.AlreadyCalledError):
+                copy.all_clocklines[0].generate_ticks()
+            expected = shot_arrays(shot)
+            result = shot_arrays(copy)
+            self.assertEqual(list(result), list(expected))
+            for name in expected:
+                self.assertTrue(np.array_equal(result[name], expected[name]), name)
+
+    def test_compile_shots(self):
+        from sweep import compile_shots
+        for storage in ['objects', 'columnar']:
+            shots = self.make_shots(storage)
+            results = compile_shots(shots, 3, max_workers=2)
+            self.assertEqual(shots[0].phase, core.phase.ADD_INSTRUCTIONS)
+            for i, result in enumerate(results):
+                self.assertEqual(list(result['pulseblaster_clock/ticks']), [0, 10, 12, 14, 16, 18])
+                self.assertTrue(np.allclose(result['ao/values'], [i, 0, 0.2 * i, 0.4 * i,
+                                                                  0.6 * i, 0.8 * i]))
+
+    def test_compile_shots_error(self):
+        from sweep import compile_shots
+        shots = self.make_shots('objects', n_shots=2)
+        [ao] = shots[1].all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        ao.constant(t=0, value=1)
+        with self.assertRaises(core.InvalidInstructionsError) as context:
+            compile_shots(shots, 3, max_workers=2)
+        [(instruction, message)] = context.exception.violations
+        self.assertEqual(instruction.t, 0)
+
+
+class DaemonTest(unittest.TestCase):
+    """test compiling shots in a CompileDaemon"""
+
+    script = ("ao.constant(t=0, value=value)\n"
+              "ao.function(t=1, duration=1, function=np.sin, samplerate=5)\n")
+
+    def setUp(self):
+        import tempfile
+        from daemon import CompileDaemon
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'daemon.sock')
+        template, _ = make_shot()
+        self.daemon = CompileDaemon(self.path, {'basic': template}, max_workers=4)
+        self.thread = threading.Thread(target=self.daemon.run)
+        self.thread.start()
+        self.assertTrue(self.daemon.started.wait(5))
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.path))
+        self.tempdir.cleanup()
+
+    def expected(self, value, **kwargs):
+        from sweep import shot_arrays
+        shot, ao = make_shot()
+        ao.constant(t=0, value=value)
+        ao.function(t=1, duration=1, function=np.sin, samplerate=5)
+        shot.stop(3, **kwargs)
+        return shot_arrays(shot)
+
+    def assertArraysEqual(self, result, expected):
+        self.assertEqual(sorted(result), sorted(expected))
+        for name in expected:
+            self.assertTrue(np.array_equal(result[name], expected[name]), name)
+
+    def test_compile(self):
+        from daemon import CompileClient
+        with CompileClient(self.path) as client:
+            for value in [1, 2]:
+                result = client.compile('basic', self.script, 3, variables={'value': value})
+                self.assertArraysEqual(result, self.expected(value))
+                self.assertEqual(set(client.stats), {'fork', 'script', 'stop', 'send'})
+            result = client.compile('basic', self.script, 3, variables={'value': 3},
+                                    chunk_size=2)
+            self.assertEqual(result['ao/values'][0], 3)
+            self.assertTrue(np.array_equal(result['clockline/ticks'],
+                                           self.expected(3)['pulseblaster_clock/ticks']))
+
+    def test_errors(self):
+        from daemon import CompileClient, CompileError
+        with CompileClient(self.path) as client:
+            with self.assertRaises(CompileError) as context:
+                client.compile('basic', "ao.constant(t=0, value=1)\n"
+                                        "ao.constant(t=0, value=2)\n", 3)
+            self.assertEqual(context.exception.type_name, 'InvalidInstructionsError')
+            self.assertIn('<basic>", line 2', str(context.exception))
+            with self.assertRaises(CompileError) as context:
+                client.compile('nonexistent', self.script, 3)
+            self.assertEqual(context.exception.type_name, 'ValueError')
+            # The connection is still usable:
+            result = client.compile('basic', self.script, 3, variables={'value': 1})
+            self.assertArraysEqual(result, self.expected(1))
+
+    def test_malformed_requests(self):
+        from daemon import CompileClient, _length
+        with CompileClient(self.path) as client:
+            for data, error in [(b'{"template": ', 'JSONDecodeError'),
+                                (b'\xe9', 'UnicodeDecodeError'),
+                                (b'[]', 'ValueError'),
+                                (b'{"template": "basic"}', 'ValueError')]:
+                client.socket.sendall(_length.pack(len(data)) + data)
+                message = client._read_frame()
+                self.assertEqual(message['error'], error)
+            self.assertIn('script, stop_time', message['message'])
+            # The connection is still usable:
+            result = client.compile('basic', self.script, 3, variables={'value': 1})
+            self.assertArraysEqual(result, self.expected(1))
+
+    def test_existing_path(self):
+        import socket
+        from daemon import CompileDaemon, CompileClient
+        template, _ = make_shot()
+        # Neither a socket in use nor a file that is not a socket is removed:
+        path = os.path.join(self.tempdir.name, 'file')
+        with open(path, 'w') as f:
+            f.write('data')
+        for existing in [self.path, path]:
+            with self.assertRaises(FileExistsError):
+                CompileDaemon(existing, {'basic': template}).run()
+            self.assertTrue(os.path.exists(existing))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'data')
+        with CompileClient(self.path) as client:
+            result = client.compile('basic', self.script, 3, variables={'value': 1})
+            self.assertArraysEqual(result, self.expected(1))
+        # A socket nothing is listening on is replaced:
+        path = os.path.join(self.tempdir.name, 'stale.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(path)
+        daemon = CompileDaemon(path, {'basic': template})
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        try:
+            self.assertTrue(daemon.started.wait(5))
+            with CompileClient(path) as client:
+                result = client.compile('basic', self.script, 3, variables={'value': 1})
+                self.assertArraysEqual(result, self.expected(1))
+        finally:
+            daemon.shutdown()
+            thread.join(5)
+
+    def test_concurrent_clients(self):
+        from daemon import CompileClient
+        results = {}
+
+        def run(value):
+            with CompileClient(self.path) as client:
+                results[value] = [client.compile('basic', self.script, 3,
+                                                 variables={'value': value})
+                                  for _ in range(5)]
+
+        threads = [threading.Thread(target=run, args=(value,)) for value in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for value in range(8):
+            for result in results[value]:
+                self.assertArraysEqual(result, self.expected(value))
+
+
+class ShotCacheTest(unittest.TestCase):
+    """test caching the results of compiled shots on disk"""
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_shot(self, value=1, final=1, storage='objects', clock_minimum_period=0.1):
+        from functions import LinearRamp
+        shot = core.Shot('<shot>', 100e-9, instruction_storage=storage)
+        pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+        pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                              clock_minimum_period=clock_minimum_period,
+                                              wait_delay=0.5, timebase=0.1)
+        clockline = core.ClockLine('clockline', pulseblaster_clock, 'flag 1')
+        ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                       clock_minimum_trigger=0.1, clock_minimum_period=0.1)
+        ao = core.Output('ao', ni_card, 'ao0')
+        shot.start()
+        shot.wait(t=2.5, name='wait')
+        ao.constant(t=0, value=value)
+        ao.function(t=1, duration=1, function=LinearRamp(1, 0, final), samplerate=5)
+        return shot
+
+    def test_digest(self):
+        from shotcache import shot_digest
+        digest = shot_digest(self.make_shot(), 3)
+        self.assertEqual(shot_digest(self.make_shot(storage='columnar'), 3), digest)
+        renamed = self.make_shot()
+        renamed.name = 'other'
+        self.assertEqual(shot_digest(renamed, 3), digest)
+        for shot, stop_time in [(self.make_shot(value=2), 3), (self.make_shot(final=2), 3),
+                                (self.make_shot(clock_minimum_period=0.2), 3),
+                                (self.make_shot(), 4)]:
+            self.assertNotEqual(shot_digest(shot, stop_time), digest)
+        shot = self.make_shot()
+        shot.instructions[0].t = 2.6
+        self.assertNotEqual(shot_digest(shot, 3), digest)
+        [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        ao.function(t=2, duration=0.2, function=lambda t: t, samplerate=5)
+        self.assertIsNone(shot_digest(shot, 3))
+
+    def test_digest_values(self):
+        from shotcache import shot_digest
+        # Of values stored in the value column and not:
+        digests = []
+        for storage in ['objects', 'columnar']:
+            shot = self.make_shot(storage=storage)
+            [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+            ao.constants([0.5, 0.6, 0.7], [1, 2**60, 1])
+            ao.constants([0.8, 0.9], [np.float32(1), np.float32(2)])
+            digests.append(shot_digest(shot, 3))
+        self.assertEqual(digests[0], digests[1])
+        shot = self.make_shot(storage='columnar')
+        [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        ao.constants([0.5, 0.6, 0.7], [1, 2**60, 2])
+        ao.constants([0.8, 0.9], [np.float32(1), np.float32(2)])
+        self.assertNotEqual(shot_digest(shot, 3), digests[0])
+
+    def test_digest_globals(self):
+        global GAIN
+        from shotcache import shot_digest
+        shot = self.make_shot()
+        [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        ao.function(t=2, duration=0.2, function=gained, samplerate=5)
+        digest = shot_digest(shot, 3)
+        self.assertIsNotNone(digest)
+        try:
+            GAIN = 2.0
+            self.assertNotEqual(shot_digest(shot, 3), digest)
+        finally:
+            GAIN = 1.0
+        self.assertEqual(shot_digest(shot, 3), digest)
+        # A global that might be modified without being reassigned:
+        ao.function(t=2.3, duration=0.1, function=offset, samplerate=5)
+        self.assertIsNone(shot_digest(shot, 3))
+
+    def test_digest_attributes(self):
+        from shotcache import shot_digest
+        digest = shot_digest(self.make_shot(), 3)
+        digests = set()
+        for calibration in [{'gain': 1.0}, {'gain': 2.0}, [1.0], np.array([1.0])]:
+            shot = self.make_shot()
+            [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+            ao.calibration = calibration
+            digests.add(shot_digest(shot, 3))
+        self.assertEqual(len(digests), 4)
+        self.assertNotIn(digest, digests)
+        shot = self.make_shot()
+        [ao] = shot.all_pseudoclocks[0].descendant_devices_of_type(core.Output)
+        ao.calibration = object()
+        self.assertIsNone(shot_digest(shot, 3))
+
+    def test_hit(self):
+        from shotcache import ShotCache
+        from sweep import shot_arrays
+        cache = ShotCache(self.tempdir.name)
+        expected = self.make_shot()
+        expected.stop(3, cache=cache)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(len(cache), 1)
+        for storage in ['objects', 'columnar']:
+            shot = self.make_shot(storage=storage)
+            shot.stop(3, cache=cache)
+            self.assertEqual(shot.phase, core.phase.GENERATE_CLOCK_TICKS)
+            # Nothing was processed:
+            self.assertIsNone(shot.all_pseudoclocks[0].ticks)
+            result = shot_arrays(shot)
+            for name, array in shot_arrays(expected).items():
+                self.assertTrue(np.array_equal(result[name], array), name)
+        self.assertEqual(cache.hits, 2)
+        shot = self.make_shot(value=2)
+        shot.stop(3, cache=cache)
+        self.assertIsNone(shot.cached_arrays)
+        self.assertEqual(len(cache), 2)
+        with self.assertRaises(ValueError):
+            self.make_shot().stop(3, chunk_size=2, cache=cache)
+
+    def test_eviction(self):
+        from shotcache import ShotCache
+        from sweep import shot_arrays
+        cache = ShotCache(self.tempdir.name)
+        shot = self.make_shot()
+        shot.stop(3)
+        arrays = shot_arrays(shot)
+        for i, digest in enumerate(['a', 'b']):
+            cache.put(digest, arrays)
+            os.utime(cache.path(digest), (i, i))
+        cache.max_bytes = 2.5 * os.path.getsize(cache.path('a'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', arrays)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.evictions, 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_compile_shots(self):
+        from shotcache import ShotCache
+        from sweep import compile_shots
+        cache = ShotCache(self.tempdir.name)
+        shots = [self.make_shot(value=value) for value in [1, 2, 1]]
+        results = compile_shots(shots, 3, max_workers=2, cache=cache)
+        self.assertEqual(len(cache), 2)
+        cached = compile_shots(shots, 3, max_workers=2, cache=cache)
+        self.assertEqual(cache.hits, 3)
+        for result, expected in zip(cached, results):
+            for name in expected:
+                self.assertTrue(np.array_equal(result[name], expected[name]), name)
+
+
+class CompactionTest(unittest.TestCase):
+    """test dropping redundant clock ticks and run-length encoding values"""
+
+    def make_template(self, storage='objects'):
+        shot = core.Shot('<shot>', 100e-9, instruction_storage=storage)
+        pulseblaster = core.PseudoclockDevice('pulseblaster', shot, None, minimum_trigger=0.1)
+        pulseblaster_clock = core.Pseudoclock('pulseblaster_clock', pulseblaster, 'clock',
+                                              clock_minimum_period=0.1, wait_delay=0.5,
+                                              timebase=0.1)
+        clockline = core.ClockLine('clockline', pulseblaster_clock, 'flag 1')
+        ni_card = core.ClockableDevice('ni_card', clockline, 'clock',
+                                       clock_minimum_trigger=0.1, clock_minimum_period=0.1)
+        core.Output('ao0', ni_card, 'ao0')
+        core.Output('ao1', ni_card, 'ao1')
+        core.Output('unused', ni_card, 'ao2')
+        shot.start()
+        shot.freeze()
+        return shot
+
+    def setUp(self):
+        from functions import LinearRamp
+        # The same function object in every shot, so that results can be
+        # reused from a previous shot:
+        self.ramp = LinearRamp(1, 0, 0)
+
+    def fill(self, template):
+        shot = template.fork()
+        ao0, ao1, _ = shot.all_clocklines[0].descendant_devices_of_type(core.Output)
+        shot.wait(t=5, name='wait')
+        ao0.constant(t=0, value=1)
+        # Flat after its first 0.5s:
+        ao0.function(t=1, duration=2, function=np.tanh, samplerate=10)
+        ao0.constant(t=3.5, value=np.tanh(1.9))
+        ao0.constant(t=6, value=2)
+        ao1.constant(t=0, value=0)
+        ao1.function(t=2, duration=1, function=self.ramp, samplerate=10)
+        ao1.constant(t=4, value=3)
+        return shot
+
+    def held(self, shot):
+        # The value of each output at every tick of the clockline, by brute
+        # force:
+        from sweep import shot_arrays
+        arrays = shot_arrays(shot)
+        clockline = shot.all_clocklines[0]
+        held = {}
+        for output in clockline.descendant_devices_of_type(core.Output):
+            samples = list(zip(arrays[f'{output.name}/segments'].tolist(),
+                               arrays[f'{output.name}/timepoints'].tolist(),
+                               arrays[f'{output.name}/values'].tolist()))
+            if not samples:
+                continue
+            values = []
+            for tick in zip(clockline.tick_segments.tolist(), clockline.ticks.tolist()):
+                previous = [value for segment, timepoint, value in samples
+                            if (segment, timepoint) <= tick]
+                values.append(previous[-1] if previous else samples[0][2])
+            held[output.name] = values
+        return clockline.tick_segments.tolist(), clockline.ticks.tolist(), held
+
+    def test_compact(self):
+        from sweep import shot_arrays
+        for storage in ['objects', 'columnar']:
+            template = self.make_template(storage)
+            expected_shot = self.fill(template)
+            expected_shot.stop(7)
+            segments, ticks, held = self.held(expected_shot)
+            shot = self.fill(template)
+            shot.stop(7, compact=True)
+            clockline = shot.all_clocklines[0]
+            kept = list(zip(clockline.tick_segments.tolist(), clockline.ticks.tolist()))
+            all_ticks = list(zip(segments, ticks))
+            for i, tick in enumerate(all_ticks):
+                changed = i == 0 or segments[i] != segments[i - 1] or any(
+                    values[i] != values[i - 1] for values in held.values())
+                self.assertEqual(tick in kept, changed, tick)
+            self.assertLess(len(kept), len(all_ticks))
+            ao0, ao1, unused = clockline.descendant_devices_of_type(core.Output)
+            for output in [ao0, ao1]:
+                values = np.repeat(output.run_values, output.run_lengths)
+                expected = [held[output.name][all_ticks.index(tick)] for tick in kept]
+                self.assertEqual(values.tolist(), expected)
+                self.assertFalse(np.any(output.run_values[1:] == output.run_values[:-1]))
+            self.assertEqual(len(unused.run_values), 0)
+            pseudoclock = shot.all_pseudoclocks[0]
+            self.assertEqual(pseudoclock.ticks.tolist(), clockline.ticks.tolist())
+            stats = shot.compaction['clockline']
+            self.assertEqual(stats['ticks'], len(all_ticks))
+            self.assertEqual(stats['compacted_ticks'], len(kept))
+            self.assertEqual(stats['values'], 3 * len(all_ticks))
+            self.assertEqual(stats['runs'], len(ao0.run_values) + len(ao1.run_values))
+            self.assertGreater(stats['ratio'], 1)
+            arrays = shot_arrays(shot)
+            self.assertTrue(np.array_equal(arrays['ao1/run_lengths'], ao1.run_lengths))
+            self.assertNotIn('ao1/run_lengths', shot_arrays(expected_shot))
+
+    def test_invalid(self):
+        template = self.make_template()
+        with self.assertRaises(ValueError):
+            self.fill(template).stop(7, chunk_size=4, compact=True)
+        previous = self.fill(template)
+        previous.stop(7)
+        with self.assertRaises(ValueError):
+            self.fill(template).stop(7, previous=previous, compact=True)
+
+    def test_reuse_and_cache(self):
+        import tempfile
+        from shotcache import ShotCache
+        from sweep import shot_arrays
+        template = self.make_template()
+        previous = self.fill(template)
+        previous.stop(7, compact=True)
+        expected = shot_arrays(previous)
+        shot = self.fill(template)
+        shot.stop(7, previous=previous, compact=True)
+        self.assertIn('clockline', shot.reused_devices)
+        self.assertEqual(shot.compaction, previous.compaction)
+        with tempfile.TemporaryDirectory() as tempdir:
+            cache = ShotCache(tempdir)
+            for _ in range(2):
+                shot = self.fill(template)
+                shot.stop(7, cache=cache, compact=True)
+                self.assertEqual(shot.compaction, previous.compaction)
+                result = shot_arrays(shot)
+                for name in expected:
+                    self.assertTrue(np.array_equal(result[name], expected[name]), name)
+            self.assertEqual(cache.hits, 1)
+            shot = self.fill(template)
+            shot.stop(7, cache=cache)
+            self.assertIsNone(shot.cached_arrays)
+
+
+class ProfilingTest(unittest.TestCase):
+    """test collecting statistics of where compilation time goes"""
+
+    def test_profile(self):
+        import json
+        import pickle
+        for storage in ['objects', 'columnar']:
+            shot, ao = make_shot(instruction_storage=storage, profile=True)
+            shot.wait(t=3, name='wait')
+            ao.constant(t=0, value=1)
+            ao.function(t=1, duration=1, function=np.sin, samplerate=2)
+            shot = pickle.loads(pickle.dumps(shot))
+            shot.stop(4)
+            profile = shot.profile.as_dict()
+            self.assertEqual(list(profile['phases']), [phase.name for phase in core.phase])
+            for stats in profile['phases'].values():
+                self.assertGreaterEqual(stats['wall'], 0)
+                self.assertGreaterEqual(stats['cpu'], 0)
+            self.assertEqual(profile['methods']['ClockLine.evaluate_functions']['calls'], 1)
+            # Columnar storage doesn't call add_instruction() for Output instructions:
+            self.assertEqual(profile['methods']['HasInstructions.add_instruction']['calls'],
+                             3 if storage == 'objects' else 1)
+            # __init__ methods are timed too, despite being called before
+            # the instance has a shot:
+            self.assertEqual(profile['methods']['Device.__init__']['calls'], 5)
+            self.assertEqual(profile['methods']['Instruction.__init__']['calls'],
+                             3 if storage == 'objects' else 1)
+            self.assertIn('Device.__init__', str(shot.profile))
+            self.assertEqual(profile['traceback_captures'], 3)
+            self.assertEqual(profile['pseudoclocks'],
+                             {'pulseblaster_clock': {'devices': 3, 'outputs': 1,
+                                                     'instructions': 2}})
+            json.dumps(profile)
+            self.assertIn('GENERATE_CLOCK_TICKS', str(shot.profile))
+            last_line = list(ao.instructions)[0].traceback.splitlines()[-1]
+            self.assertIn('ao.constant', last_line)
+
+    def test_disabled(self):
+        shot, ao = make_shot()
+        self.assertIsNone(shot.profile)
+        ao.constant(t=0, value=1)
+        # Whether to time calls was decided once, when the method was bound:
+        self.assertIs(ao.__dict__['add_instruction'].__func__,
+                      type(ao).add_instruction)
+        shot.stop(1)
+        self.assertIsNone(shot.profile)
+
+    def test_fork(self):
+        template, _ = make_shot(profile=True)
+        template.freeze()
+        shot = template.fork()
+        self.assertIsNot(shot.profile, template.profile)
+        # Calls on the fork are timed in its own profile, not the template's:
+        ao, = [device for device in shot.all_devices if device.name == 'ao']
+        ao.constant(t=0, value=1)
+        self.assertNotIn('HasInstructions.add_instruction', template.profile.methods)
+        self.assertEqual(shot.profile.methods['HasInstructions.add_instruction']['calls'], 1)
+        shot.stop(1)
+        self.assertEqual(list(shot.profile.phases),
+                         [phase.name for phase in core.phase][core.phase.ADD_INSTRUCTIONS:])
+
+
 if __name__ == '__main__':
     try:
         unittest.main(verbosity=1)
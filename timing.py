@@ -0,0 +1,224 @@
+import numpy as np
+
+from enforce_phase import enforce_phase
+
+
+__all__ = ['TIMELINE_MODES', 'to_integer_time', 'to_integer_times', 'integer_timebase',
+           'wait_times', 'integer_wait_times', 'convert_times', 'convert_integer_times',
+           'quantise_wait_times',
+           'quantise_durations', 'quantise_integer_durations', 'quantise_sample_periods',
+           'quantise_period', 'quantise_integer_period', 'convert_instruction_times',
+           'quantise_instruction_durations', 'convert_timing']
+
+
+# How times are represented during processing. With 'float', instruction
+# times and durations are converted to quantised times from floats in
+# seconds during phase.CONVERT_TIMING. With 'integer', each time and
+# duration is converted once, when the instruction is created, to an integer
+# number of the shot's epsilon, and stored as integer_t and integer_duration
+# alongside t and duration, as are waits. Timebases and minimum periods are
+# converted to integers when devices establish their limits, and all later
+# arithmetic and comparisons of times are exact integer operations:
+TIMELINE_MODES = ('float', 'integer')
+
+
+def to_integer_time(t, epsilon):
+    """Convert a time or duration in seconds to the nearest integer number
+    of epsilon"""
+    return int(round(t / epsilon))
+
+
+def to_integer_times(t, epsilon):
+    """Array version of to_integer_time()"""
+    return np.rint(np.asarray(t, dtype=float) / epsilon).astype(np.int64)
+
+
+def integer_timebase(timebase, epsilon, device=None):
+    """Return a timebase as an integer number of epsilon, raising ValueError
+    if it is not a multiple of epsilon to within a millionth of the
+    timebase"""
+    n = to_integer_time(timebase, epsilon)
+    if n < 1 or abs(n * epsilon - timebase) > 1e-6 * timebase:
+        msg = (f"Timebase {timebase} of {device} is not a multiple of the shot's "
+               f"epsilon {epsilon}")
+        raise ValueError(msg)
+    return n
+
+
+def wait_times(waits):
+    """Return an array of the times of a list of Wait instructions, which
+    must already be sorted by time"""
+    return np.fromiter((wait.t for wait in waits), dtype=float, count=len(waits))
+
+
+def integer_wait_times(waits):
+    """Return an array of the integer times of a list of Wait instructions
+    of a shot with timeline='integer', which must already be sorted by
+    time"""
+    return np.fromiter((wait.integer_t for wait in waits), dtype=np.int64, count=len(waits))
+
+
+def convert_times(t, wait_times, timebase):
+    """Convert an array of times to be relative to the start of the segment
+    of the pseudoclock's execution they are in, where the start of the
+    experiment and each wait begin a new segment. wait_times must be sorted.
+    An instruction at exactly the time of a wait is in the segment following
+    the wait. Return the index of each time's segment, the relative times,
+    and the relative times quantised to an integer number of timebases."""
+    segment = np.searchsorted(wait_times, t, side='right')
+    segment_start = np.concatenate([[0.0], wait_times])[segment]
+    relative_t = t - segment_start
+    quantised_t = np.rint(relative_t / timebase).astype(np.int64)
+    return segment, relative_t, quantised_t
+
+
+def _divide_rounding(numerator, denominator):
+    # Integer division rounding to the nearest integer, with halves rounded
+    # up:
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def convert_integer_times(t, wait_times, timebase):
+    """Equivalent of convert_times() for integer times, wait times and
+    timebase, all in units of the shot's epsilon, returning relative times
+    in the same units. Quantised times are rounded to the nearest timebase,
+    with halves rounded up."""
+    segment = np.searchsorted(wait_times, t, side='right')
+    segment_start = np.concatenate([np.zeros(1, dtype=np.int64), wait_times])[segment]
+    relative_t = t - segment_start
+    return segment, relative_t, _divide_rounding(relative_t, timebase)
+
+
+def quantise_wait_times(wait_times, timebase, integer_timebase=None):
+    """Return the time of each of the sorted wait_times relative to the start
+    of the segment it ends, quantised to an integer number of timebases as
+    instruction times are, for comparing with the quantised end times of
+    instructions in that segment. If integer_timebase is given, wait_times
+    are integer times as for convert_integer_times()."""
+    if integer_timebase is None:
+        starts = np.concatenate([[0.0], wait_times[:-1]])
+        return np.rint((wait_times - starts) / timebase).astype(np.int64)
+    starts = np.concatenate([np.zeros(1, dtype=np.int64), wait_times[:-1]])
+    return _divide_rounding(wait_times - starts, integer_timebase)
+
+
+def quantise_durations(duration, timebase):
+    """Quantise an array of durations to an integer number of timebases"""
+    return np.rint(duration / timebase).astype(np.int64)
+
+
+def quantise_integer_durations(duration, timebase):
+    """Quantise an array of integer durations to an integer number of an
+    integer timebase, both in units of the shot's epsilon, with halves
+    rounded up"""
+    return _divide_rounding(np.asarray(duration, dtype=np.int64), timebase)
+
+
+def quantise_sample_periods(samplerate, timebase):
+    """Convert an array of sample rates to sample periods quantised to an
+    integer number of timebases, with a sample rate of zero (as used by
+    Constant instructions) giving a sample period of zero"""
+    samplerate = np.asarray(samplerate, dtype=float)
+    with np.errstate(divide='ignore'):
+        period = np.where(samplerate > 0, 1 / (samplerate * timebase), 0)
+    return np.rint(period).astype(np.int64)
+
+
+def quantise_period(period, timebase):
+    """Round a minimum period up to an integer number of timebases. Periods
+    within a millionth of a timebase of a multiple of it are taken to be that
+    multiple, to tolerate floating point error in the division."""
+    return int(np.ceil(period / timebase - 1e-6))
+
+
+def quantise_integer_period(period, timebase):
+    """Round an integer minimum period up to an integer number of an
+    integer timebase, both in units of the shot's epsilon"""
+    return -(-period // timebase)
+
+
+def convert_instruction_times(t, integer_t, waits, timebase, integer_timebase, epsilon):
+    """Convert the times of instructions as for convert_times(), given the
+    sorted list of the shot's waits. If integer_timebase is None, the shot
+    has timeline='float' and the times t are converted, otherwise it has
+    timeline='integer' and their integer versions integer_t are, and
+    relative times are converted back to seconds for the result."""
+    if integer_timebase is None:
+        return convert_times(t, wait_times(waits), timebase)
+    segment, relative_t, quantised_t = convert_integer_times(
+        integer_t, integer_wait_times(waits), integer_timebase)
+    return segment, relative_t * epsilon, quantised_t
+
+
+def quantise_instruction_durations(duration, integer_duration, timebase, integer_timebase):
+    """Quantise the durations of instructions, from their integer versions
+    if integer_timebase is not None, as for convert_instruction_times()"""
+    if integer_timebase is None:
+        return quantise_durations(duration, timebase)
+    return quantise_integer_durations(integer_duration, integer_timebase)
+
+
+# Cache of whether instances of each Instruction class can have their timing
+# converted in bulk, which is the case only if the class does not override
+# convert_timing() beyond the core implementations. Shared by all shots, but
+# as concurrent updates can only store the same value, it needs no lock:
+_batchable = {}
+
+
+def _is_batchable(cls):
+    try:
+        return _batchable[cls]
+    except KeyError:
+        from bases import Instruction
+        from instructions import Function
+        batchable = cls.convert_timing in (Instruction.convert_timing,
+                                           Function.convert_timing)
+        _batchable[cls] = batchable
+        return batchable
+
+
+def convert_timing(outputs, waits, timebase, integer_timebase=None, epsilon=None):
+    """Do the work of convert_timing() for all instructions of the given
+    outputs at once, which must all be controlled by a single pseudoclock
+    with the given timebase, and integer timebase if the shot has
+    timeline='integer', in which case epsilon is the shot's. Both lists of Instruction objects and
+    InstructionTables are supported: their times are gathered into a single
+    array, converted in one pass, and the results written back. waits must
+    be the sorted list of the shot's Wait instructions. The calls are
+    recorded with the phase enforcer as if convert_timing() had been called
+    on each instruction or table individually. Instructions whose class
+    reimplements convert_timing() have it called individually."""
+    from bases import Instruction
+    from table import InstructionTable, InstructionColumns
+    objects = []
+    table_outputs = []
+    for output in outputs:
+        if isinstance(output.instructions, InstructionTable):
+            table_outputs.append(output)
+            continue
+        for instruction in output.instructions:
+            if _is_batchable(type(instruction)):
+                objects.append(instruction)
+            else:
+                instruction.convert_timing(waits)
+    names = ['t', 'duration', 'samplerate']
+    if integer_timebase is not None:
+        names += ['integer_t', 'integer_duration']
+    columns = InstructionColumns(table_outputs, names, objects=objects)
+    integer_t = columns.columns.get('integer_t')
+    integer_duration = columns.columns.get('integer_duration')
+
+    segment, relative_t, quantised_t = convert_instruction_times(
+        columns.columns['t'], integer_t, waits, timebase, integer_timebase, epsilon)
+    columns.scatter('segment', segment)
+    columns.scatter('relative_t', relative_t)
+    columns.scatter('quantised_t', quantised_t)
+    columns.scatter('quantised_duration', quantise_instruction_durations(
+        columns.columns['duration'], integer_duration, timebase, integer_timebase))
+    columns.scatter('quantised_sample_period',
+                    quantise_sample_periods(columns.columns['samplerate'], timebase))
+
+    for table in columns.tables:
+        table.timing_converted = True
+    enforce_phase.record_calls(columns.tables, InstructionTable.convert_timing)
+    enforce_phase.record_calls(columns.objects, Instruction.convert_timing)
@@ -1,5 +1,21 @@
+import sys
+import traceback
 from operator import attrgetter
-import numpy as np
+
+from enforce_phase import PhaseEnforcedFunction, _sampled_call
+from profiling import ShotProfile
+
+# Modes for capturing the call site of user code that creates each
+# instruction, for use in error messages. 'full' formats the traceback
+# immediately (slow, as it reads source files), 'lazy' records only
+# (filename, lineno, function name) tuples and formats them when needed, and
+# 'off' records nothing at all:
+TRACEBACK_CAPTURE_MODES = ('full', 'lazy', 'off')
+
+# Frames of wrapper functions that are not counted when skipping labscript
+# frames to find where user code ends:
+_transparent_code = {PhaseEnforcedFunction.__call__.__code__, _sampled_call.__code__,
+                     ShotProfile._timed_call.__code__}
 
 def sort_by_time(instructions):
     instructions.sort(key=attrgetter('t'))
@@ -21,14 +37,32 @@ def sorted_by_quantised_time(instructions):
     return instructions
 
 
-def _const(c):
-    """Return a constant function"""
-    def const(t):
-        if isinstance(c, np.ndarray):
-            return np.full_like(t, c, dtype=type(c))
-        else:
-            return c
-    return const
+def capture_call_site(depth=1):
+    """Return the stack of the calling function as a tuple of (filename,
+    lineno, function name) tuples, outermost frame first, with the innermost
+    `depth` frames omitted. depth=1 omits only the calling function itself,
+    mirroring ''.join(traceback.format_stack()[:-depth]) called from the same
+    place. Frames of the @enforce_phase wrapper are not counted. This is cheap,
+    as no source lines are read."""
+    frame = sys._getframe(1)
+    while depth:
+        if frame.f_code not in _transparent_code:
+            depth -= 1
+        frame = frame.f_back
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def format_call_site(call_site):
+    """Format a call site as returned by capture_call_site() into a string in
+    the same format as traceback.format_stack()"""
+    frames = [traceback.FrameSummary(filename, lineno, name)
+              for filename, lineno, name in call_site]
+    return ''.join(traceback.StackSummary.from_list(frames).format())
 
 
 def formatobj(obj, *attrs):